@@ -0,0 +1,33 @@
+# Micro-benchmark: NumPy VolumeLimiterSource vs discord.PCMVolumeTransformer on 20 ms frames.
+# Usage: python benchmarks/bench_volume.py [frames]
+import os
+import sys
+import timeit
+
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark") # bot.py exits at import without a token; nothing connects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import numpy as np
+import discord
+import bot
+
+class LoopingPCMSource(discord.AudioSource):
+    """Replays a pre-rendered 20 ms frame of loud stereo noise so only the volume stage is measured."""
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.frame = (rng.standard_normal(bot.DSP_FRAME_SAMPLES * 2) * 12000).clip(-32768, 32767).astype(np.int16).tobytes()
+    def read(self) -> bytes: return self.frame
+
+def bench(label: str, source: discord.AudioSource, frames: int):
+    source.read() # Warm up buffers
+    seconds = timeit.timeit(source.read, number=frames)
+    print(f"{label:<28} {seconds / frames * 1e6:8.1f} us/frame ({frames} frames)")
+    return seconds
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for volume in (0.5, 1.5, 2.0):
+        print(f"volume={volume}")
+        try: baseline = bench("  PCMVolumeTransformer", discord.PCMVolumeTransformer(LoopingPCMSource(), volume=volume), frames)
+        except Exception as e: baseline = None; print(f"  PCMVolumeTransformer unavailable: {e}") # audioop missing (Python 3.13+)
+        numpy_stage = bench("  VolumeLimiterSource", bot.VolumeLimiterSource(LoopingPCMSource(), volume=volume), frames)
+        if baseline: print(f"  ratio (numpy / audioop): {numpy_stage / baseline:.2f}")
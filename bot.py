@@ -10,13 +10,30 @@ import json
 import os
 import datetime
 from datetime import timezone, timedelta
-from typing import Optional, Union, List, Dict, Any, Callable
+from typing import Optional, Union, List, Dict, Any, Callable, Tuple
 import functools
 import random
 import aiohttp
 import sys
 import traceback
-from io import StringIO # For queue export
+import time
+import copy
+import abc
+import hashlib
+import codecs
+import tempfile
+import contextlib
+import queue as thread_queue
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy as np # Optional: enables the in-process effects stage
+except ImportError:
+    np = None
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qsl, urlencode
 
 # --- CONFIGURATION ---
 BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
@@ -27,6 +44,8 @@ if not BOT_TOKEN:
 GUILD_SETTINGS_DIR = "guild_music_settings"
 USER_PLAYLISTS_DIR = "user_playlists"
 CUSTOM_PREFIXES_FILE = "custom_prefixes.json"
+STORAGE_BACKEND = "sqlite" # "sqlite": one WAL-mode database (JSON layout imported once on first start); "json": one file per guild / user
+SQLITE_DB_FILE = "music_bot.db"
 
 AUTO_LEAVE_DELAY = 120  # seconds
 MAX_QUEUE_SIZE = 250
@@ -36,19 +55,91 @@ UP_NEXT_NOTIFICATION_SECONDS = 15 # Increased slightly
 VOTE_SKIP_PERCENTAGE = 0.5 # 50%
 
 DEFAULT_FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin'
+LOCAL_FFMPEG_BEFORE_OPTIONS = '-nostdin' # The -reconnect options are http-only; FFmpeg rejects them for local files
 DEFAULT_FFMPEG_OPTIONS_AUDIO_ONLY = '-vn'
 LOUDNESS_NORMALIZATION_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
 DEFAULT_AUDIO_FILTERS = LOUDNESS_NORMALIZATION_FILTER
+LOUDNESS_DB_FILE = "loudness_measurements.json"
+AUDIO_CACHE_DIR = "audio_cache"
+LOUDNESS_TARGET_LUFS = -16.0 # Same target as LOUDNESS_NORMALIZATION_FILTER
+LOUDNESS_TRUE_PEAK_LIMIT = -1.5 # dBTP; static gain is clamped so the measured peak stays under this
+LOUDNESS_MAX_GAIN_DB = 12.0 # Never boost quiet tracks more than this with a static gain
+LOUDNESS_ANALYSIS_CONCURRENCY = 1 # Background ffmpeg measurement passes running at once
+LOUDNESS_ANALYSIS_MAX_DURATION = 20 * 60 # seconds; longer tracks keep using live loudnorm
+DSP_ENABLED = True # In-process NumPy effects stage (requires numpy); effects it covers change live without restarting FFmpeg
+DSP_FIR_TAPS = 1023 # Length of the combined bass/treble/EQ FIR filter
+VOLUME_SOFT_LIMITER = True # Soft-knee limiting instead of hard clipping when volume pushes samples past full scale (NumPy volume stage)
+VOLUME_LIMITER_THRESHOLD = 0.89 # Fraction of full scale (~-1 dBFS) where the limiter knee starts
+JITTER_BUFFER_SECONDS = 5.0 # PCM read ahead of the voice sender by a separate reader thread; 0 reads the FFmpeg pipe directly
+JITTER_STARTUP_TIMEOUT = 15.0 # seconds the first read waits for FFmpeg to connect and produce audio
+LIVE_STREAM_SHARING = True # One FFmpeg decode per distinct live stream + filter chain, fanned out to every guild playing it
+LIVE_SUBSCRIBER_BUFFER_SECONDS = 2.0 # Per-guild backlog of shared live frames; older frames are dropped past this
+GUILD_SETTINGS_SAVE_DELAY_SECONDS = 2.0 # Guild state saves within this window are coalesced into one write per guild
+GUILD_STATE_IDLE_SECONDS = 30 * 60 # Guilds not in voice and unused this long are flushed to storage and dropped from memory
+GUILD_STATE_MAX_RESIDENT = 5000 # Soft memory budget: exceeding it is logged; only guilds idle for GUILD_STATE_IDLE_SECONDS are ever evicted
+GUILD_STATE_EVICTION_INTERVAL = 60 # seconds between eviction passes
+QUEUE_JOURNAL_FLUSH_SECONDS = 0.25 # Queue operations are appended to the guild's journal in batches this often
+QUEUE_JOURNAL_COMPACT_OPS = 500 # Journal length after which the queue is rewritten as a snapshot and the journal truncated
+AUDIO_CACHE_ENABLED = True # Keep frequently played tracks on disk in their original codec and play them locally
+AUDIO_CACHE_MAX_BYTES = 2 * 1024 ** 3 # Byte budget for AUDIO_CACHE_DIR
+AUDIO_CACHE_ADMIT_AFTER_PLAYS = 3 # Plays before a track is downloaded
+AUDIO_CACHE_MAX_DURATION = 30 * 60 # seconds; longer tracks (mixes, DJ sets) keep streaming
+AUDIO_CACHE_PLAY_WEIGHT_SECONDS = 24 * 3600 # Eviction: each play counts like this much extra recency
+AUDIO_CACHE_TRACKED_PLAYS = 20000 # Play counters kept for tracks that aren't cached yet
+AUDIO_CACHE_DOWNLOAD_CONCURRENCY = 1
+AUDIO_CACHE_INDEX_SAVE_SECONDS = 30.0 # Play counts / recency are written behind at most this often
+STREAM_RECOVERY_MAX_ATTEMPTS = 3 # Re-resolve + resume attempts after a track's stream ends early
+STREAM_RECOVERY_END_TOLERANCE = 5 # seconds; EOF this close to the known duration counts as the real end
+STREAM_RECOVERY_RESET_SECONDS = 30 # A resumed segment that plays this long resets the attempt counter
+STREAM_RECOVERY_BACKOFF = 1.5 # seconds * attempt number to wait before resuming
+GAPLESS_ENABLED = True # Spawn and pre-buffer the next track's decoder before the current one ends, then switch on EOF
+GAPLESS_PREPARE_SECONDS = 10 # seconds before the known end of a track to open the next one
+GAPLESS_PREBUFFER_FRAMES = 25 # 20 ms frames read from the next decoder up front (connect + probe happen here)
+GAPLESS_CROSSFADE_SECONDS = 0.0 # >0 mixes the outgoing and incoming track over this long (requires numpy)
+OPUS_PASSTHROUGH_ENABLED = True # Send source Opus packets untouched when no filters are active and volume is at unity
+OPUS_PASSTHROUGH_VOLUME = 1.0 # Passthrough can't scale samples, so it only applies at 100% volume
+
+YTDL_CACHE_DIR = "ytdl_cache" # yt-dlp's own on-disk cache (player JS / signature functions)
+YTDL_POOL_SIZE_PER_PROFILE = 4 # Idle YoutubeDL instances kept per option profile
+RESOLUTION_WORKERS = 4 # Concurrent yt-dlp extractions across all guilds
+BULK_IMPORT_MAX_URLS = 500 # URLs accepted per /music queue import
+BULK_IMPORT_CONCURRENCY = 4 # Parallel resolves per import (still bounded globally by RESOLUTION_WORKERS)
+BULK_IMPORT_PROGRESS_INTERVAL = 2.0 # seconds between progress message edits
+IMPORT_MAX_BYTES = 8 * 1024 * 1024 # Import downloads are read in chunks and cut off past this size
+IMPORT_MAX_ENTRY_CHARS = 64 * 1024 # Longest single line / JSON object accepted by the import parser
+QUEUE_EXPORT_FORMAT = "music-queue-export" # Header tag of /music queue export JSON Lines files
+QUEUE_EXPORT_VERSION = 1
+
+TRACK_CACHE_DIR = "track_cache"
+TRACK_CACHE_MEMORY_ENTRIES = 5000 # Resolved tracks kept in the in-memory LRU
+TRACK_METADATA_TTL = 7 * 24 * 3600 # seconds; title/duration/uploader/thumbnail
+TRACK_STREAM_URL_TTL = 3600 # seconds; fallback lifetime when a stream URL carries no expire= and its extractor has no default
+STREAM_URL_DEFAULT_TTLS = {"youtube": 6 * 3600, "soundcloud": 1800, "bandcamp": 3600} # per extractor_key (lowercase)
+STREAM_URL_REFRESH_MARGIN = 120 # seconds; URLs expiring sooner than this are treated as stale
+STREAM_URL_PREFETCH_WINDOW = 900 # seconds; upcoming queue entries expiring within this get refreshed in the background
+STREAM_URL_REFRESH_INTERVAL = 300 # seconds; how often an idle pre-resolver re-checks upcoming URLs for expiry
+PRERESOLVE_LOOKAHEAD = 3 # Upcoming queue entries kept resolved with fresh stream URLs
+PRERESOLVE_RETRY_BACKOFF = 30 # seconds before retrying a soft look-ahead failure (rate limit, network); doubles per failure. Only hard failures flag an entry unplayable
+PRERESOLVE_RETRY_MAX_BACKOFF = 300 # seconds
+TRACK_NEGATIVE_TTL = 6 * 3600 # seconds; hard failures like "Video unavailable"
 
 # --- DATA PERSISTENCE ---
 if not os.path.exists(GUILD_SETTINGS_DIR): os.makedirs(GUILD_SETTINGS_DIR)
 if not os.path.exists(USER_PLAYLISTS_DIR): os.makedirs(USER_PLAYLISTS_DIR)
+if not os.path.exists(TRACK_CACHE_DIR): os.makedirs(TRACK_CACHE_DIR)
+if not os.path.exists(YTDL_CACHE_DIR): os.makedirs(YTDL_CACHE_DIR)
+if not os.path.exists(AUDIO_CACHE_DIR): os.makedirs(AUDIO_CACHE_DIR)
 
 # --- BOT SETUP ---
 # --- BOT SETUP ---
+class MusicCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.guild_id: await self.client.ensure_guild_loaded(interaction.guild_id) # Guild state is loaded lazily, before any slash command touches it
+        return True
+
 class MyClient(commands.Bot):
     def __init__(self, *, intents: discord.Intents, command_prefix: Union[str, List[str], Callable]):
-        super().__init__(command_prefix=command_prefix, intents=intents, help_command=None)
+        super().__init__(command_prefix=command_prefix, intents=intents, help_command=None, tree_cls=MusicCommandTree)
         self.start_time = datetime.datetime.now(timezone.utc)
         self._voice_clients: Dict[int, discord.VoiceClient] = {}
         self._queues: Dict[int, List[Dict[str, Any]]] = {}
@@ -58,6 +149,12 @@ class MyClient(commands.Bot):
         self._interactive_np_message_ids: Dict[int, int] = {} # guild_id -> message_id
 
         self._guild_settings: Dict[int, Dict[str, Any]] = {}
+        self._loaded_guilds: set = set() # Guilds whose stored state is in memory; others load on first use (ensure_guild_loaded)
+        self._guild_load_tasks: Dict[int, asyncio.Task] = {} # Single-flight loads
+        self._guild_last_used: "OrderedDict[int, float]" = OrderedDict() # Loaded guilds, least recently used first (monotonic time)
+        self._recently_evicted: "OrderedDict[int, bool]" = OrderedDict() # Bounded; tells reloads apart from first loads
+        self._guild_state_stats = {"loads": 0, "reloads": 0, "evictions": 0}
+        self._running_imports: Dict[int, int] = {} # guild_id -> bulk imports in progress; keeps the guild resident
 
         self._session_controllers: Dict[int, List[int]] = {}
         self._original_joiner: Dict[int, int] = {}
@@ -66,6 +163,15 @@ class MyClient(commands.Bot):
         self._vote_skips: Dict[int, Dict[int, List[int]]] = {}
 
         self._pending_text_searches: Dict[int, Dict[str, Any]] = {}
+        self._preresolve_tasks: Dict[int, asyncio.Task] = {} # Per-guild look-ahead resolver workers
+        self._preresolve_events: Dict[int, asyncio.Event] = {} # Set whenever the guild's queue changes
+        self._inflight_genre_streams: Dict[str, Tuple[asyncio.Task, int]] = {} # Single-flight genre stream lookups
+        self._gapless_sources: Dict[int, 'GaplessTrackSource'] = {} # Switching stage of the guild's current PCM chain
+        self._prepared_next: Dict[int, Dict[str, Any]] = {} # Pre-spawned decoder for the queue head: {'song', 'source', 'gapless', 'ffmpeg_filters'}
+        self._gapless_tasks: Dict[int, asyncio.Task] = {} # Timers that prepare the next decoder near the end of a track
+        self._playback_clocks: Dict[int, 'PlaybackClock'] = {} # Frame-driven position of each guild's current track
+        self._current_decoders: Dict[int, discord.AudioSource] = {} # FFmpeg source of the audible track (frame-counting), for early-EOF detection
+        self._playback_buffer_stats: Dict[int, Dict[str, float]] = {} # Per-guild jitter buffer counters, shared by every decoder the guild opens
 
         self.custom_prefixes: Dict[int, List[str]] = {}
         if callable(command_prefix):
@@ -80,11 +186,88 @@ class MyClient(commands.Bot):
     def set_guild_volume(self, guild_id: int, volume: float):
         self._guild_settings.setdefault(guild_id, {})["volume"] = volume
         if guild_id in self._voice_clients and self._voice_clients[guild_id].source:
-             if isinstance(self._voice_clients[guild_id].source, discord.PCMVolumeTransformer):
+             if isinstance(self._voice_clients[guild_id].source, VOLUME_SOURCE_TYPES):
                 self._voice_clients[guild_id].source.volume = volume
+             elif self._voice_clients[guild_id].source.is_opus() and volume != OPUS_PASSTHROUGH_VOLUME:
+                self.loop.create_task(self.restart_current_song(guild_id)) # Passthrough can't scale; move to the PCM path
+
+    def can_use_opus_passthrough(self, guild_id: int, song: Dict[str, Any]) -> bool:
+        # Source Opus packets go straight to Discord only when nothing would touch the samples
+        return OPUS_PASSTHROUGH_ENABLED and not self.get_guild_ffmpeg_filters(guild_id) and \
+               self.get_guild_volume(guild_id) == OPUS_PASSTHROUGH_VOLUME and not song.get('is_live_stream') and is_opus_stream(song)
+
+    def apply_live_effects(self, guild_id: int) -> bool:
+        # Swaps the in-process DSP parameters on the running source if the FFmpeg part of the chain is unchanged
+        vc = self._voice_clients.get(guild_id)
+        volume_source = vc.source if vc and (vc.is_playing() or vc.is_paused()) else None
+        dsp_source = getattr(volume_source, 'original', None) if isinstance(volume_source, VOLUME_SOURCE_TYPES) else None
+        if not isinstance(dsp_source, EffectsDSPSource): return False
+        ffmpeg_filters, dsp_spec = split_filters_for_dsp(self.get_guild_ffmpeg_filters(guild_id))
+        if ffmpeg_filters != dsp_source.ffmpeg_filters: return False
+        dsp_source.set_effects(dsp_spec)
+        print(f"DEBUG DSP: Applied effects live for guild {guild_id}: {dsp_spec}")
+        return True
+
+    async def restart_current_song(self, guild_id: int) -> bool:
+        # Restarts the current song at its current position, re-selecting the playback path (passthrough / PCM / filters)
+        vc = self._voice_clients.get(guild_id); current_song = self._current_song.get(guild_id)
+        if not vc or not (vc.is_playing() or vc.is_paused()) or not current_song or current_song.get('is_live_stream'): return False
+        accumulated_time = self.get_playback_position(guild_id)
+        song_duration = current_song.get('duration')
+        # Ensure seek time is valid
+        if isinstance(song_duration, (int,float)) and accumulated_time >= song_duration :
+             accumulated_time = song_duration - 0.1 if song_duration > 0.1 else 0.0
+        # vc.stop() is handled by _play_guild_queue
+        await self._play_guild_queue(guild_id, song_to_replay=current_song.copy(), seek_seconds=max(0, accumulated_time))
+        return True
+
+    def get_playback_clock(self, guild_id: int) -> 'PlaybackClock': return self._playback_clocks.setdefault(guild_id, PlaybackClock())
+
+    def get_playback_position(self, guild_id: int) -> float:
+        # Seconds into the current track, from delivered audio frames; wall-clock bookkeeping only before any audio went out (e.g. restored state)
+        current_song = self._current_song.get(guild_id)
+        if not current_song: return 0.0
+        clock = self._playback_clocks.get(guild_id)
+        if clock and clock.owner is not None: return clock.position()
+        elapsed = current_song.get('accumulated_play_time_seconds', 0.0)
+        if current_song.get('play_start_utc'): elapsed += (datetime.datetime.now(timezone.utc) - current_song['play_start_utc']).total_seconds()
+        return elapsed
+
+    def seconds_until_position(self, guild_id: int, track_position: float) -> float:
+        # Real time until the current track reaches track_position, accounting for tempo effects
+        clock = self._playback_clocks.get(guild_id)
+        if clock and clock.owner is not None: return clock.wall_seconds_until(track_position)
+        return max(0.0, track_position - self.get_playback_position(guild_id))
+
+    # Queue mutations: every change goes through apply_queue_op and is journaled (O(1) per operation on disk)
+    def _apply_queue_op(self, guild_id: int, op: Dict[str, Any]) -> Any:
+        # An unloaded guild's in-memory queue is empty, not its real queue; editing and journaling it would replace the stored one
+        if guild_id not in self._loaded_guilds: raise RuntimeError(f"Queue '{op['op']}' for guild {guild_id} before its state was loaded (call ensure_guild_loaded first)")
+        queue = self._queues.setdefault(guild_id, [])
+        result = apply_queue_op(queue, op)
+        queue_journal.record(guild_id, op, queue)
+        return result
+
+    def queue_add(self, guild_id: int, song: Dict[str, Any], index: Optional[int] = None): self._apply_queue_op(guild_id, {"op": "add", "song": song, "index": index})
+    def queue_pop(self, guild_id: int, index: int = 0) -> Dict[str, Any]: return self._apply_queue_op(guild_id, {"op": "pop", "index": index})
+    def queue_move(self, guild_id: int, from_index: int, to_index: int) -> Dict[str, Any]: return self._apply_queue_op(guild_id, {"op": "move", "from": from_index, "to": to_index})
+    def queue_remove_range(self, guild_id: int, start: int, count: int) -> List[Dict[str, Any]]: return self._apply_queue_op(guild_id, {"op": "remove_range", "start": start, "count": count})
+    def queue_shuffle(self, guild_id: int): self._apply_queue_op(guild_id, {"op": "shuffle", "seed": random.getrandbits(32)}) # Seeded so replay reproduces the order
+    def queue_clear(self, guild_id: int): self._apply_queue_op(guild_id, {"op": "clear"})
+    def queue_replace(self, guild_id: int, songs: List[Dict[str, Any]]): self._apply_queue_op(guild_id, {"op": "replace", "songs": songs})
+    def queue_update(self, guild_id: int, song: Dict[str, Any], fields: Dict[str, Any], removed: Tuple[str, ...] = ()):
+        # Edits `song` wherever it is; journaled only while it is still queued (it may have started playing meanwhile)
+        index = next((i for i, queued in enumerate(self._queues.get(guild_id, [])) if queued is song), None)
+        if index is None:
+            song.update(fields)
+            for key in removed: song.pop(key, None)
+            return
+        self._apply_queue_op(guild_id, {"op": "update", "index": index, "fields": fields, "removed": [key for key in removed if key in song]})
 
     def get_guild_loop_mode(self, guild_id: int) -> str: return self._guild_settings.get(guild_id, {}).get("loop_mode", "off")
-    def set_guild_loop_mode(self, guild_id: int, mode: str): self._guild_settings.setdefault(guild_id, {})["loop_mode"] = mode
+    def set_guild_loop_mode(self, guild_id: int, mode: str):
+        self._guild_settings.setdefault(guild_id, {})["loop_mode"] = mode
+        if mode == "song": self._discard_prepared_next(guild_id) # The current track repeats instead of moving on
 
     def get_guild_ffmpeg_filters(self, guild_id: int) -> str: return self._guild_settings.get(guild_id, {}).get("ffmpeg_filters", DEFAULT_AUDIO_FILTERS)
     def set_guild_ffmpeg_filters(self, guild_id: int, filters: str): self._guild_settings.setdefault(guild_id, {})["ffmpeg_filters"] = filters
@@ -105,12 +288,28 @@ class MyClient(commands.Bot):
     def set_guild_dj_role_id(self, guild_id: int, role_id: Optional[int]): self._guild_settings.setdefault(guild_id, {})["dj_role_id"] = role_id
 
     async def setup_hook(self):
+        await asyncio.to_thread(storage.open) # Schema + one-time JSON import; everything below reads from it
         self.tree.add_command(music_group)
         await self.tree.sync()
-        self.loop.create_task(self.load_all_guild_settings_on_startup()) # Call to method
         self.loop.create_task(self.load_custom_prefixes_from_file())
         self.loop.create_task(self.cleanup_old_pending_searches())
+        self.loop.create_task(self.evict_idle_guild_state())
         self.loop.create_task(self.attempt_24_7_rejoins_on_startup()) # Call to method
+        self.loop.create_task(asyncio.to_thread(track_cache.prune_disk))
+        self.loop.create_task(asyncio.to_thread(ytdl_pool.warm))
+        self.loop.create_task(asyncio.to_thread(loudness_store.load))
+        self.loop.create_task(asyncio.to_thread(audio_cache.load))
+
+    async def close(self):
+        try: await guild_state_persister.close(); await queue_journal.close() # Flush-on-shutdown: pending guild state reaches disk before the connection goes away
+        except Exception as e: print(f"Error flushing guild settings on shutdown: {e}")
+        try: await audio_cache.close() # Play counts not yet written behind
+        except Exception as e: print(f"Error saving audio cache index on shutdown: {e}")
+        await super().close()
+        # Commands and voice callbacks may have saved until the gateway closed; write that too, then close storage last
+        try: await guild_state_persister.close(); await queue_journal.close()
+        except Exception as e: print(f"Error flushing guild settings on shutdown: {e}")
+        await asyncio.to_thread(storage.close)
 
     async def get_prefix(self, message: discord.Message):
         if not message.guild:
@@ -119,53 +318,41 @@ class MyClient(commands.Bot):
         return commands.when_mentioned_or(*guild_prefixes)(self, message)
 
     async def load_custom_prefixes_from_file(self):
-        if os.path.exists(CUSTOM_PREFIXES_FILE):
-            try:
-                with open(CUSTOM_PREFIXES_FILE, "r") as f:
-                    self.custom_prefixes = {int(k): v for k, v in json.load(f).items()}
-            except Exception as e:
-                print(f"Error loading custom prefixes: {e}")
+        try: self.custom_prefixes = await asyncio.to_thread(storage.load_prefixes)
+        except Exception as e:
+            print(f"Error loading custom prefixes: {e}")
 
-    async def save_custom_prefixes_to_file(self):
-        try:
-            with open(CUSTOM_PREFIXES_FILE, "w") as f:
-                json.dump(self.custom_prefixes, f, indent=4)
+    async def save_custom_prefixes_to_file(self, guild_id: int):
+        try: await asyncio.to_thread(storage.save_guild_prefixes, guild_id, list(self.custom_prefixes.get(guild_id, [])) or None)
         except Exception as e:
             print(f"Error saving custom prefixes: {e}")
 
-    def get_guild_settings_save_path(self, guild_id: int) -> str:
-        return os.path.join(GUILD_SETTINGS_DIR, f"{guild_id}_settings.json")
-
-    def get_user_playlist_path(self, user_id: int) -> str:
-        return os.path.join(USER_PLAYLISTS_DIR, f"{user_id}_playlists.json")
-
     # These methods must be indented to be part of MyClient
     async def save_guild_settings_to_file(self, guild_id: int):
-        settings_path = self.get_guild_settings_save_path(guild_id)
-        queue_to_save_serializable = []
-        original_queue = self._queues.get(guild_id, [])
-        for song in original_queue:
-            s_copy = song.copy()
-            s_copy.pop('play_start_utc', None)
-            queue_to_save_serializable.append(s_copy)
-
+        # Write-behind: marks the guild dirty; its latest state is written off the event loop within GUILD_SETTINGS_SAVE_DELAY_SECONDS
+        if guild_id not in self._loaded_guilds: await self.ensure_guild_loaded(guild_id) # Otherwise defaults would overwrite the stored settings
+        guild_state_persister.mark_dirty(guild_id, functools.partial(self._guild_settings_snapshot, guild_id))
+
+    async def flush_guild_settings(self, guild_id: int):
+        # Writes the guild's pending state now, before state the snapshot depends on (voice client, playback clock) is torn down
+        await guild_state_persister.flush([guild_id])
+
+    def _guild_settings_snapshot(self, guild_id: int) -> Tuple[str, Dict[str, Any]]:
+        # Runs on the event loop; the current song is copied so the writer thread never sees live dicts
+        # The queue itself lives in the guild's queue journal; this holds settings and the current song only
+        if guild_id not in self._loaded_guilds: raise RuntimeError(f"Guild {guild_id} is not loaded; stored settings left as they are")
         current_playing_song_serializable = None
         current_playing_song_original = self._current_song.get(guild_id)
         if current_playing_song_original:
             current_playing_song_serializable = current_playing_song_original.copy()
             current_playing_song_serializable.pop('play_start_utc', None)
-            if current_playing_song_original.get('play_start_utc'):
-                elapsed_this_segment = (datetime.datetime.now(timezone.utc) - current_playing_song_original['play_start_utc']).total_seconds()
-                current_playing_song_serializable['accumulated_play_time_seconds'] = \
-                    current_playing_song_original.get('accumulated_play_time_seconds', 0.0) + elapsed_this_segment
-            
-            if not queue_to_save_serializable or \
-               (queue_to_save_serializable[0].get('webpage_url') != current_playing_song_serializable.get('webpage_url')):
-                queue_to_save_serializable.insert(0, current_playing_song_serializable)
-        
+            current_playing_song_serializable['accumulated_play_time_seconds'] = self.get_playback_position(guild_id)
+            if not current_playing_song_original.get('is_live_stream') and current_playing_song_serializable['accumulated_play_time_seconds'] > 0:
+                current_playing_song_serializable['resume_position_seconds'] = current_playing_song_serializable['accumulated_play_time_seconds'] # Picked up when this entry plays again
+
         self._guild_settings.setdefault(guild_id, {})
         data_to_save = {
-            "queue": queue_to_save_serializable,
+            "current_song": current_playing_song_serializable,
             "volume": self.get_guild_volume(guild_id),
             "loop_mode": self.get_guild_loop_mode(guild_id),
             "ffmpeg_filters": self.get_guild_ffmpeg_filters(guild_id),
@@ -175,77 +362,122 @@ class MyClient(commands.Bot):
             "last_known_vc_channel_id": self.get_last_known_vc_channel_id(guild_id),
             "dj_role_id": self.get_guild_dj_role_id(guild_id),
         }
-        try:
-            with open(settings_path, 'w') as f:
-                json.dump(data_to_save, f, indent=4)
-        except Exception as e:
-            print(f"Error saving settings for guild {guild_id}: {e}")
-            traceback.print_exc()
+        return data_to_save
 
     async def load_guild_settings_from_file(self, guild_id: int):
-        settings_path = self.get_guild_settings_save_path(guild_id)
         self._guild_settings[guild_id] = {
             "volume": 0.5, "loop_mode": "off", "ffmpeg_filters": DEFAULT_AUDIO_FILTERS,
             "smart_autoplay": True, "is_24_7_mode": False, "autoplay_genre": None,
             "last_known_vc_channel_id": None, "dj_role_id": None,
         }
         self._queues[guild_id] = []
-        if os.path.exists(settings_path):
-            try:
-                with open(settings_path, 'r') as f: data = json.load(f)
-                for key in self._guild_settings[guild_id].keys():
-                    if key in data: self._guild_settings[guild_id][key] = data[key]
-                self._queues[guild_id] = data.get("queue", [])
-            except Exception as e:
-                print(f"Error loading settings for guild {guild_id}: {e}. Using defaults.")
-                self._queues[guild_id] = []
+        data = {}
+        try:
+            data = await asyncio.to_thread(storage.load_guild_settings, guild_id) or {}
+            for key in self._guild_settings[guild_id].keys():
+                if key in data: self._guild_settings[guild_id][key] = data[key]
+        except Exception as e:
+            print(f"Error loading settings for guild {guild_id}: {e}. Using defaults.")
+            data = {}
+        try: await queue_journal.flush(); recovered_queue = await asyncio.to_thread(queue_journal.load, guild_id)
+        except Exception as e: print(f"Error recovering queue for guild {guild_id}: {e}"); recovered_queue = None
+        if recovered_queue is not None: self._queues[guild_id] = recovered_queue
+        self._loaded_guilds.add(guild_id) # Stored state is in place; the queue ops below extend it
+        if recovered_queue is None and data.get("queue"): self.queue_replace(guild_id, data["queue"]) # Settings file from before the queue journal; carries the current song at its head
+        saved_current_song = data.get("current_song")
+        if saved_current_song and (not self._queues[guild_id] or self._queues[guild_id][0].get('webpage_url') != saved_current_song.get('webpage_url')):
+            self.queue_add(guild_id, saved_current_song, 0) # Resumes first, as before
         self._session_controllers.pop(guild_id, None); self._original_joiner.pop(guild_id, None)
         self._current_song.pop(guild_id, None)
+        self._touch_guild(guild_id)
+        self._guild_state_stats["loads"] += 1
+        if self._recently_evicted.pop(guild_id, None): self._guild_state_stats["reloads"] += 1
+
+    def _touch_guild(self, guild_id: int):
+        self._guild_last_used[guild_id] = time.monotonic(); self._guild_last_used.move_to_end(guild_id)
+
+    async def ensure_guild_loaded(self, guild_id: int):
+        # Loads stored settings + queue on first use (command, voice event, 24/7 rejoin) instead of for every guild at startup
+        if guild_id in self._loaded_guilds: self._touch_guild(guild_id); return
+        task = self._guild_load_tasks.get(guild_id)
+        if task is None:
+            task = self._guild_load_tasks[guild_id] = self.loop.create_task(self.load_guild_settings_from_file(guild_id))
+            task.add_done_callback(lambda _: self._guild_load_tasks.pop(guild_id, None))
+        await asyncio.shield(task) # A cancelled caller must not abort the load for everyone else
+
+    def _is_guild_evictable(self, guild_id: int) -> bool:
+        # Only guilds idle for GUILD_STATE_IDLE_SECONDS (longer than any view timeout); anything audible, connected, loading,
+        # importing or still showing live controls keeps the guild resident
+        leave_task = self._leave_tasks.get(guild_id)
+        return guild_id in self._loaded_guilds and time.monotonic() - self._guild_last_used.get(guild_id, 0) >= GUILD_STATE_IDLE_SECONDS and \
+               guild_id not in self._voice_clients and guild_id not in self._guild_load_tasks and not self._running_imports.get(guild_id) and \
+               not self._is_processing_next_song.get(guild_id) and guild_id not in self._interactive_np_message_ids and not (leave_task and not leave_task.done())
+
+    async def evict_guild_state(self, guild_id: int) -> bool:
+        # Flushes the guild's settings and queue journal, then drops its in-memory state; ensure_guild_loaded brings it back
+        if not self._is_guild_evictable(guild_id): return False
+        last_used = self._guild_last_used.get(guild_id)
+        await self.save_guild_settings_to_file(guild_id); await self.flush_guild_settings(guild_id); await queue_journal.flush()
+        if self._guild_last_used.get(guild_id) != last_used or not self._is_guild_evictable(guild_id) or guild_state_persister.is_dirty(guild_id): return False # Used again while flushing
+        if not queue_journal.forget(guild_id): return False # Queue changed while flushing; try again next pass
+        for guild_state in (self._queues, self._guild_settings, self._current_song, self._last_text_channel, self._session_controllers, self._original_joiner,
+                            self._vote_skips, self._is_processing_next_song, self._playback_buffer_stats, self._playback_clocks, self._current_decoders, self._preresolve_events):
+            guild_state.pop(guild_id, None)
+        for guild_tasks in (self._preresolve_tasks, self._up_next_tasks, self._leave_tasks, self._gapless_tasks):
+            task = guild_tasks.pop(guild_id, None)
+            if task: task.cancel()
+        self._loaded_guilds.discard(guild_id); self._guild_last_used.pop(guild_id, None)
+        self._recently_evicted[guild_id] = True
+        while len(self._recently_evicted) > GUILD_STATE_MAX_RESIDENT: self._recently_evicted.popitem(last=False)
+        self._guild_state_stats["evictions"] += 1
+        return True
 
-    async def load_all_guild_settings_on_startup(self): # Now correctly indented
-        print("Loading saved guild settings...")
-        for filename in os.listdir(GUILD_SETTINGS_DIR):
-            if filename.endswith("_settings.json"):
+    async def evict_idle_guild_state(self):
+        await self.wait_until_ready()
+        while not self.is_closed():
+            await asyncio.sleep(GUILD_STATE_EVICTION_INTERVAL)
+            idle_cutoff = time.monotonic() - GUILD_STATE_IDLE_SECONDS; evicted = 0
+            for guild_id, last_used in list(self._guild_last_used.items()): # Least recently used first
+                if last_used > idle_cutoff: break # Everything after this is more recent; active guilds are never evicted, even over budget
                 try:
-                    guild_id_str = filename.split("_")[0]
-                    if guild_id_str.isdigit(): await self.load_guild_settings_from_file(int(guild_id_str))
-                except Exception as e: print(f"Error startup settings load for {filename}: {e}")
-        print("Finished loading guild settings.")
+                    if await self.evict_guild_state(guild_id): evicted += 1
+                except Exception as e: print(f"Error evicting state of guild {guild_id}: {e}")
+            if evicted: print(f"DEBUG GUILD STATE: Evicted {evicted} idle guilds; {len(self._loaded_guilds)} resident.")
+            if len(self._loaded_guilds) > GUILD_STATE_MAX_RESIDENT:
+                print(f"Warning: {len(self._loaded_guilds)} guilds resident, over GUILD_STATE_MAX_RESIDENT ({GUILD_STATE_MAX_RESIDENT}); none left idle for {GUILD_STATE_IDLE_SECONDS}s to evict.")
+
+    async def invoke(self, ctx: commands.Context):
+        if ctx.guild and ctx.command: await self.ensure_guild_loaded(ctx.guild.id) # Text commands: same lazy load as slash commands
+        await super().invoke(ctx)
 
     async def attempt_24_7_rejoins_on_startup(self): # Now correctly indented
         await self.wait_until_ready()
         print("Attempting 24/7 rejoins...")
-        for guild_id_str_settings_file in os.listdir(GUILD_SETTINGS_DIR): # Renamed to avoid conflict
-             if guild_id_str_settings_file.endswith("_settings.json"):
-                try:
-                    guild_id_str = guild_id_str_settings_file.split("_")[0]
-                    if not guild_id_str.isdigit(): continue # Skip if filename isn't as expected
-                    guild_id = int(guild_id_str)
-
-                    # Ensure settings are loaded for this guild if not already
-                    if guild_id not in self._guild_settings:
-                        await self.load_guild_settings_from_file(guild_id)
-
-                    if self.get_guild_24_7_mode(guild_id):
-                        channel_id = self.get_last_known_vc_channel_id(guild_id)
-                        guild = self.get_guild(guild_id)
-                        if guild and channel_id:
-                            vc_channel = guild.get_channel(channel_id)
-                            if isinstance(vc_channel, discord.VoiceChannel):
-                                try:
-                                    print(f"Attempting 24/7 rejoin to {vc_channel.name} in {guild.name}")
-                                    vc = await vc_channel.connect(timeout=10.0, reconnect=True)
-                                    self._voice_clients[guild_id] = vc
-                                    self._last_text_channel[guild_id] = guild.system_channel or next((tc for tc in guild.text_channels if tc.permissions_for(guild.me).send_messages), None)
-                                    if self._queues.get(guild_id) and not vc.is_playing():
-                                        await self._play_guild_queue(guild_id)
-                                    elif not self._queues.get(guild_id) and self.get_guild_autoplay_genre(guild_id):
-                                        await self._play_guild_queue(guild_id)
-                                    print(f"Successfully rejoined {vc_channel.name} for 24/7 mode.")
-                                except Exception as e: print(f"Failed 24/7 rejoin for guild {guild_id} to channel {channel_id}: {e}")
-                            else: print(f"24/7 rejoin: VC ID {channel_id} not found or not a voice channel in guild {guild_id}.")
-                except Exception as e_outer:
-                    print(f"Error processing file {guild_id_str_settings_file} for 24/7 rejoin: {e_outer}")
+        for guild_id, indexed_channel_id in await asyncio.to_thread(storage.rejoin_index): # Lightweight index; full state loads only for guilds we rejoin
+            try:
+                if not indexed_channel_id or not self.get_guild(guild_id): continue # No channel to rejoin or no longer in the guild
+                await self.ensure_guild_loaded(guild_id)
+
+                if self.get_guild_24_7_mode(guild_id):
+                    channel_id = self.get_last_known_vc_channel_id(guild_id)
+                    guild = self.get_guild(guild_id)
+                    if guild and channel_id:
+                        vc_channel = guild.get_channel(channel_id)
+                        if isinstance(vc_channel, discord.VoiceChannel):
+                            try:
+                                print(f"Attempting 24/7 rejoin to {vc_channel.name} in {guild.name}")
+                                vc = await vc_channel.connect(timeout=10.0, reconnect=True)
+                                self._voice_clients[guild_id] = vc
+                                self._last_text_channel[guild_id] = guild.system_channel or next((tc for tc in guild.text_channels if tc.permissions_for(guild.me).send_messages), None)
+                                if self._queues.get(guild_id) and not vc.is_playing():
+                                    await self._play_guild_queue(guild_id)
+                                elif not self._queues.get(guild_id) and self.get_guild_autoplay_genre(guild_id):
+                                    await self._play_guild_queue(guild_id)
+                                print(f"Successfully rejoined {vc_channel.name} for 24/7 mode.")
+                            except Exception as e: print(f"Failed 24/7 rejoin for guild {guild_id} to channel {channel_id}: {e}")
+                        else: print(f"24/7 rejoin: VC ID {channel_id} not found or not a voice channel in guild {guild_id}.")
+            except Exception as e_outer:
+                print(f"Error processing guild {guild_id} for 24/7 rejoin: {e_outer}")
         print("Finished 24/7 rejoin attempts.")
 
     def is_controller(self, interaction_or_ctx: Union[discord.Interaction, commands.Context]) -> bool:
@@ -331,7 +563,7 @@ class MyClient(commands.Bot):
                     self._session_controllers.setdefault(guild_id, []).clear(); self._session_controllers[guild_id].append(author_member.id)
         elif user_vc_channel and join_if_not_connected:
             try:
-                if guild_id not in self._guild_settings: await self.load_guild_settings_from_file(guild_id) # Corrected call
+                await self.ensure_guild_loaded(guild_id) # Single-flight with any load already in progress
                 vc = await user_vc_channel.connect(timeout=10.0, reconnect=True)
                 self._voice_clients[guild_id] = vc
                 self.set_last_known_vc_channel_id(guild_id, user_vc_channel.id)
@@ -351,21 +583,25 @@ class MyClient(commands.Bot):
             self._last_text_channel[guild_id] = text_channel_for_updates
         return self._voice_clients.get(guild_id)
 
-    async def find_genre_stream(self, genre: str) -> Optional[Dict[str, Any]]:
+    async def find_genre_stream(self, genre: str, guild_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        # 24/7 guilds autoplaying the same genre at the same time share one lookup
+        return await coalesce_inflight(self._inflight_genre_streams, genre.strip().lower(), lambda: self._search_genre_stream(genre, guild_id), RESOLVE_PRIORITY_AUTOPLAY)
+
+    async def _search_genre_stream(self, genre: str, guild_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
         queries = [f"{genre} live stream music", f"{genre} 24/7 radio", f"{genre} mix playlist"]
         for query_str in queries:
             try:
-                stream_info_result = await get_audio_stream_info(query_str, search=True, search_results_count=1)
+                stream_info_result = await get_audio_stream_info(query_str, search=True, search_results_count=1, priority=RESOLVE_PRIORITY_AUTOPLAY, guild_id=guild_id)
                 if stream_info_result and "error" not in stream_info_result and stream_info_result.get('webpage_url'):
                     is_live = stream_info_result.get('is_live', False)
                     duration = stream_info_result.get('duration')
                     if is_live or duration is None or (isinstance(duration, (int,float)) and duration > 3600 * 2):
-                        final_stream_info = await get_audio_stream_info(stream_info_result['webpage_url'], search=False)
+                        final_stream_info = await get_audio_stream_info(stream_info_result['webpage_url'], search=False, priority=RESOLVE_PRIORITY_AUTOPLAY, guild_id=guild_id)
                         if final_stream_info and "error" not in final_stream_info and final_stream_info.get('url'):
                             return {'webpage_url': final_stream_info.get('webpage_url'), 'title': final_stream_info.get('title', f"{genre} Autoplay"),
                                     'duration': final_stream_info.get('duration'), 'thumbnail': final_stream_info.get('thumbnail'),
                                     'uploader': final_stream_info.get('uploader', "Autoplay Service"), 'requester': self.user.mention,
-                                    'stream_url': final_stream_info.get('url'), 'is_live_stream': True }
+                                    'stream_url': final_stream_info.get('url'), 'stream_expires_at': final_stream_info.get('stream_expires_at'), 'is_live_stream': True }
             except Exception as e: print(f"Error in find_genre_stream for '{genre}' with query '{query_str}': {e}")
         return None
 
@@ -373,6 +609,7 @@ class MyClient(commands.Bot):
         print(f"\nDEBUG PLAY_QUEUE: Called for guild {guild_id}. Replay: {bool(song_to_replay)}, Seek: {seek_seconds}s") # Q1
         if guild_id in self._leave_tasks: self._leave_tasks[guild_id].cancel(); self._leave_tasks.pop(guild_id, None)
         if guild_id in self._up_next_tasks: self._up_next_tasks[guild_id].cancel(); self._up_next_tasks.pop(guild_id, None)
+        if guild_id in self._gapless_tasks: self._gapless_tasks[guild_id].cancel(); self._gapless_tasks.pop(guild_id, None)
         
         # Check if already processing, to prevent race conditions if _handle_after_play calls this too quickly
         if self._is_processing_next_song.get(guild_id, False) and not song_to_replay and not seek_seconds:
@@ -380,7 +617,8 @@ class MyClient(commands.Bot):
              return
         self._is_processing_next_song[guild_id] = True # Set flag early
 
-        song_info = None
+        song_info = None; resume_position = None
+        fresh_play = seek_seconds is None # Seeks, restarts and early-EOF resumes continue a play that was already counted
         guild_loop_mode = self.get_guild_loop_mode(guild_id)
         guild_is_24_7 = self.get_guild_24_7_mode(guild_id)
         guild_autoplay_genre = self.get_guild_autoplay_genre(guild_id)
@@ -390,19 +628,32 @@ class MyClient(commands.Bot):
 
         print(f"DEBUG PLAY_QUEUE: Guild {guild_id} - Loop: {guild_loop_mode}, 24/7: {guild_is_24_7}, AutoplayGenre: {guild_autoplay_genre}, SmartAutoplay: {guild_smart_autoplay}, Queue size before logic: {len(current_queue)}") # Q2
 
+        # Drop entries the pre-resolver already found unplayable instead of stalling on them
+        skipped_unplayable = []
+        while not song_to_replay and current_queue and current_queue[0].get('unplayable'): skipped_unplayable.append(self.queue_pop(guild_id))
+        if skipped_unplayable:
+            print(f"DEBUG PLAY_QUEUE: Skipped {len(skipped_unplayable)} unplayable entries for guild {guild_id}.")
+            if self._last_text_channel.get(guild_id):
+                skipped_lines = "\n".join(f"• {truncate_text(s.get('title', 'Unknown song'), 60)}: {truncate_text(str(s['unplayable']), 80)}" for s in skipped_unplayable[:5])
+                if len(skipped_unplayable) > 5: skipped_lines += f"\n...and {len(skipped_unplayable) - 5} more."
+                try: await self._last_text_channel[guild_id].send(embed=create_error_embed(f"Skipping unplayable songs:\n{skipped_lines}"))
+                except discord.HTTPException: pass
+
         if song_to_replay:
             song_info = song_to_replay
             print(f"DEBUG PLAY_QUEUE: Replaying song: {song_info.get('title')}") # Q3
         elif current_queue: # Check if self._queues[guild_id] exists and is not empty
-            song_info = current_queue.pop(0) # Pop from the actual queue
-            self._queues[guild_id] = current_queue # Update the queue in our client's state
+            song_info = self.queue_pop(guild_id) # Pop from the actual queue
+            resume_position = song_info.pop('resume_position_seconds', None) # Saved mid-track before a restart
+            if resume_position and not seek_seconds and not song_info.get('is_live_stream'):
+                seek_seconds = resume_position; print(f"DEBUG PLAY_QUEUE: Resuming '{song_info.get('title')}' at saved position {resume_position:.2f}s")
             print(f"DEBUG PLAY_QUEUE: Popped from queue: {song_info.get('title')}. New queue size: {len(self._queues[guild_id])}") # Q4
             if guild_loop_mode == "queue" and current_playing_song_before_pop:
                  # Add the song that *just finished* (or was current) to the end of the queue
                  song_that_was_playing_copy = current_playing_song_before_pop.copy()
                  song_that_was_playing_copy.pop('play_start_utc', None) # Clear runtime state
                  song_that_was_playing_copy.pop('accumulated_play_time_seconds', None)
-                 self._queues[guild_id].append(song_that_was_playing_copy)
+                 self.queue_add(guild_id, song_that_was_playing_copy)
                  print(f"DEBUG PLAY_QUEUE: Loop 'queue' active. Added '{song_that_was_playing_copy.get('title')}' back to queue. New size: {len(self._queues[guild_id])}") # Q5
         # ... (rest of your autoplay logic for 24/7 and smart autoplay - ensure these also correctly set song_info) ...
         elif guild_is_24_7 and guild_autoplay_genre:
@@ -411,7 +662,7 @@ class MyClient(commands.Bot):
             if self._last_text_channel.get(guild_id):
                 try: await self._last_text_channel[guild_id].send(f"🎶 Queue ended. Autoplaying genre: **{guild_autoplay_genre}** (24/7 Mode)...")
                 except discord.HTTPException: pass
-            genre_song_info = await self.find_genre_stream(guild_autoplay_genre)
+            genre_song_info = await self.find_genre_stream(guild_autoplay_genre, guild_id=guild_id)
             if genre_song_info: song_info = genre_song_info
             else:
                 if self._last_text_channel.get(guild_id):
@@ -428,13 +679,14 @@ class MyClient(commands.Bot):
             if self._last_text_channel.get(guild_id):
                 try: await self._last_text_channel[guild_id].send(f"🤖 Queue ended. Autoplaying related to: **{last_song.get('title')}**...")
                 except discord.HTTPException: pass
-            autoplay_info_result = await get_audio_stream_info(autoplay_query, search=True, search_results_count=1) # Ensure this returns a single item dict
+            autoplay_info_result = await get_audio_stream_info(autoplay_query, search=True, search_results_count=1, priority=RESOLVE_PRIORITY_AUTOPLAY, guild_id=guild_id) # Ensure this returns a single item dict
             if autoplay_info_result and "error" not in autoplay_info_result and autoplay_info_result.get('webpage_url'):
                 # If get_audio_stream_info returns the entry directly for search=True, count=1
                 song_info = {'webpage_url': autoplay_info_result.get('webpage_url'), 'title': autoplay_info_result.get('title', 'Autoplay'),
                              'duration': autoplay_info_result.get('duration'), 'thumbnail': autoplay_info_result.get('thumbnail'),
                              'uploader': autoplay_info_result.get('uploader'), 'requester': self.user.mention, # Bot is requester for autoplay
-                             'stream_url': autoplay_info_result.get('url')} # Crucial: make sure 'url' is present
+                             'stream_url': autoplay_info_result.get('url'), # Crucial: make sure 'url' is present
+                             'stream_expires_at': autoplay_info_result.get('stream_expires_at'), 'stream_acodec': autoplay_info_result.get('acodec')}
             else:
                 if self._last_text_channel.get(guild_id):
                     try: await self._last_text_channel[guild_id].send(embed=create_error_embed("Autoplay failed to find a related song."))
@@ -465,7 +717,7 @@ class MyClient(commands.Bot):
             self._is_processing_next_song[guild_id] = False # Reset flag
             # Optionally try to put song_info back if it was popped
             if song_info and not song_to_replay and self._queues.get(guild_id) is not None : # if popped from queue
-                 self._queues.setdefault(guild_id, []).insert(0, song_info)
+                 self.queue_add(guild_id, song_info, 0)
             return
         
         # If VC is already playing something and this isn't a seek/replay, something is wrong (e.g. rapid fire after_play)
@@ -480,22 +732,21 @@ class MyClient(commands.Bot):
         self._current_song[guild_id] = song_info.copy() # Make a copy to avoid modifying original in queue
         self._current_song[guild_id]['play_start_utc'] = datetime.datetime.now(timezone.utc)
         self._current_song[guild_id]['accumulated_play_time_seconds'] = seek_seconds if seek_seconds else 0.0
+        self._current_song[guild_id]['segment_start_seconds'] = seek_seconds if seek_seconds else 0.0 # Track offset the decoder starts at
         print(f"DEBUG PLAY_QUEUE: Set current_song for guild {guild_id}: {self._current_song[guild_id].get('title')} at {self._current_song[guild_id]['play_start_utc']}") # Q10
         await self.save_guild_settings_to_file(guild_id) # Save current song state
 
-        # Delete previous interactive NP message
-        if self._interactive_np_message_ids.get(guild_id) and self._last_text_channel.get(guild_id):
-            try:
-                old_np_msg = await self._last_text_channel[guild_id].fetch_message(self._interactive_np_message_ids[guild_id])
-                await old_np_msg.delete()
-            except (discord.NotFound, discord.HTTPException): pass
-            self._interactive_np_message_ids.pop(guild_id, None)
+        await self._delete_interactive_np_message(guild_id) # Delete previous interactive NP message
 
         try:
             stream_data_url = song_info.get('stream_url')
-            # If stream_url is missing (e.g. from saved queue or older addition), re-fetch it.
-            if not stream_data_url:
-                print(f"DEBUG PLAY_QUEUE: stream_url missing for '{song_info.get('title')}'. Re-fetching from webpage_url: {song_info.get('webpage_url')}") # Q11
+            cached_audio = audio_cache.lookup(song_info) # Locally cached copy: no resolve, no network, instant seeks
+            if cached_audio:
+                stream_data_url = cached_audio['path']; self._current_song[guild_id]['stream_acodec'] = cached_audio.get('acodec')
+                print(f"DEBUG PLAY_QUEUE: Playing '{song_info.get('title')}' from the audio cache.")
+            # If stream_url is missing (e.g. from saved queue or older addition) or expired/about to expire, re-fetch it.
+            elif not stream_data_url or is_stream_url_stale(song_info):
+                print(f"DEBUG PLAY_QUEUE: stream_url {'stale' if stream_data_url else 'missing'} for '{song_info.get('title')}'. Re-fetching from webpage_url: {song_info.get('webpage_url')}") # Q11
                 # Ensure webpage_url exists before trying to fetch
                 if not song_info.get('webpage_url'):
                     err_msg_no_url = "Song has no webpage_url to fetch stream data from."
@@ -507,7 +758,7 @@ class MyClient(commands.Bot):
                     return
 
                 # Re-fetch full info to get a fresh stream URL
-                fresh_stream_info = await get_audio_stream_info(song_info['webpage_url'], search=False)
+                fresh_stream_info = await get_audio_stream_info(song_info['webpage_url'], search=False, guild_id=guild_id) # Interactive: playback is waiting on it
                 if not fresh_stream_info or "error" in fresh_stream_info or not fresh_stream_info.get('url'):
                     err_msg = fresh_stream_info['error'] if fresh_stream_info and 'error' in fresh_stream_info else "Could not get audio stream data after re-fetch."
                     print(f"DEBUG PLAY_QUEUE: Re-fetch failed for '{song_info.get('title')}'. Error: {err_msg}") # Q12
@@ -518,24 +769,43 @@ class MyClient(commands.Bot):
                     return
                 stream_data_url = fresh_stream_info['url']
                 self._current_song[guild_id]['stream_url'] = stream_data_url # Update current song with fresh URL
+                self._current_song[guild_id]['stream_expires_at'] = fresh_stream_info.get('stream_expires_at')
+                self._current_song[guild_id]['stream_acodec'] = fresh_stream_info.get('acodec')
                 # Also update other relevant fields from fresh_stream_info if they changed
                 for key in ['title', 'duration', 'thumbnail', 'uploader']:
                     if fresh_stream_info.get(key) and self._current_song[guild_id].get(key) != fresh_stream_info.get(key):
                         self._current_song[guild_id][key] = fresh_stream_info.get(key)
+                self._current_song[guild_id].pop('needs_metadata', None)
                 print(f"DEBUG PLAY_QUEUE: Successfully re-fetched stream_url: {stream_data_url[:60]}...")
 
             # ... (rest of FFmpeg options setup, source creation, vc.play call) ...
-            ffmpeg_before_options_list = DEFAULT_FFMPEG_BEFORE_OPTIONS.split()
-            if seek_seconds and seek_seconds > 0: ffmpeg_before_options_list = ['-ss', str(seek_seconds)] + ffmpeg_before_options_list
-            final_ffmpeg_before_options = " ".join(ffmpeg_before_options_list)
-            ffmpeg_main_options_list = [DEFAULT_FFMPEG_OPTIONS_AUDIO_ONLY]
-            current_applied_filters = self.get_guild_ffmpeg_filters(guild_id)
-            if current_applied_filters: ffmpeg_main_options_list.append(f'-af "{current_applied_filters}"')
-            final_ffmpeg_main_options = " ".join(ffmpeg_main_options_list)
-            ffmpeg_player_options_final = {'options': final_ffmpeg_main_options, 'before_options': final_ffmpeg_before_options}
+            ffmpeg_filters, dsp_spec = split_filters_for_dsp(self.get_guild_ffmpeg_filters(guild_id))
+            playback_speed = playback_speed_for_filters(ffmpeg_filters)
+            ffmpeg_player_options_final = self._ffmpeg_options_for(self._current_song[guild_id], ffmpeg_filters, seek_seconds, stream_data_url)
+            use_passthrough = self.can_use_opus_passthrough(guild_id, self._current_song[guild_id])
+            # A skip lands here with the queue head already decoding in the background; adopt it instead of spawning again
+            prepared_source = None if use_passthrough or song_to_replay or seek_seconds else self._take_prepared_next(guild_id, song_info, ffmpeg_filters)
+            self._discard_prepared_next(guild_id)
             
-            source = discord.FFmpegPCMAudio(stream_data_url, **ffmpeg_player_options_final)
-            volume_source = discord.PCMVolumeTransformer(source, volume=self.get_guild_volume(guild_id))
+            if use_passthrough:
+                # Fast path: remux the source Opus packets (-c:a copy), no decode / volume scaling / re-encode in Python
+                print(f"DEBUG PLAY_QUEUE: Using Opus passthrough for '{self._current_song[guild_id].get('title')}'")
+                volume_source = ClockedTrackSource(TrackedFFmpegOpusAudio(stream_data_url, codec='opus', **ffmpeg_player_options_final), self.get_playback_clock(guild_id), seek_seconds or 0.0, playback_speed)
+                volume_source.claim()
+                self._gapless_sources.pop(guild_id, None); self._current_decoders[guild_id] = find_tracked_decoder(volume_source)
+            else:
+                if prepared_source: print(f"DEBUG PLAY_QUEUE: Using pre-spawned decoder for '{self._current_song[guild_id].get('title')}'")
+                source = prepared_source or ClockedTrackSource(self.open_pcm_decoder(guild_id, self._current_song[guild_id], stream_data_url, ffmpeg_player_options_final, shareable_live=True),
+                                                               self.get_playback_clock(guild_id), seek_seconds or 0.0, playback_speed)
+                source.claim() # Position reads switch to this track now, not at its first frame
+                self._current_decoders[guild_id] = find_tracked_decoder(source)
+                song_duration = self._current_song[guild_id].get('duration')
+                if GAPLESS_ENABLED and not self._current_song[guild_id].get('is_live_stream'):
+                    remaining_seconds = song_duration - (seek_seconds or 0) if isinstance(song_duration, (int, float)) else None
+                    source = self._gapless_sources[guild_id] = GaplessTrackSource(source, ffmpeg_filters, self._gapless_switch_callback(guild_id), remaining_seconds)
+                else: self._gapless_sources.pop(guild_id, None)
+                if np is not None and DSP_ENABLED: source = EffectsDSPSource(source, ffmpeg_filters, dsp_spec) # Lets DSP-capable effects change live
+                volume_source = make_volume_source(source, self.get_guild_volume(guild_id))
             
             if vc.is_playing() or vc.is_paused() : vc.stop(); await asyncio.sleep(0.1) # Ensure stop completes
             if not vc.is_connected():
@@ -543,46 +813,14 @@ class MyClient(commands.Bot):
                 self._is_processing_next_song[guild_id] = False
                 # Optionally put song back
                 if song_info and not song_to_replay and self._queues.get(guild_id) is not None:
-                     self._queues.setdefault(guild_id, []).insert(0, song_info)
+                     self.queue_add(guild_id, song_info, 0)
                 return
 
             after_callback = functools.partial(self._handle_after_play, guild_id)
             print(f"DEBUG PLAY_QUEUE: Calling vc.play() for '{self._current_song[guild_id].get('title')}' in guild {guild_id}") # Q13
             vc.play(volume_source, after=lambda e: self.loop.create_task(after_callback(e)))
             # self._is_processing_next_song[guild_id] = False # Reset flag *after* successfully starting play OR if play fails to start
-
-            # Send Now Playing message (only if not seeking)
-            if not seek_seconds:
-                # ... (your existing Now Playing embed and message sending logic) ...
-                # Ensure this uses self._current_song[guild_id] for details
-                cs = self._current_song[guild_id] # Use the definitive current song
-                embed = discord.Embed(title="🎶 Now Playing", description=f"[{cs['title']}]({cs['webpage_url']})", color=discord.Color.blurple())
-                if cs.get('thumbnail'): embed.set_thumbnail(url=cs['thumbnail'])
-                embed.add_field(name="Duration", value=format_duration(cs.get('duration', 0)))
-                embed.add_field(name="Requested by", value=cs['requester'])
-                embed.add_field(name="Volume", value=f"{int(self.get_guild_volume(guild_id) * 100)}%")
-                embed.add_field(name="Loop", value=self.get_guild_loop_mode(guild_id).capitalize())
-                embed.add_field(name="Effects", value=self.get_active_effects_display(guild_id), inline=False)
-                
-                if self._last_text_channel.get(guild_id):
-                    target_channel_for_np = self._last_text_channel.get(guild_id)
-                    if target_channel_for_np:
-                        try:
-                            np_view = NowPlayingView(guild_id=guild_id, song_requester_mention=cs['requester'])
-                            np_msg = await target_channel_for_np.send(embed=embed, view=np_view)
-                            self._interactive_np_message_ids[guild_id] = np_msg.id
-                            np_view.message = np_msg 
-                            print(f"DEBUG PLAY_QUEUE: Sent NP message with view for '{cs.get('title')}', ID: {np_msg.id}") # Q14
-                        except Exception as e_np_send: 
-                            print(f"ERROR PLAY_QUEUE: Failed to send NP message with view for guild {guild_id}: {e_np_send}")
-                            try: await target_channel_for_np.send(embed=embed) # Fallback without view
-                            except Exception as e_fallback: print(f"ERROR PLAY_QUEUE: Fallback NP send also failed: {e_fallback}")
-            
-            song_duration = self._current_song[guild_id].get('duration') # Use current song
-            if isinstance(song_duration, (int, float)) and song_duration > UP_NEXT_NOTIFICATION_SECONDS and not self._current_song[guild_id].get('is_live_stream'):
-                if guild_id in self._up_next_tasks: self._up_next_tasks[guild_id].cancel()
-                self._up_next_tasks[guild_id] = self.loop.create_task(self.up_next_scheduler(guild_id, song_duration))
-            
+            await self._on_track_started(guild_id, stream_data_url, announce=not seek_seconds or bool(resume_position), new_play=fresh_play and not resume_position)
             # Successfully started playing or scheduled.
             self._is_processing_next_song[guild_id] = False # Reset flag HERE after play has started
 
@@ -598,17 +836,166 @@ class MyClient(commands.Bot):
             self._is_processing_next_song[guild_id] = False # Reset flag before recursive call
             await self._play_guild_queue(guild_id) # Try to play next song in queue on error
 
+    async def _on_track_started(self, guild_id: int, stream_data_url: str, announce: bool = True, new_play: bool = True):
+        # Bookkeeping once audio for self._current_song[guild_id] is flowing, whether via vc.play() or a gapless switch
+        # Send Now Playing message (only if not seeking)
+        if announce:
+            # ... (your existing Now Playing embed and message sending logic) ...
+            # Ensure this uses self._current_song[guild_id] for details
+            cs = self._current_song[guild_id] # Use the definitive current song
+            embed = discord.Embed(title="🎶 Now Playing", description=f"[{cs['title']}]({cs['webpage_url']})", color=discord.Color.blurple())
+            if cs.get('thumbnail'): embed.set_thumbnail(url=cs['thumbnail'])
+            embed.add_field(name="Duration", value=format_duration(cs.get('duration', 0)))
+            embed.add_field(name="Requested by", value=cs['requester'])
+            embed.add_field(name="Volume", value=f"{int(self.get_guild_volume(guild_id) * 100)}%")
+            embed.add_field(name="Loop", value=self.get_guild_loop_mode(guild_id).capitalize())
+            embed.add_field(name="Effects", value=self.get_active_effects_display(guild_id), inline=False)
+            
+            if self._last_text_channel.get(guild_id):
+                target_channel_for_np = self._last_text_channel.get(guild_id)
+                if target_channel_for_np:
+                    try:
+                        np_view = NowPlayingView(guild_id=guild_id, song_requester_mention=cs['requester'])
+                        np_msg = await target_channel_for_np.send(embed=embed, view=np_view)
+                        self._interactive_np_message_ids[guild_id] = np_msg.id
+                        np_view.message = np_msg 
+                        print(f"DEBUG PLAY_QUEUE: Sent NP message with view for '{cs.get('title')}', ID: {np_msg.id}") # Q14
+                    except Exception as e_np_send: 
+                        print(f"ERROR PLAY_QUEUE: Failed to send NP message with view for guild {guild_id}: {e_np_send}")
+                        try: await target_channel_for_np.send(embed=embed) # Fallback without view
+                        except Exception as e_fallback: print(f"ERROR PLAY_QUEUE: Fallback NP send also failed: {e_fallback}")
+        
+        song_duration = self._current_song[guild_id].get('duration') # Use current song
+        if isinstance(song_duration, (int, float)) and song_duration > UP_NEXT_NOTIFICATION_SECONDS and not self._current_song[guild_id].get('is_live_stream'):
+            if guild_id in self._up_next_tasks: self._up_next_tasks[guild_id].cancel()
+            self._up_next_tasks[guild_id] = self.loop.create_task(self.up_next_scheduler(guild_id, song_duration))
+        
+        self.notify_queue_changed(guild_id) # Pre-resolve the next few queue entries while this one plays
+        if LOUDNESS_NORMALIZATION_FILTER in self.get_guild_ffmpeg_filters(guild_id).split(",") and loudness_store.needs_analysis(self._current_song[guild_id]):
+            # Measure once in the background; later plays of this track use a static gain instead of live loudnorm
+            self.loop.create_task(loudness_store.analyze(self._current_song[guild_id]['webpage_url'], stream_data_url))
+        if new_play and audio_cache.record_play(self._current_song[guild_id]) and is_remote_input(stream_data_url):
+            self.loop.create_task(audio_cache.download(self._current_song[guild_id], stream_data_url)) # Played often enough; fetch a local copy in the background
+        if GAPLESS_ENABLED and guild_id in self._gapless_sources and isinstance(song_duration, (int, float)) and song_duration > GAPLESS_PREPARE_SECONDS:
+            if guild_id in self._gapless_tasks: self._gapless_tasks[guild_id].cancel()
+            self._gapless_tasks[guild_id] = self.loop.create_task(self._gapless_prepare_scheduler(guild_id, song_duration))
+
+    def _ffmpeg_options_for(self, song: Dict[str, Any], ffmpeg_filters: str, seek_seconds: Optional[float] = None, input_url: Optional[str] = None) -> Dict[str, str]:
+        ffmpeg_before_options_list = ffmpeg_before_options_for(input_url).split()
+        if seek_seconds and seek_seconds > 0: ffmpeg_before_options_list = ['-ss', str(seek_seconds)] + ffmpeg_before_options_list
+        ffmpeg_main_options_list = [DEFAULT_FFMPEG_OPTIONS_AUDIO_ONLY]
+        applied_filters = loudness_store.apply_to_filters(ffmpeg_filters, song.get('webpage_url'))
+        if applied_filters: ffmpeg_main_options_list.append(f'-af "{applied_filters}"')
+        return {'options': " ".join(ffmpeg_main_options_list), 'before_options': " ".join(ffmpeg_before_options_list)}
+
+    async def _delete_interactive_np_message(self, guild_id: int):
+        if self._interactive_np_message_ids.get(guild_id) and self._last_text_channel.get(guild_id):
+            try:
+                old_np_msg = await self._last_text_channel[guild_id].fetch_message(self._interactive_np_message_ids[guild_id])
+                await old_np_msg.delete()
+            except (discord.NotFound, discord.HTTPException): pass
+            self._interactive_np_message_ids.pop(guild_id, None)
+
+    async def _gapless_prepare_scheduler(self, guild_id: int, current_song_duration: float):
+        current_song_details = self._current_song.get(guild_id)
+        if not current_song_details: return
+        try:
+            await asyncio.sleep(self.seconds_until_position(guild_id, current_song_duration - GAPLESS_PREPARE_SECONDS))
+            await self._prepare_next_track(guild_id, current_song_details)
+        except asyncio.CancelledError: pass
+        except Exception as e: print(f"Error preparing next track for guild {guild_id}: {e}"); traceback.print_exc()
+        finally:
+            if self._gapless_tasks.get(guild_id) is asyncio.current_task(): self._gapless_tasks.pop(guild_id, None)
+
+    async def _prepare_next_track(self, guild_id: int, expected_current: Dict[str, Any]):
+        # Opens and pre-buffers the queue head's decoder, then hands it to the running GaplessTrackSource
+        gapless = self._gapless_sources.get(guild_id)
+        if not gapless or guild_id in self._prepared_next or self._current_song.get(guild_id) is not expected_current: return
+        if self.get_guild_loop_mode(guild_id) == "song" or not self._queues.get(guild_id): return
+        song = self._queues[guild_id][0]
+        if song.get('unplayable') or song.get('is_live_stream'): return
+        cached_audio = audio_cache.lookup(song)
+        if not cached_audio and is_stream_url_stale(song): await self._preresolve_entry(guild_id, song)
+        if song.get('unplayable') or not (cached_audio or song.get('stream_url')): return
+        ffmpeg_filters, _ = split_filters_for_dsp(self.get_guild_ffmpeg_filters(guild_id))
+        if ffmpeg_filters != gapless.ffmpeg_filters: return # Effects changed; the restart path owns the next transition
+        input_url = cached_audio['path'] if cached_audio else song['stream_url']
+        ffmpeg_options = self._ffmpeg_options_for(song, ffmpeg_filters, input_url=input_url)
+        source = await asyncio.to_thread(self._open_prebuffered_decoder, guild_id, song, input_url, ffmpeg_options)
+        queue_now = self._queues.get(guild_id) or [None]
+        if not source.ready or self._gapless_sources.get(guild_id) is not gapless or self._current_song.get(guild_id) is not expected_current or \
+           queue_now[0] is not song or guild_id in self._prepared_next:
+            print(f"DEBUG GAPLESS: Dropping pre-spawned decoder for '{song.get('title')}' in guild {guild_id} (state changed or no audio).")
+            await asyncio.to_thread(source.cleanup); return
+        prepared = {'song': song, 'source': source, 'gapless': gapless, 'ffmpeg_filters': ffmpeg_filters, 'input_url': input_url}
+        self._prepared_next[guild_id] = prepared
+        duration = song.get('duration')
+        gapless.set_next(source, prepared, duration if isinstance(duration, (int, float)) else None)
+        print(f"DEBUG GAPLESS: Pre-spawned decoder ready for '{song.get('title')}' in guild {guild_id}")
+
+    def open_pcm_decoder(self, guild_id: int, song: Dict[str, Any], stream_url: str, ffmpeg_options: Dict[str, str], shareable_live: bool = False) -> discord.AudioSource:
+        stats = self._playback_buffer_stats.setdefault(guild_id, {"underruns": 0, "overruns": 0, "buffered_ms": 0.0})
+        if shareable_live and LIVE_STREAM_SHARING and song.get('is_live_stream'):
+            # 24/7 guilds on the same live stream share one decode; effects above FFmpeg and volume stay per guild
+            hub_key = (normalize_track_url(song.get('webpage_url') or stream_url), ffmpeg_options['options'])
+            return live_stream_hub.subscribe(hub_key, lambda: TrackedFFmpegPCMAudio(stream_url, **ffmpeg_options), stats)
+        decoder = TrackedFFmpegPCMAudio(stream_url, **ffmpeg_options)
+        if JITTER_BUFFER_SECONDS <= 0: return decoder
+        return JitterBufferSource(decoder, stats, drop_when_full=bool(song.get('is_live_stream'))) # Live audio can't wait on a full ring; keep it current
+
+    def _open_prebuffered_decoder(self, guild_id: int, song: Dict[str, Any], input_url: str, ffmpeg_options: Dict[str, str]) -> discord.AudioSource:
+        # Blocking; run off the event loop. Returns once the decoder has audio ready (check .ready)
+        decoder = self.open_pcm_decoder(guild_id, song, input_url, ffmpeg_options)
+        if isinstance(decoder, JitterBufferSource): decoder.wait_ready(GAPLESS_PREBUFFER_FRAMES, JITTER_STARTUP_TIMEOUT)
+        else: decoder = PrebufferedSource(decoder, GAPLESS_PREBUFFER_FRAMES)
+        # Claims the guild clock itself on its first delivered frame, i.e. exactly at the gapless switch
+        return ClockedTrackSource(decoder, self.get_playback_clock(guild_id), 0.0, playback_speed_for_filters(split_filters_for_dsp(self.get_guild_ffmpeg_filters(guild_id))[0]))
+
+    def _take_prepared_next(self, guild_id: int, song: Dict[str, Any], ffmpeg_filters: str) -> Optional[discord.AudioSource]:
+        # Detaches the prepared decoder if it is for exactly this queue entry and filter chain
+        prepared = self._prepared_next.get(guild_id)
+        if not prepared or prepared['song'] is not song or prepared['ffmpeg_filters'] != ffmpeg_filters: return None
+        self._prepared_next.pop(guild_id, None)
+        return prepared['gapless'].clear_next(prepared)
+
+    def _discard_prepared_next(self, guild_id: int):
+        prepared = self._prepared_next.pop(guild_id, None)
+        if not prepared: return
+        source = prepared['gapless'].clear_next(prepared) # None if playback already switched onto it
+        if source:
+            print(f"DEBUG GAPLESS: Discarding pre-spawned decoder for '{prepared['song'].get('title')}' in guild {guild_id}")
+            self.loop.run_in_executor(None, source.cleanup)
+
+    def _gapless_switch_callback(self, guild_id: int) -> Callable[[Any], None]:
+        # GaplessTrackSource calls this on the audio thread the moment it moves onto the prepared decoder
+        return lambda token: self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self._handle_gapless_transition(guild_id, token)))
+
+    async def _handle_gapless_transition(self, guild_id: int, prepared: Dict[str, Any]):
+        # Mirrors the queue bookkeeping of _play_guild_queue for a track that is already audible
+        if self._prepared_next.get(guild_id) is prepared: self._prepared_next.pop(guild_id, None)
+        song = prepared['song']; queue = self._queues.setdefault(guild_id, [])
+        previous_song = self._current_song.get(guild_id)
+        for index, entry in enumerate(queue):
+            if entry is song: self.queue_pop(guild_id, index); break
+        if self.get_guild_loop_mode(guild_id) == "queue" and previous_song:
+            previous_copy = previous_song.copy(); previous_copy.pop('play_start_utc', None); previous_copy.pop('accumulated_play_time_seconds', None)
+            self.queue_add(guild_id, previous_copy)
+        print(f"DEBUG GAPLESS: Switched to '{song.get('title')}' in guild {guild_id}. Queue size: {len(queue)}")
+        self._current_song[guild_id] = song.copy()
+        self._current_song[guild_id]['play_start_utc'] = datetime.datetime.now(timezone.utc)
+        self._current_song[guild_id]['accumulated_play_time_seconds'] = 0.0
+        self._current_song[guild_id]['segment_start_seconds'] = 0.0
+        self._current_decoders[guild_id] = find_tracked_decoder(prepared['source'])
+        await self.save_guild_settings_to_file(guild_id)
+        await self._delete_interactive_np_message(guild_id)
+        await self._on_track_started(guild_id, prepared['input_url'])
+
     async def up_next_scheduler(self, guild_id: int, current_song_duration: float):
         # ... (ensure calls to self.save_guild_settings_to_file are correct if any) ...
         current_song_details = self._current_song.get(guild_id)
         if not current_song_details or current_song_details.get('is_live_stream'): return
 
-        accumulated_time = current_song_details.get('accumulated_play_time_seconds', 0.0)
-        current_segment_elapsed = 0.0
-        if current_song_details.get('play_start_utc'): # This key is fine for runtime
-             current_segment_elapsed = (datetime.datetime.now(timezone.utc) - current_song_details['play_start_utc']).total_seconds()
-        total_elapsed_for_song = accumulated_time + current_segment_elapsed
-        time_until_notification = max(0, current_song_duration - total_elapsed_for_song - UP_NEXT_NOTIFICATION_SECONDS)
+        time_until_notification = self.seconds_until_position(guild_id, current_song_duration - UP_NEXT_NOTIFICATION_SECONDS)
         
         try: await asyncio.sleep(time_until_notification)
         except asyncio.CancelledError: return
@@ -628,6 +1015,59 @@ class MyClient(commands.Bot):
             except discord.HTTPException as e: print(f"Error sending Up Next notification: {e}")
         self._up_next_tasks.pop(guild_id, None)
 
+    def notify_queue_changed(self, guild_id: int):
+        # Central hook for anything that edits the upcoming queue; wakes (or starts) the guild's pre-resolver.
+        prepared = self._prepared_next.get(guild_id)
+        if prepared and (not self._queues.get(guild_id) or self._queues[guild_id][0] is not prepared['song'] or prepared['song'].get('unplayable')):
+            self._discard_prepared_next(guild_id) # The pre-spawned decoder no longer matches the queue head
+        event = self._preresolve_events.setdefault(guild_id, asyncio.Event()); event.set()
+        existing_task = self._preresolve_tasks.get(guild_id)
+        if (not existing_task or existing_task.done()) and guild_id in self._voice_clients:
+            self._preresolve_tasks[guild_id] = self.loop.create_task(self._preresolve_worker(guild_id))
+
+    async def _preresolve_entry(self, guild_id: int, song: Dict[str, Any]):
+        # Changes go through queue_update so they are journaled like any other queue mutation
+        if not song.get('webpage_url'):
+            self.queue_update(guild_id, song, {'unplayable': "Song has no webpage_url to fetch stream data from."}); return
+        fresh_info = await get_audio_stream_info(song['webpage_url'], search=False, min_stream_validity=STREAM_URL_PREFETCH_WINDOW,
+                                                 priority=RESOLVE_PRIORITY_PREFETCH, guild_id=guild_id)
+        if fresh_info and "error" not in fresh_info and fresh_info.get('url'):
+            fields = {'stream_url': fresh_info['url'], 'stream_expires_at': fresh_info.get('stream_expires_at'), 'stream_acodec': fresh_info.get('acodec')}
+            overwrite_metadata = song.get('needs_metadata', False) # Lazy entry whose title is still a placeholder
+            for key in ['title', 'duration', 'thumbnail', 'uploader']:
+                if fresh_info.get(key) and (overwrite_metadata or not song.get(key)): fields[key] = fresh_info[key]
+            self.queue_update(guild_id, song, fields, removed=('needs_metadata', 'preresolve_failures', 'preresolve_retry_at'))
+            return
+        err = fresh_info.get('error') if fresh_info else "Could not get audio stream data."
+        fields = {'preresolve_failures': song.get('preresolve_failures', 0) + 1}
+        if fresh_info and fresh_info.get('hard_failure'): fields['unplayable'] = err # Permanent (removed, private, ...); skip it at play time
+        else: # Transient: back off and leave the final call to the play-time resolve
+            fields['preresolve_retry_at'] = time.time() + min(PRERESOLVE_RETRY_MAX_BACKOFF, PRERESOLVE_RETRY_BACKOFF * 2 ** (fields['preresolve_failures'] - 1))
+        self.queue_update(guild_id, song, fields)
+        print(f"DEBUG PRERESOLVE: Failed to resolve '{song.get('title')}' (attempt {song['preresolve_failures']}): {err}")
+
+    async def _preresolve_worker(self, guild_id: int):
+        # Keeps the next PRERESOLVE_LOOKAHEAD queue entries resolved with unexpired stream URLs so track changes never block on yt-dlp.
+        event = self._preresolve_events.setdefault(guild_id, asyncio.Event())
+        try:
+            while guild_id in self._voice_clients and not self.is_closed():
+                event.clear(); wake_in = STREAM_URL_REFRESH_INTERVAL
+                for song in list(self._queues.get(guild_id, []))[:PRERESOLVE_LOOKAHEAD]:
+                    if event.is_set(): break # Queue changed underneath us; rescan from the new head
+                    if song.get('unplayable') or song.get('is_live_stream') or not is_stream_url_stale(song, STREAM_URL_PREFETCH_WINDOW) or audio_cache.contains(song): continue
+                    retry_in = song.get('preresolve_retry_at', 0) - time.time()
+                    if retry_in > 0: wake_in = min(wake_in, retry_in); continue # Backing off after a soft failure
+                    print(f"DEBUG PRERESOLVE: Resolving '{song.get('title')}' for guild {guild_id}")
+                    await self._preresolve_entry(guild_id, song)
+                    if song.get('preresolve_retry_at'): wake_in = min(wake_in, max(0.0, song['preresolve_retry_at'] - time.time()))
+                if event.is_set(): continue
+                try: await asyncio.wait_for(event.wait(), timeout=wake_in) # Periodic wake-up re-checks expiry and due retries
+                except asyncio.TimeoutError: pass
+        except asyncio.CancelledError: pass
+        except Exception as e: print(f"Error in pre-resolver for guild {guild_id}: {e}"); traceback.print_exc()
+        finally:
+            if self._preresolve_tasks.get(guild_id) is asyncio.current_task(): self._preresolve_tasks.pop(guild_id, None)
+
     async def _handle_after_play(self, guild_id: int, error=None): # 'self' is the first parameter
         # NO 'client_instance = self' line needed here. Just use 'self'.
         print(f"\nDEBUG AFTER_PLAY: Called for guild {guild_id}. Error: {error}") # A1
@@ -660,6 +1100,8 @@ class MyClient(commands.Bot):
                 print(f"DEBUG AFTER_PLAY: Forced skip detected for guild {guild_id}.")
                 delattr(self, f"_skip_forced_{guild_id}") 
         
+        if song_that_just_finished and not forced_skip and await self._resume_after_early_eof(guild_id, song_that_just_finished): return
+        
         if song_that_just_finished and song_that_just_finished.get('is_live_stream') and \
            is_24_7_on and autoplay_genre and loop_mode == "off" and not forced_skip:
             print(f"DEBUG AFTER_PLAY: Live stream ended/errored in 24/7. Finding another for genre '{autoplay_genre}'.")
@@ -677,6 +1119,31 @@ class MyClient(commands.Bot):
                 print(f"DEBUG AFTER_PLAY: Loop is '{loop_mode}' or skip forced. Playing next.")
             await self._play_guild_queue(guild_id) # Use self.
 
+    async def _resume_after_early_eof(self, guild_id: int, song: Dict[str, Any]) -> bool:
+        # FFmpeg ending well before the known duration means the stream dropped (expired URL, connection reset), not that the track ended.
+        # Re-resolve and continue from where the decoder stopped instead of losing the rest of the track.
+        decoder = self._current_decoders.get(guild_id) # Not popped: a late callback must not unregister the next track's decoder
+        duration = song.get('duration')
+        if not decoder or not getattr(decoder, 'reached_eof', False) or song.get('is_live_stream') or not isinstance(duration, (int, float)): return False
+        segment_seconds = decoder.frames_read * 0.02 * playback_speed_for_filters(split_filters_for_dsp(self.get_guild_ffmpeg_filters(guild_id))[0]) # Decoder output is post-tempo
+        resume_at = song.get('segment_start_seconds', 0.0) + segment_seconds
+        if resume_at >= duration - STREAM_RECOVERY_END_TOLERANCE: return False
+        attempts = song.get('recovery_attempts', 0) if segment_seconds < STREAM_RECOVERY_RESET_SECONDS else 0 # Long healthy segments don't use up retries
+        if attempts >= STREAM_RECOVERY_MAX_ATTEMPTS:
+            print(f"DEBUG RECOVERY: Giving up on '{song.get('title')}' in guild {guild_id} after {attempts} resume attempts.")
+            if self._last_text_channel.get(guild_id):
+                try: await self._last_text_channel[guild_id].send(embed=create_error_embed(f"Stream for '{truncate_text(song.get('title', 'Unknown song'), 80)}' kept dropping at {format_duration(resume_at)}. Moving on."))
+                except discord.HTTPException: pass
+            return False
+        print(f"DEBUG RECOVERY: Early EOF for '{song.get('title')}' in guild {guild_id} at {resume_at:.1f}s of {duration}s. Resuming (attempt {attempts + 1}/{STREAM_RECOVERY_MAX_ATTEMPTS}).")
+        if song.get('webpage_url'): await track_cache.invalidate_stream(song['webpage_url']) # The cached stream URL may be the one that just died
+        resume_song = song.copy(); resume_song['recovery_attempts'] = attempts + 1
+        resume_song.pop('stream_url', None); resume_song.pop('stream_expires_at', None) # Forces a fresh resolve in _play_guild_queue
+        await asyncio.sleep(STREAM_RECOVERY_BACKOFF * attempts)
+        if self._current_song.get(guild_id) is not song or guild_id not in self._voice_clients: return True # Something else took over meanwhile
+        await self._play_guild_queue(guild_id, song_to_replay=resume_song, seek_seconds=resume_at)
+        return True
+
     async def schedule_leave(self, guild_id: int):
         # ... (ensure calls to self.save_guild_settings_to_file are correct if any) ...
         if self.get_guild_24_7_mode(guild_id): return
@@ -698,7 +1165,8 @@ class MyClient(commands.Bot):
         self._leave_tasks[guild_id] = asyncio.create_task(_leave_task_coro())
 
     async def disconnect_voice(self, guild_id: int):
-        await self.save_guild_settings_to_file(guild_id) # Corrected call
+        await self.save_guild_settings_to_file(guild_id); await self.flush_guild_settings(guild_id) # Capture the resume position while the clock still exists
+        if guild_id in self._loaded_guilds: self._touch_guild(guild_id) # Idle time counts from leaving voice, not from the last command
         if guild_id in self._voice_clients:
             vc = self._voice_clients.pop(guild_id)
             if vc.is_connected(): vc.stop(); await vc.disconnect(force=False)
@@ -708,6 +1176,10 @@ class MyClient(commands.Bot):
         
         if guild_id in self._leave_tasks: self._leave_tasks[guild_id].cancel(); self._leave_tasks.pop(guild_id, None)
         if guild_id in self._up_next_tasks: self._up_next_tasks[guild_id].cancel(); self._up_next_tasks.pop(guild_id, None)
+        if guild_id in self._preresolve_tasks: self._preresolve_tasks[guild_id].cancel(); self._preresolve_tasks.pop(guild_id, None)
+        if guild_id in self._gapless_tasks: self._gapless_tasks[guild_id].cancel(); self._gapless_tasks.pop(guild_id, None)
+        self._discard_prepared_next(guild_id); self._gapless_sources.pop(guild_id, None); self._playback_buffer_stats.pop(guild_id, None)
+        self._current_decoders.pop(guild_id, None); self._playback_clocks.pop(guild_id, None)
         self._is_processing_next_song.pop(guild_id, None)
         self._vote_skips.pop(guild_id, None)
 
@@ -796,15 +1268,353 @@ def parse_timestamp(ts: str) -> Optional[float]:
 def truncate_text(text: str, max_length: int) -> str:
     return text[:max_length - 3] + "..." if len(text) > max_length else text
 
-# Global function or method of MyClient
-async def get_audio_stream_info(url_or_query: str, search: bool = False, search_results_count: int = 1, search_provider: str = "youtube") -> Optional[Dict[str, Any]]:
-    print(f"\nDEBUG YTDL (get_audio_stream_info): CALLED with url_or_query='{truncate_text(url_or_query, 100)}', search={search}, count={search_results_count}, provider_hint='{search_provider}'")
+# --- YT-DLP EXTRACTOR POOL ---
+YTDL_BASE_OPTIONS = {
+    'format': 'bestaudio/best', 'quiet': True, 'no_warnings': True,
+    'skip_download': True, 'source_address': '0.0.0.0',
+    'youtube_skip_dash_manifest': True, 'allow_multiple_audio_streams': True,
+    'cachedir': YTDL_CACHE_DIR,
+}
+YTDL_PROFILE_OPTIONS = {
+    "resolve": {'noplaylist': True, 'dump_single_json': True, 'extract_flat': False},
+    "search": {'noplaylist': False, 'dump_single_json': False, 'extract_flat': 'discard_in_playlist'},
+    "flat_search": {'noplaylist': False, 'dump_single_json': False, 'extract_flat': True},
+}
+
+class YTDLPool:
+    """
+    Long-lived YoutubeDL instances per option profile, so extractors, HTTP keep-alive and the
+    in-process signature cache survive between calls. An instance is leased to exactly one caller
+    at a time through thread-safe queues, so leases may be taken from the event loop or worker threads.
+    """
+    def __init__(self, base_options: Dict[str, Any], profile_options: Dict[str, Dict[str, Any]], max_idle_per_profile: int):
+        self.base_options = base_options; self.profile_options = profile_options
+        self._idle: Dict[str, thread_queue.Queue] = {name: thread_queue.Queue(maxsize=max_idle_per_profile) for name in profile_options}
+        self.stats = {"created": 0, "reused": 0}
 
-    ydl_opts = {
-        'format': 'bestaudio/best', 'quiet': True, 'no_warnings': True, 
-        'skip_download': True, 'source_address': '0.0.0.0',
-        'youtube_skip_dash_manifest': True, 'allow_multiple_audio_streams': True,
-    }
+    def options_for(self, profile: str) -> Dict[str, Any]:
+        return {**self.base_options, **self.profile_options[profile]}
+
+    @contextlib.contextmanager
+    def lease(self, profile: str):
+        try:
+            ydl = self._idle[profile].get_nowait(); self.stats["reused"] += 1
+        except thread_queue.Empty:
+            ydl = yt_dlp.YoutubeDL(self.options_for(profile)); self.stats["created"] += 1
+        try: yield ydl
+        finally:
+            try: self._idle[profile].put_nowait(ydl)
+            except thread_queue.Full: ydl.close() # Burst instance beyond the idle cap
+
+    def warm(self):
+        """Pre-creates one instance per profile and initializes the common extractors. Blocking; run it in a thread."""
+        for profile in self.profile_options:
+            with self.lease(profile) as ydl:
+                try:
+                    for extractor_key in ("Youtube", "YoutubeSearch", "Soundcloud", "SoundcloudSearch"): ydl.get_info_extractor(extractor_key)
+                except Exception as e: print(f"Error warming yt-dlp profile '{profile}': {e}")
+        print(f"yt-dlp extractor pool warmed ({len(self.profile_options)} profiles, cache dir '{YTDL_CACHE_DIR}').")
+
+ytdl_pool = YTDLPool(YTDL_BASE_OPTIONS, YTDL_PROFILE_OPTIONS, YTDL_POOL_SIZE_PER_PROFILE)
+
+# --- RESOLUTION SCHEDULER ---
+RESOLVE_PRIORITY_INTERACTIVE = 0 # /play, searches, embeds, the track about to start
+RESOLVE_PRIORITY_PREFETCH = 1 # Look-ahead pre-resolving of upcoming queue entries
+RESOLVE_PRIORITY_AUTOPLAY = 2 # Smart autoplay and 24/7 genre streams
+RESOLVE_PRIORITY_BULK = 3 # Queue imports and playlist loads
+RESOLVE_PRIORITY_NAMES = {RESOLVE_PRIORITY_INTERACTIVE: "interactive", RESOLVE_PRIORITY_PREFETCH: "prefetch", RESOLVE_PRIORITY_AUTOPLAY: "autoplay", RESOLVE_PRIORITY_BULK: "bulk"}
+
+class ResolutionScheduler:
+    """
+    Grants a bounded number of resolution slots, highest priority class first and round-robin across
+    guilds within a class, so one guild's bulk import cannot starve another guild's /play.
+    Blocking yt-dlp calls made while holding a slot run on the scheduler's own thread pool.
+    Slot bookkeeping is only touched from the event loop thread.
+    """
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resolver")
+        self._active = 0
+        self._waiting: Dict[int, "OrderedDict[Optional[int], deque]"] = {p: OrderedDict() for p in RESOLVE_PRIORITY_NAMES}
+        self.stats = {p: {"completed": 0, "total_wait": 0.0, "max_wait": 0.0} for p in RESOLVE_PRIORITY_NAMES}
+
+    def depth(self, priority: int) -> int:
+        return sum(1 for waiters in self._waiting[priority].values() for fut in waiters if not fut.cancelled())
+
+    def _pop_next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self._waiting):
+            guild_waiters = self._waiting[priority]
+            while guild_waiters:
+                guild_key, waiters = guild_waiters.popitem(last=False)
+                fut = waiters.popleft()
+                if waiters: guild_waiters[guild_key] = waiters # Back of the line for this guild
+                if not fut.cancelled(): return fut
+        return None
+
+    def _grant_waiters(self):
+        while self._active < self.max_workers:
+            fut = self._pop_next_waiter()
+            if fut is None: return
+            self._active += 1; fut.set_result(None)
+
+    def _release(self):
+        self._active -= 1; self._grant_waiters()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = RESOLVE_PRIORITY_INTERACTIVE, guild_id: Optional[int] = None):
+        enqueued_at = time.monotonic()
+        if self._active < self.max_workers and not any(self._waiting.values()):
+            self._active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiting[priority].setdefault(guild_id, deque()).append(fut)
+            try: await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled(): self._release() # Granted just as we were cancelled
+                raise
+        waited = time.monotonic() - enqueued_at; priority_stats = self.stats[priority]
+        priority_stats["total_wait"] += waited; priority_stats["max_wait"] = max(priority_stats["max_wait"], waited)
+        try: yield
+        finally:
+            priority_stats["completed"] += 1
+            self._release()
+
+    async def run_blocking(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def summary(self) -> str:
+        lines = []
+        for priority, name in RESOLVE_PRIORITY_NAMES.items():
+            priority_stats = self.stats[priority]; completed = priority_stats["completed"]
+            avg_wait = priority_stats["total_wait"] / completed if completed else 0.0
+            lines.append(f"{name}: {self.depth(priority)} waiting, avg {avg_wait:.2f}s / max {priority_stats['max_wait']:.2f}s wait")
+        return f"Active {self._active}/{self.max_workers}\n" + "\n".join(lines)
+
+resolution_scheduler = ResolutionScheduler(RESOLUTION_WORKERS)
+
+# Single-flight registry: identical concurrent resolves share one extraction. key -> (task, priority)
+_inflight_resolutions: Dict[Any, Tuple[asyncio.Task, int]] = {}
+coalesce_stats = {"started": 0, "joined": 0}
+
+async def coalesce_inflight(registry: Dict[Any, Tuple[asyncio.Task, int]], key: Any, coro_factory, priority: int = RESOLVE_PRIORITY_INTERACTIVE):
+    """
+    Runs coro_factory() once per key at a time; concurrent callers with the same key await the same task
+    and each get their own deep copy of the result. A caller only joins a flight of equal or higher priority,
+    so an interactive request never waits behind a queued bulk resolve of the same track.
+    """
+    existing = registry.get(key)
+    if existing and not existing[0].done() and existing[1] <= priority:
+        coalesce_stats["joined"] += 1
+        print(f"DEBUG SINGLE_FLIGHT: Joining in-flight resolve for {truncate_text(str(key), 100)}")
+        return copy.deepcopy(await asyncio.shield(existing[0]))
+    task = asyncio.ensure_future(coro_factory()); coalesce_stats["started"] += 1
+    registry[key] = (task, priority)
+    def _forget(finished_task):
+        if registry.get(key, (None,))[0] is finished_task: registry.pop(key, None)
+    task.add_done_callback(_forget)
+    return copy.deepcopy(await asyncio.shield(task)) # Shielded so a cancelled caller doesn't abort it for the others
+
+# --- TRACK RESOLUTION CACHE ---
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be", "www.youtu.be")
+TRACKING_QUERY_PARAMS = ("si", "feature", "fbclid", "gclid", "pp", "ab_channel", "start_radio", "index", "t")
+HARD_RESOLUTION_FAILURES = [
+    "video unavailable", "private video", "this video has been removed", "this video is no longer available",
+    "account associated with this video has been terminated", "http error 404", "unsupported url", "does not exist",
+    "copyright claim", "has been blocked", "this track is not available", "members-only content",
+]
+
+def normalize_track_url(url: str) -> str:
+    """Canonical form of a track URL, used as the cache key for resolved tracks."""
+    url = url.strip()
+    try: parsed = urlparse(url)
+    except ValueError: return url
+    host = (parsed.hostname or "").lower()
+    if host in YOUTUBE_HOSTS:
+        video_id = None
+        if host.endswith("youtu.be"): video_id = parsed.path.strip("/").split("/")[0]
+        elif parsed.path == "/watch": video_id = dict(parse_qsl(parsed.query)).get("v")
+        else:
+            path_parts = parsed.path.strip("/").split("/")
+            if len(path_parts) >= 2 and path_parts[0] in ("shorts", "embed", "live", "v"): video_id = path_parts[1]
+        if video_id: return f"https://www.youtube.com/watch?v={video_id}"
+    if host.startswith("www."): host = host[4:]
+    if host.startswith("m."): host = host[2:]
+    query_pairs = sorted((k, v) for k, v in parse_qsl(parsed.query) if not k.startswith("utm_") and k not in TRACKING_QUERY_PARAMS)
+    path = parsed.path.rstrip("/") or "/"
+    return f"https://{host}{path}" + (f"?{urlencode(query_pairs)}" if query_pairs else "")
+
+def is_hard_resolution_failure(error_text: str) -> bool:
+    error_lower = error_text.lower()
+    return any(marker in error_lower for marker in HARD_RESOLUTION_FAILURES)
+
+def parse_stream_url_expiry(stream_url: Optional[str]) -> Optional[float]:
+    """Unix timestamp from a signed stream URL's expire= parameter (query or /expire/<ts>/ path form), if any."""
+    if not stream_url: return None
+    match = re.search(r"[?&/]expire[=/](\d{9,11})", stream_url)
+    return float(match.group(1)) if match else None
+
+def estimate_stream_url_expiry(stream_url: Optional[str], extractor_key: Optional[str], resolved_at: Optional[float] = None) -> Optional[float]:
+    if not stream_url: return None
+    signed_expiry = parse_stream_url_expiry(stream_url)
+    if signed_expiry: return signed_expiry
+    return (resolved_at or time.time()) + STREAM_URL_DEFAULT_TTLS.get((extractor_key or "").lower(), TRACK_STREAM_URL_TTL)
+
+def is_stream_url_stale(song: Dict[str, Any], margin: float = STREAM_URL_REFRESH_MARGIN) -> bool:
+    """True if the entry has no stream URL or its URL expires within `margin` seconds. Unknown expiry counts as fresh."""
+    if not song.get('stream_url'): return True
+    expires_at = song.get('stream_expires_at') or parse_stream_url_expiry(song['stream_url'])
+    return bool(expires_at) and expires_at - time.time() < margin
+
+def is_opus_stream(song: Dict[str, Any]) -> bool:
+    """True if the entry's stream is Opus audio (from the resolved acodec, or YouTube's webm/Opus itags in the URL)."""
+    acodec = (song.get('stream_acodec') or "").lower()
+    if acodec: return acodec.startswith("opus")
+    stream_url = song.get('stream_url') or ""
+    return bool(re.search(r"[?&/]itag[=/](249|250|251)(?:[&/]|$)", stream_url)) or "mime=audio%2Fwebm" in stream_url
+
+class TrackResolutionCache:
+    """
+    Two-tier cache (in-memory LRU + one JSON file per track on disk) of resolved tracks.
+    Long-lived metadata and the short-lived stream URL are stored and expired separately,
+    and hard failures are negative-cached so repeated imports stop re-extracting them.
+    """
+    METADATA_KEYS = ('webpage_url', 'title', 'duration', 'uploader', 'thumbnail', 'is_live', 'extractor_key')
+    STREAM_KEYS = ('url', 'abr', 'ext', 'acodec', 'stream_expires_at')
+
+    def __init__(self, cache_dir: str, max_memory_entries: int, metadata_ttl: float, stream_ttl: float, negative_ttl: float):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.metadata_ttl = metadata_ttl; self.stream_ttl = stream_ttl; self.negative_ttl = negative_ttl
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "stale_streams": 0}
+
+    def _path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path_for(key)
+        if not os.path.exists(path): return None
+        try:
+            with open(path, "r") as f: record = json.load(f)
+            return record if record.get("key") == key else None
+        except Exception as e:
+            print(f"Error reading track cache entry for {key}: {e}")
+            return None
+
+    def _write_disk(self, key: str, record: Dict[str, Any]):
+        try:
+            with open(self._path_for(key), "w") as f: json.dump(record, f)
+        except Exception as e: print(f"Error writing track cache entry for {key}: {e}")
+
+    def _remember(self, key: str, record: Dict[str, Any]):
+        self._memory[key] = record; self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries: self._memory.popitem(last=False)
+
+    async def _get_record(self, key: str) -> Optional[Dict[str, Any]]:
+        record = self._memory.get(key)
+        if record is not None:
+            self._memory.move_to_end(key)
+        else:
+            record = await asyncio.to_thread(self._read_disk, key)
+            if record is None: return None
+            self._remember(key, record)
+        if record.get("alias_of"): # Alternate input URL pointing at the canonical entry
+            return await self._get_record(record["alias_of"]) if record["alias_of"] != key else None
+        return record
+
+    async def lookup(self, url: str, min_stream_validity: float = STREAM_URL_REFRESH_MARGIN) -> Optional[Dict[str, Any]]:
+        """Full info dict (metadata + a stream URL valid for at least `min_stream_validity` seconds), an error dict for negative entries, or None on a miss."""
+        record = await self._get_record(normalize_track_url(url)); now = time.time()
+        if record is None: self.stats["misses"] += 1; return None
+        if record.get("failure"):
+            if now - record.get("failed_at", 0) < self.negative_ttl:
+                self.stats["negative_hits"] += 1
+                return {"error": record["failure"], "title": record.get("title") or url, "hard_failure": True}
+            self.stats["misses"] += 1; return None
+        if not record.get("metadata") or now - record.get("metadata_at", 0) >= self.metadata_ttl:
+            self.stats["misses"] += 1; return None
+        stream = record.get("stream")
+        stream_expires_at = (stream or {}).get("stream_expires_at") or record.get("stream_at", 0) + self.stream_ttl
+        if not stream or stream_expires_at - now < min_stream_validity:
+            self.stats["stale_streams"] += 1; return None
+        self.stats["hits"] += 1
+        return {**record["metadata"], **record["stream"]}
+
+    async def peek_metadata(self, url: str) -> Optional[Dict[str, Any]]:
+        """Cached metadata only (ignores stream URL freshness), or None."""
+        record = await self._get_record(normalize_track_url(url))
+        if not record or record.get("failure") or not record.get("metadata"): return None
+        if time.time() - record.get("metadata_at", 0) >= self.metadata_ttl: return None
+        return dict(record["metadata"])
+
+    async def store(self, info: Dict[str, Any], requested_url: Optional[str] = None):
+        if not info.get('webpage_url') or not info.get('url'): return
+        key = normalize_track_url(info['webpage_url']); now = time.time()
+        record = {"key": key, "metadata": {k: info.get(k) for k in self.METADATA_KEYS}, "metadata_at": now, "stream": None, "stream_at": 0}
+        if not info.get('is_live'): # Live manifests are too short-lived to be worth caching
+            record["stream"] = {k: info.get(k) for k in self.STREAM_KEYS}; record["stream_at"] = now
+        self._remember(key, record)
+        await asyncio.to_thread(self._write_disk, key, record)
+        if requested_url:
+            alias_key = normalize_track_url(requested_url)
+            if alias_key != key:
+                alias_record = {"key": alias_key, "alias_of": key}
+                self._remember(alias_key, alias_record)
+                await asyncio.to_thread(self._write_disk, alias_key, alias_record)
+
+    async def invalidate_stream(self, url: str):
+        """Drops the cached stream URL (keeps metadata), e.g. after playback of it failed."""
+        record = await self._get_record(normalize_track_url(url))
+        if not record or not record.get("stream"): return
+        record["stream"] = None; record["stream_at"] = 0
+        await asyncio.to_thread(self._write_disk, record["key"], record)
+
+    async def store_failure(self, url: str, error: str, title: Optional[str] = None):
+        key = normalize_track_url(url)
+        record = {"key": key, "failure": error, "title": title, "failed_at": time.time()}
+        self._remember(key, record)
+        await asyncio.to_thread(self._write_disk, key, record)
+
+    def prune_disk(self):
+        """Deletes on-disk entries older than every TTL. Blocking; run it in a thread."""
+        cutoff = time.time() - max(self.metadata_ttl, self.negative_ttl); removed = 0
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                if filename.endswith(".json") and os.path.getmtime(path) < cutoff: os.remove(path); removed += 1
+            except OSError: pass
+        if removed: print(f"Pruned {removed} expired track cache entries.")
+
+track_cache = TrackResolutionCache(TRACK_CACHE_DIR, TRACK_CACHE_MEMORY_ENTRIES, TRACK_METADATA_TTL, TRACK_STREAM_URL_TTL, TRACK_NEGATIVE_TTL)
+
+async def get_audio_stream_info(url_or_query: str, search: bool = False, search_results_count: int = 1, search_provider: str = "youtube",
+                                min_stream_validity: float = STREAM_URL_REFRESH_MARGIN, priority: int = RESOLVE_PRIORITY_INTERACTIVE,
+                                guild_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    # Direct URL lookups go through the track cache first; single-result searches populate it.
+    is_direct_lookup = not search and url_or_query.startswith("http")
+    if is_direct_lookup:
+        cached_info = await track_cache.lookup(url_or_query, min_stream_validity=min_stream_validity)
+        if cached_info:
+            print(f"DEBUG YTDL CACHE: {'Negative hit' if 'error' in cached_info else 'Hit'} for '{truncate_text(url_or_query, 100)}'")
+            return cached_info
+
+    async def _resolve_and_cache():
+        async with resolution_scheduler.slot(priority, guild_id):
+            info = await _extract_audio_stream_info(url_or_query, search=search, search_results_count=search_results_count, search_provider=search_provider)
+        if isinstance(info, dict):
+            if "error" in info:
+                if is_direct_lookup and info.get("hard_failure"):
+                    await track_cache.store_failure(url_or_query, info["error"], info.get("title"))
+            elif info.get('_type') != 'playlist':
+                await track_cache.store(info, requested_url=url_or_query if is_direct_lookup else None)
+        return info
+
+    if search: flight_key = ("search", search_provider.lower(), " ".join(url_or_query.lower().split()), search_results_count)
+    else: flight_key = ("resolve", normalize_track_url(url_or_query) if is_direct_lookup else url_or_query)
+    return await coalesce_inflight(_inflight_resolutions, flight_key, _resolve_and_cache, priority)
+
+async def _extract_audio_stream_info(url_or_query: str, search: bool = False, search_results_count: int = 1, search_provider: str = "youtube") -> Optional[Dict[str, Any]]:
+    print(f"\nDEBUG YTDL (get_audio_stream_info): CALLED with url_or_query='{truncate_text(url_or_query, 100)}', search={search}, count={search_results_count}, provider_hint='{search_provider}'")
 
     actual_query_or_url = url_or_query
     if search:
@@ -817,19 +1627,17 @@ async def get_audio_stream_info(url_or_query: str, search: bool = False, search_
             num_to_fetch += 5 
 
         actual_query_or_url = f"{search_prefix}{num_to_fetch}:{url_or_query}"
-        
-        ydl_opts.update({'noplaylist': False, 'dump_single_json': False, 
-                         'extract_flat': 'discard_in_playlist' if search_results_count == 1 else True})
+        ytdl_profile = "search" if search_results_count == 1 else "flat_search"
     else: 
-        ydl_opts.update({'noplaylist': True, 'dump_single_json': True, 'extract_flat': False})
+        ytdl_profile = "resolve"
 
-    print(f"DEBUG YTDL: ydl_opts: {ydl_opts}, ACTUAL query: '{actual_query_or_url}'")
+    print(f"DEBUG YTDL: profile: {ytdl_profile}, ACTUAL query: '{actual_query_or_url}'")
     
     raw_info_from_ydl = None; error_message = None; processed_info = None
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            raw_info_from_ydl = await asyncio.to_thread(ydl.extract_info, actual_query_or_url, download=False)
+        with ytdl_pool.lease(ytdl_profile) as ydl:
+            raw_info_from_ydl = await resolution_scheduler.run_blocking(ydl.extract_info, actual_query_or_url, download=False)
             print(f"DEBUG YTDL: Raw info type: {type(raw_info_from_ydl)}. Content (500 chars): {str(raw_info_from_ydl)[:500]}")
 
             if not raw_info_from_ydl: error_message = "yt-dlp returned no information."
@@ -898,10 +1706,9 @@ async def get_audio_stream_info(url_or_query: str, search: bool = False, search_
                 if webpage_url := processed_info.get('webpage_url'):
                     if not processed_info.get('formats'):
                         print(f"DEBUG YTDL: Item '{item_title_debug}' missing formats, re-fetching from '{webpage_url}'.")
-                        refetch_opts = ydl_opts.copy(); refetch_opts.update({'noplaylist': True, 'dump_single_json': True, 'extract_flat': False})
-                        with yt_dlp.YoutubeDL(refetch_opts) as ydl_single:
+                        with ytdl_pool.lease("resolve") as ydl_single:
                             try:
-                                refetched_data = await asyncio.to_thread(ydl_single.extract_info, webpage_url, download=False)
+                                refetched_data = await resolution_scheduler.run_blocking(ydl_single.extract_info, webpage_url, download=False)
                                 if refetched_data and isinstance(refetched_data, dict):
                                     print(f"DEBUG YTDL: Re-fetch successful. Updating item.")
                                     processed_info.update(refetched_data)
@@ -920,6 +1727,8 @@ async def get_audio_stream_info(url_or_query: str, search: bool = False, search_
                         print(f"DEBUG YTDL: Found playable stream URL in formats: ...{best_audio_format['url'][-50:]}")
                         for key in ['title', 'duration', 'uploader', 'thumbnail', 'abr', 'ext', 'is_live']:
                             if not processed_info.get(key) and best_audio_format.get(key) is not None: processed_info[key] = best_audio_format.get(key)
+                        processed_info['acodec'] = best_audio_format.get('acodec')
+                        processed_info['stream_expires_at'] = estimate_stream_url_expiry(processed_info['url'], processed_info.get('extractor_key'))
                     elif not processed_info.get('url') or "youtu" in processed_info.get('url'): error_message = "No suitable audio stream URL found in formats."
                 elif not processed_info.get('url') or "youtu" in processed_info.get('url'): error_message = "No playable stream URL could be determined (no formats)."
                 # --- END OF COPIED SINGLE ITEM LOGIC ---
@@ -927,7 +1736,7 @@ async def get_audio_stream_info(url_or_query: str, search: bool = False, search_
     except yt_dlp_utils.DownloadError as e:
         error_message = f"DownloadError: {truncate_text(str(e), 100)}"
         title_fallback = (raw_info_from_ydl.get("title") if isinstance(raw_info_from_ydl, dict) else None) or url_or_query
-        return {"error": error_message, "title": title_fallback}
+        return {"error": error_message, "title": title_fallback, "hard_failure": is_hard_resolution_failure(str(e))}
     except Exception as e:
         error_message = f"Unexpected yt-dlp processing error: {truncate_text(str(e), 100)}"
         traceback.print_exc()
@@ -949,11 +1758,1262 @@ async def get_audio_stream_info(url_or_query: str, search: bool = False, search_
             return {"error": "Could not determine a playable stream URL for the item.", "title": processed_info.get('title', url_or_query)}
         if processed_info.get('webpage_url') == processed_info.get('url') and any(kw in processed_info.get('url') for kw in ['/watch?v=', 'youtu.be/', 'soundcloud.com/']):
             return {"error": "Identified webpage, but failed to extract a direct audio stream.", "title": processed_info.get('title', url_or_query)}
+        if not processed_info.get('stream_expires_at'): processed_info['stream_expires_at'] = estimate_stream_url_expiry(processed_info['url'], processed_info.get('extractor_key'))
     
     has_stream_url = isinstance(processed_info, dict) and bool(processed_info.get('url')) and not any(kw in processed_info.get('url', '') for kw in ['/watch?v=', 'youtu.be/', 'soundcloud.com/'])
     print(f"DEBUG YTDL: Successfully processed. Title: '{processed_info.get('title', 'Playlist/Unknown') if isinstance(processed_info, dict) else 'Playlist'}'. Has potential stream: {has_stream_url}")
     return processed_info
 
+# --- STORAGE BACKENDS ---
+def write_json_atomic(path: str, data: Any, indent: Optional[int] = None):
+    # Temp file in the same directory + fsync + rename: readers see either the old or the new file, never a torn one
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=indent); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class StorageBackend(abc.ABC):
+    """
+    Where guild settings, queue journals, user playlists and command prefixes are kept. Every method blocks;
+    call them from worker threads (the persisters do) or via asyncio.to_thread.
+    Queues are stored as a snapshot plus the journal lines recorded after it (see QueueJournal).
+    """
+    name = "base"
+    def open(self): pass
+    def close(self): pass
+    @abc.abstractmethod
+    def guild_ids(self) -> List[int]: ...
+    @abc.abstractmethod
+    def rejoin_index(self) -> List[Tuple[int, Optional[int]]]: ... # [(guild_id, last voice channel)] of guilds in 24/7 mode
+    @abc.abstractmethod
+    def load_guild_settings(self, guild_id: int) -> Optional[Dict[str, Any]]: ...
+    @abc.abstractmethod
+    def save_guild_settings(self, guild_id: int, data: Dict[str, Any]): ...
+    @abc.abstractmethod
+    def read_queue(self, guild_id: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]]: ... # (snapshot seq, snapshot queue, later ops)
+    @abc.abstractmethod
+    def append_queue_ops(self, guild_id: int, entries: List[Tuple[int, str]]): ... # [(seq, serialized op)]
+    @abc.abstractmethod
+    def write_queue_snapshot(self, guild_id: int, seq: int, queue: List[Dict[str, Any]]): ... # Also drops ops up to seq
+    @abc.abstractmethod
+    def load_user_playlists(self, user_id: int) -> Dict[str, List[Dict[str, Any]]]: ...
+    @abc.abstractmethod
+    def save_user_playlists(self, user_id: int, playlists: Dict[str, List[Dict[str, Any]]]): ...
+    @abc.abstractmethod
+    def user_ids_with_playlists(self) -> List[int]: ...
+    @abc.abstractmethod
+    def load_prefixes(self) -> Dict[int, List[str]]: ...
+    @abc.abstractmethod
+    def save_guild_prefixes(self, guild_id: int, prefixes: Optional[List[str]]): ... # None removes the guild's entry
+
+class JsonStorageBackend(StorageBackend):
+    """The original layout: one settings file and one queue journal per guild, one playlist file per user, one prefixes file."""
+    name = "json"
+
+    def __init__(self, settings_dir: str, playlists_dir: str, prefixes_file: str):
+        self.settings_dir = settings_dir; self.playlists_dir = playlists_dir; self.prefixes_file = prefixes_file
+        self._prefixes_lock = threading.Lock()
+
+    def settings_path(self, guild_id: int) -> str: return os.path.join(self.settings_dir, f"{guild_id}_settings.json")
+    def journal_path(self, guild_id: int) -> str: return os.path.join(self.settings_dir, f"{guild_id}_queue.jsonl")
+    def snapshot_path(self, guild_id: int) -> str: return os.path.join(self.settings_dir, f"{guild_id}_queue.json")
+    def playlist_path(self, user_id: int) -> str: return os.path.join(self.playlists_dir, f"{user_id}_playlists.json")
+
+    @staticmethod
+    def _ids_in(directory: str, suffix: str) -> List[int]:
+        return [int(filename[:-len(suffix)]) for filename in os.listdir(directory) if filename.endswith(suffix) and filename[:-len(suffix)].isdigit()]
+
+    def guild_ids(self) -> List[int]: return self._ids_in(self.settings_dir, "_settings.json")
+    def rejoin_index(self) -> List[Tuple[int, Optional[int]]]:
+        # Still a parse per settings file: the JSON layout has nowhere to keep an index
+        index = []
+        for guild_id in self.guild_ids():
+            try: settings = self.load_guild_settings(guild_id) or {}
+            except Exception as e: print(f"Error reading settings of guild {guild_id}: {e}"); continue
+            if settings.get("is_24_7_mode"): index.append((guild_id, settings.get("last_known_vc_channel_id")))
+        return index
+
+    def load_guild_settings(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        settings_path = self.settings_path(guild_id)
+        if not os.path.exists(settings_path): return None
+        with open(settings_path, "r") as f: return json.load(f)
+
+    def save_guild_settings(self, guild_id: int, data: Dict[str, Any]): write_json_atomic(self.settings_path(guild_id), data, indent=4)
+
+    def read_queue(self, guild_id: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]]:
+        snapshot_path = self.snapshot_path(guild_id); journal_path = self.journal_path(guild_id)
+        if not os.path.exists(snapshot_path) and not os.path.exists(journal_path): return None
+        queue, seq, ops = [], 0, []
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "r") as f: snapshot = json.load(f)
+            queue, seq = snapshot.get("queue", []), snapshot.get("seq", 0)
+        if os.path.exists(journal_path):
+            with open(journal_path, "rb") as f: raw = f.read()
+            good_bytes = 0
+            for raw_line in raw.splitlines(keepends=True):
+                try:
+                    if not raw_line.endswith(b"\n"): raise ValueError("unterminated line")
+                    ops.append(json.loads(raw_line))
+                except ValueError:
+                    print(f"DEBUG QUEUE JOURNAL: Dropping torn entry at byte {good_bytes} of {journal_path}"); break
+                good_bytes += len(raw_line)
+            if good_bytes < len(raw): os.truncate(journal_path, good_bytes) # Later appends must not follow a torn line
+        return seq, queue, ops
+
+    def append_queue_ops(self, guild_id: int, entries: List[Tuple[int, str]]):
+        with open(self.journal_path(guild_id), "a") as f:
+            f.write("".join(f"{line}\n" for _, line in entries)); f.flush(); os.fsync(f.fileno())
+
+    def write_queue_snapshot(self, guild_id: int, seq: int, queue: List[Dict[str, Any]]):
+        write_json_atomic(self.snapshot_path(guild_id), {"seq": seq, "queue": queue})
+        with open(self.journal_path(guild_id), "w") as f: f.flush(); os.fsync(f.fileno()) # Everything up to seq is in the snapshot
+
+    def load_user_playlists(self, user_id: int) -> Dict[str, List[Dict[str, Any]]]:
+        playlist_path = self.playlist_path(user_id)
+        if not os.path.exists(playlist_path): return {}
+        with open(playlist_path, "r") as f: return json.load(f)
+
+    def save_user_playlists(self, user_id: int, playlists: Dict[str, List[Dict[str, Any]]]): write_json_atomic(self.playlist_path(user_id), playlists, indent=4)
+    def user_ids_with_playlists(self) -> List[int]: return self._ids_in(self.playlists_dir, "_playlists.json")
+
+    def load_prefixes(self) -> Dict[int, List[str]]:
+        if not os.path.exists(self.prefixes_file): return {}
+        with open(self.prefixes_file, "r") as f: return {int(k): v for k, v in json.load(f).items()}
+
+    def save_guild_prefixes(self, guild_id: int, prefixes: Optional[List[str]]):
+        with self._prefixes_lock:
+            all_prefixes = self.load_prefixes()
+            if prefixes: all_prefixes[guild_id] = prefixes
+            else: all_prefixes.pop(guild_id, None)
+            write_json_atomic(self.prefixes_file, all_prefixes, indent=4)
+
+class SqliteStorageBackend(StorageBackend):
+    """
+    Everything in one SQLite database in WAL mode, keyed and indexed per guild / user, so a lookup or save costs
+    the same however many guilds and users are stored. open() creates the schema and, once, imports the JSON layout.
+    """
+    name = "sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL, is_24_7 INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL, last_vc_channel_id INTEGER);
+        CREATE INDEX IF NOT EXISTS idx_guild_settings_24_7 ON guild_settings (is_24_7) WHERE is_24_7 = 1;
+        CREATE TABLE IF NOT EXISTS queue_snapshots (guild_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS queue_entries (guild_id INTEGER NOT NULL, position INTEGER NOT NULL, song TEXT NOT NULL, PRIMARY KEY (guild_id, position)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS queue_ops (guild_id INTEGER NOT NULL, seq INTEGER NOT NULL, op TEXT NOT NULL, PRIMARY KEY (guild_id, seq)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS playlists (user_id INTEGER NOT NULL, name TEXT NOT NULL, songs TEXT NOT NULL, PRIMARY KEY (user_id, name)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS prefixes (guild_id INTEGER PRIMARY KEY, prefixes TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+
+    def __init__(self, path: str, migrate_from: Optional[StorageBackend] = None):
+        self.path = path; self.migrate_from = migrate_from
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock() # One connection shared by the writer threads; sqlite3 objects aren't safe for concurrent use
+
+    def open(self):
+        if self._conn is not None: return
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL: durable on commit up to an OS crash, no fsync per write
+        conn.executescript(self.SCHEMA)
+        if "last_vc_channel_id" not in [row[1] for row in conn.execute("PRAGMA table_info(guild_settings)")]: # Database created before the rejoin index
+            conn.execute("ALTER TABLE guild_settings ADD COLUMN last_vc_channel_id INTEGER")
+            for guild_id, data in conn.execute("SELECT guild_id, data FROM guild_settings WHERE is_24_7 = 1").fetchall():
+                conn.execute("UPDATE guild_settings SET last_vc_channel_id = ? WHERE guild_id = ?", (json.loads(data).get("last_known_vc_channel_id"), guild_id))
+        self._conn = conn
+        if self.migrate_from and not self._meta("json_migrated_at"):
+            pending = self._meta("json_migration_pending") # What failed last time; everything else is already imported
+            self._migrate(self.migrate_from, json.loads(pending) if pending else None)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None: self._conn.close(); self._conn = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try: yield self._conn
+            except BaseException: self._conn.execute("ROLLBACK"); raise
+            else: self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock: return self._conn.execute(sql, params).fetchall()
+
+    def _meta(self, key: str) -> Optional[str]:
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def guild_ids(self) -> List[int]: return [row[0] for row in self._query("SELECT guild_id FROM guild_settings")]
+    def rejoin_index(self) -> List[Tuple[int, Optional[int]]]: return self._query("SELECT guild_id, last_vc_channel_id FROM guild_settings WHERE is_24_7 = 1")
+
+    def load_guild_settings(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT data FROM guild_settings WHERE guild_id = ?", (guild_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_guild_settings(self, guild_id: int, data: Dict[str, Any]):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO guild_settings (guild_id, data, is_24_7, updated_at, last_vc_channel_id) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(guild_id) DO UPDATE SET data = excluded.data, is_24_7 = excluded.is_24_7, updated_at = excluded.updated_at, last_vc_channel_id = excluded.last_vc_channel_id",
+                         (guild_id, json.dumps(data, default=str), int(bool(data.get("is_24_7_mode"))), time.time(), data.get("last_known_vc_channel_id")))
+
+    def read_queue(self, guild_id: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]]:
+        with self._lock:
+            snapshot_row = self._conn.execute("SELECT seq FROM queue_snapshots WHERE guild_id = ?", (guild_id,)).fetchone()
+            seq = snapshot_row[0] if snapshot_row else 0
+            queue = [json.loads(row[0]) for row in self._conn.execute("SELECT song FROM queue_entries WHERE guild_id = ? ORDER BY position", (guild_id,))]
+            ops = [json.loads(row[0]) for row in self._conn.execute("SELECT op FROM queue_ops WHERE guild_id = ? AND seq > ? ORDER BY seq", (guild_id, seq))]
+        if not snapshot_row and not ops: return None
+        return seq, queue, ops
+
+    def append_queue_ops(self, guild_id: int, entries: List[Tuple[int, str]]):
+        with self._transaction() as conn: conn.executemany("INSERT OR REPLACE INTO queue_ops (guild_id, seq, op) VALUES (?, ?, ?)", [(guild_id, seq, line) for seq, line in entries])
+
+    def write_queue_snapshot(self, guild_id: int, seq: int, queue: List[Dict[str, Any]]):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM queue_entries WHERE guild_id = ?", (guild_id,))
+            conn.executemany("INSERT INTO queue_entries (guild_id, position, song) VALUES (?, ?, ?)", [(guild_id, position, json.dumps(song, default=str)) for position, song in enumerate(queue)])
+            conn.execute("INSERT INTO queue_snapshots (guild_id, seq) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET seq = excluded.seq", (guild_id, seq))
+            conn.execute("DELETE FROM queue_ops WHERE guild_id = ?", (guild_id,)) # The snapshot covers every recorded op, like the truncated JSON journal
+
+    def load_user_playlists(self, user_id: int) -> Dict[str, List[Dict[str, Any]]]:
+        return {name: json.loads(songs) for name, songs in self._query("SELECT name, songs FROM playlists WHERE user_id = ?", (user_id,))}
+
+    def save_user_playlists(self, user_id: int, playlists: Dict[str, List[Dict[str, Any]]]):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM playlists WHERE user_id = ?", (user_id,))
+            conn.executemany("INSERT INTO playlists (user_id, name, songs) VALUES (?, ?, ?)", [(user_id, name, json.dumps(songs)) for name, songs in playlists.items()])
+
+    def user_ids_with_playlists(self) -> List[int]: return [row[0] for row in self._query("SELECT DISTINCT user_id FROM playlists")]
+
+    def load_prefixes(self) -> Dict[int, List[str]]: return {guild_id: json.loads(prefixes) for guild_id, prefixes in self._query("SELECT guild_id, prefixes FROM prefixes")}
+
+    def save_guild_prefixes(self, guild_id: int, prefixes: Optional[List[str]]):
+        with self._transaction() as conn:
+            if prefixes: conn.execute("INSERT INTO prefixes (guild_id, prefixes) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET prefixes = excluded.prefixes", (guild_id, json.dumps(prefixes)))
+            else: conn.execute("DELETE FROM prefixes WHERE guild_id = ?", (guild_id,))
+
+    def _migrate(self, source: StorageBackend, retry: Optional[Dict[str, Any]] = None):
+        # One-time import; re-running after an interruption is harmless (every write is an upsert or a full replace). The JSON files are left in place.
+        # Items that fail are recorded and retried on the next open(); a retry skips anything the bot has saved to SQLite since, so it never goes back in time.
+        started = time.perf_counter(); counts = {"guilds": 0, "users": 0, "prefixes": 0}
+        failed = {"guilds": [], "users": [], "prefixes": False}
+        guild_ids = source.guild_ids() if retry is None else [guild_id for guild_id in retry.get("guilds", []) if self.load_guild_settings(guild_id) is None]
+        for guild_id in guild_ids:
+            try:
+                settings = source.load_guild_settings(guild_id) or {}
+                stored_queue = source.read_queue(guild_id)
+                if stored_queue is not None:
+                    seq, queue, _ = replay_queue_ops(*stored_queue)
+                    self.write_queue_snapshot(guild_id, seq, queue)
+                elif settings.get("queue"): self.write_queue_snapshot(guild_id, 0, settings["queue"]) # Pre-journal file: current song at its head, as before
+                settings.pop("queue", None)
+                self.save_guild_settings(guild_id, settings); counts["guilds"] += 1
+            except Exception as e: failed["guilds"].append(guild_id); print(f"Error migrating guild {guild_id} to SQLite: {e}")
+        migrated_users = set(self.user_ids_with_playlists()) if retry is not None else set()
+        for user_id in (source.user_ids_with_playlists() if retry is None else retry.get("users", [])):
+            if user_id in migrated_users: continue
+            try: self.save_user_playlists(user_id, source.load_user_playlists(user_id)); counts["users"] += 1
+            except Exception as e: failed["users"].append(user_id); print(f"Error migrating playlists of user {user_id} to SQLite: {e}")
+        if retry is None or retry.get("prefixes"):
+            try:
+                migrated_prefixes = self.load_prefixes() if retry is not None else {}
+                for guild_id, prefixes in source.load_prefixes().items():
+                    if guild_id not in migrated_prefixes: self.save_guild_prefixes(guild_id, prefixes); counts["prefixes"] += 1
+            except Exception as e: failed["prefixes"] = True; print(f"Error migrating custom prefixes to SQLite: {e}")
+        with self._transaction() as conn:
+            if failed["guilds"] or failed["users"] or failed["prefixes"]:
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migration_pending', ?)", (json.dumps(failed),))
+            else:
+                conn.execute("DELETE FROM meta WHERE key = 'json_migration_pending'")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated_at', ?)", (datetime.datetime.now(timezone.utc).isoformat(),))
+        print(f"Migrated JSON storage to {self.path}: {counts['guilds']} guilds, {counts['users']} users with playlists, {counts['prefixes']} prefix sets in {time.perf_counter() - started:.1f}s."
+              + (f" Will retry on next start: {len(failed['guilds'])} guilds, {len(failed['users'])} users{', prefixes' if failed['prefixes'] else ''}." if failed["guilds"] or failed["users"] or failed["prefixes"] else ""))
+
+json_storage = JsonStorageBackend(GUILD_SETTINGS_DIR, USER_PLAYLISTS_DIR, CUSTOM_PREFIXES_FILE)
+storage: StorageBackend = SqliteStorageBackend(SQLITE_DB_FILE, migrate_from=json_storage) if STORAGE_BACKEND == "sqlite" else json_storage
+
+# --- GUILD STATE PERSISTENCE ---
+class DebouncedStatePersister:
+    """
+    Write-behind saver for per-key state. mark_dirty() only records the key; once per debounce window the
+    latest state of every dirty key is snapshotted on the event loop, then handed to `writer` in a worker
+    thread. Flushes are serialized, so writes for one key never overlap or land out of order.
+    """
+    def __init__(self, debounce_seconds: float, writer: Callable[[Any, Any], None]):
+        self.debounce_seconds = debounce_seconds; self.writer = writer
+        self._dirty: Dict[Any, Callable[[], Any]] = {} # key -> snapshot function returning the data to write
+        self._timer: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.stats = {"marks": 0, "writes": 0, "failures": 0, "last_flush_ms": 0.0}
+
+    def mark_dirty(self, key: Any, snapshot_fn: Callable[[], Any]):
+        self._dirty[key] = snapshot_fn; self.stats["marks"] += 1
+        self._arm()
+
+    def is_dirty(self, key: Any) -> bool: return key in self._dirty
+
+    def _arm(self):
+        if self._timer is None or self._timer.done(): self._timer = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.debounce_seconds)
+        self._timer = None # Marks arriving during the flush start a new window
+        await self.flush()
+
+    async def flush(self, keys: Optional[List[Any]] = None):
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            targets = list(self._dirty) if keys is None else [k for k in keys if k in self._dirty]
+            snapshots = []; snapshot_fns = {}
+            for key in targets:
+                snapshot_fn = snapshot_fns[key] = self._dirty.pop(key)
+                try: snapshots.append((key, snapshot_fn()))
+                except Exception as e: self.stats["failures"] += 1; print(f"Error snapshotting state for {key}: {e}"); traceback.print_exc()
+            if not snapshots: return
+            started = time.perf_counter()
+            failed_keys = await asyncio.to_thread(self._write_all, snapshots)
+            self.stats["writes"] += len(snapshots) - len(failed_keys); self.stats["failures"] += len(failed_keys)
+            self.stats["last_flush_ms"] = (time.perf_counter() - started) * 1000
+            if failed_keys:
+                # Retry next window; a mark that arrived during the write already holds a newer snapshot function
+                for key in failed_keys: self._dirty.setdefault(key, snapshot_fns[key])
+                self._arm()
+
+    def _write_all(self, snapshots: List[Tuple[Any, Any]]) -> List[Any]:
+        failed_keys = []
+        for key, data in snapshots:
+            try: self.writer(key, data)
+            except Exception as e: failed_keys.append(key); print(f"Error saving state for {key}: {e}")
+        return failed_keys
+
+    async def close(self):
+        if self._timer and not self._timer.done(): self._timer.cancel()
+        self._timer = None
+        await self.flush()
+        if self._timer and not self._timer.done(): self._timer.cancel() # No retries after shutdown
+        self._timer = None
+        if self._dirty: print(f"Warning: {len(self._dirty)} state saves still failing at shutdown: {list(self._dirty)[:10]}")
+
+    def summary(self) -> str:
+        return f"{self.stats['marks']} saves -> {self.stats['writes']} writes · {len(self._dirty)} pending · {self.stats['failures']} failed · last flush {self.stats['last_flush_ms']:.0f}ms"
+
+guild_state_persister = DebouncedStatePersister(GUILD_SETTINGS_SAVE_DELAY_SECONDS, lambda guild_id, data: storage.save_guild_settings(guild_id, data))
+
+def apply_queue_op(queue: List[Dict[str, Any]], op: Dict[str, Any]) -> Any:
+    # Single implementation for live mutations and journal replay, so both produce the same queue
+    kind = op["op"]
+    if kind == "add":
+        if op.get("index") is None: queue.append(op["song"])
+        else: queue.insert(op["index"], op["song"])
+        return op["song"]
+    if kind == "pop": return queue.pop(op.get("index", 0))
+    if kind == "move":
+        song = queue.pop(op["from"]); queue.insert(op["to"], song) # insert() past the end appends
+        return song
+    if kind == "remove_range":
+        removed = queue[op["start"]:op["start"] + op["count"]]; del queue[op["start"]:op["start"] + op["count"]]
+        return removed
+    if kind == "shuffle": random.Random(op["seed"]).shuffle(queue); return None
+    if kind == "clear": removed = queue[:]; queue.clear(); return removed
+    if kind == "replace": queue[:] = op["songs"]; return None
+    if kind == "update": # In-place edit of one entry (pre-resolved stream/metadata, unplayable flag)
+        song = queue[op["index"]]; song.update(op.get("fields", {}))
+        for key in op.get("removed", []): song.pop(key, None)
+        return song
+    raise ValueError(f"Unknown queue operation: {kind}")
+
+def replay_queue_ops(seq: int, queue: List[Dict[str, Any]], ops: List[Dict[str, Any]]) -> Tuple[int, List[Dict[str, Any]], int]:
+    # Applies journal entries newer than the snapshot's seq; returns (last seq, queue, ops replayed)
+    replayed = 0
+    for op in ops:
+        if op.get("seq", 0) <= seq: continue # Already part of the snapshot
+        try: apply_queue_op(queue, op); replayed += 1
+        except (IndexError, KeyError, ValueError) as e: print(f"DEBUG QUEUE JOURNAL: Skipping unreplayable op {op.get('seq')}: {e}")
+        seq = op["seq"]
+    return seq, queue, replayed
+
+class QueueJournal:
+    """
+    Per-guild queue persistence as an append-only log of operations, compacted into a snapshot every
+    QUEUE_JOURNAL_COMPACT_OPS operations. Each entry carries a sequence number and the snapshot records the
+    last one it includes, so a crash between writing the snapshot and dropping the old entries replays
+    nothing twice. The storage backend decides where entries and snapshots live.
+    """
+    def __init__(self, backend: StorageBackend, flush_seconds: float, compact_ops: int):
+        self.backend = backend; self.flush_seconds = flush_seconds; self.compact_ops = compact_ops
+        self._seq: Dict[int, int] = {}
+        self._ops_since_snapshot: Dict[int, int] = {}
+        self._pending: Dict[int, List[Tuple[int, str]]] = {} # guild_id -> serialized entries not yet stored
+        self._compact: Dict[int, List[Dict[str, Any]]] = {} # guild_id -> live queue to snapshot on the next flush
+        self._timer: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.stats = {"ops": 0, "bytes": 0, "compactions": 0, "recovered_ops": 0}
+
+    @staticmethod
+    def _storable(op: Dict[str, Any]) -> Dict[str, Any]:
+        strip = lambda song: {k: v for k, v in song.items() if k != 'play_start_utc'} # Runtime-only state
+        if "song" in op: op = {**op, "song": strip(op["song"])}
+        if "songs" in op: op = {**op, "songs": [strip(song) for song in op["songs"]]}
+        return op
+
+    def record(self, guild_id: int, op: Dict[str, Any], queue: List[Dict[str, Any]]):
+        # Serialized now, so later in-place edits of the song dicts don't leak into this entry
+        if guild_id not in self._seq: # Stored queue never loaded (or unreadable): leave it alone rather than replace or extend it with clashing seqs
+            print(f"DEBUG QUEUE JOURNAL: Not journaling '{op['op']}' for guild {guild_id}; its stored queue was not loaded."); return
+        seq = self._seq[guild_id] + 1; self._seq[guild_id] = seq
+        line = json.dumps({"seq": seq, **self._storable(op)}, default=str)
+        self._pending.setdefault(guild_id, []).append((seq, line)); self.stats["ops"] += 1
+        self._ops_since_snapshot[guild_id] = self._ops_since_snapshot.get(guild_id, 0) + 1
+        if self._ops_since_snapshot[guild_id] >= self.compact_ops: self._compact[guild_id] = queue
+        if self._timer is None or self._timer.done(): self._timer = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_seconds)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            # Taken without yielding, so every recorded op is either in these entries or in the snapshot below
+            work = []
+            for guild_id in set(self._pending) | set(self._compact):
+                entries = self._pending.pop(guild_id, [])
+                queue = self._compact.pop(guild_id, None)
+                snapshot = None
+                if queue is not None:
+                    snapshot = (self._seq[guild_id], [self._storable({"song": song})["song"] for song in queue])
+                    self._ops_since_snapshot[guild_id] = 0
+                work.append((guild_id, entries, snapshot))
+            if work: await asyncio.to_thread(self._write_all, work)
+
+    def _write_all(self, work: List[Tuple[int, List[Tuple[int, str]], Optional[Tuple[int, List[Dict[str, Any]]]]]]):
+        for guild_id, entries, snapshot in work:
+            try:
+                if snapshot is not None: self.backend.write_queue_snapshot(guild_id, *snapshot); self.stats["compactions"] += 1
+                elif entries: self.backend.append_queue_ops(guild_id, entries); self.stats["bytes"] += sum(len(line) + 1 for _, line in entries)
+            except Exception as e: print(f"Error writing queue journal for guild {guild_id}: {e}")
+
+    def load(self, guild_id: int) -> Optional[List[Dict[str, Any]]]:
+        """Blocking; run it in a thread. Snapshot + replayed journal, or None when nothing is stored for the guild."""
+        stored = self.backend.read_queue(guild_id)
+        if stored is None: self._seq.setdefault(guild_id, 0); return None
+        seq, queue, replayed = replay_queue_ops(*stored)
+        self._seq[guild_id] = seq; self._ops_since_snapshot[guild_id] = replayed; self.stats["recovered_ops"] += replayed
+        if replayed: print(f"DEBUG QUEUE JOURNAL: Recovered queue for guild {guild_id}: {len(queue)} songs, {replayed} ops replayed.")
+        return queue
+
+    def forget(self, guild_id: int) -> bool:
+        # Drops per-guild counters of an evicted guild; the next load() restores them from storage
+        if guild_id in self._pending or guild_id in self._compact: return False
+        self._seq.pop(guild_id, None); self._ops_since_snapshot.pop(guild_id, None)
+        return True
+
+    async def close(self):
+        if self._timer and not self._timer.done(): self._timer.cancel()
+        self._timer = None
+        await self.flush()
+
+    def summary(self) -> str:
+        return f"queue journal: {self.stats['ops']} ops, {self.stats['bytes'] / 1024:.0f} KB appended · {self.stats['compactions']} compactions · {self.stats['recovered_ops']} replayed at startup"
+
+queue_journal = QueueJournal(storage, QUEUE_JOURNAL_FLUSH_SECONDS, QUEUE_JOURNAL_COMPACT_OPS)
+
+# --- LOUDNESS MEASUREMENTS ---
+class LoudnessStore:
+    """
+    Integrated loudness / true peak per track (keyed by normalized URL), measured once by a background
+    ffmpeg loudnorm analysis pass. Measured tracks are normalized with a cheap static gain instead of
+    running the dynamic single-pass loudnorm filter for the whole stream.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._measurements: Dict[str, Dict[str, float]] = {}
+        self._in_progress: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def load(self):
+        """Blocking; run it in a thread."""
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, "r") as f: self._measurements = json.load(f)
+            print(f"Loaded {len(self._measurements)} loudness measurements.")
+        except Exception as e: print(f"Error loading loudness measurements: {e}")
+
+    def _save(self, snapshot: Dict[str, Dict[str, float]]):
+        try: write_json_atomic(self.path, snapshot)
+        except Exception as e: print(f"Error saving loudness measurements: {e}")
+
+    def get(self, url: str) -> Optional[Dict[str, float]]:
+        return self._measurements.get(normalize_track_url(url)) if url else None
+
+    def static_gain_filter(self, url: str) -> Optional[str]:
+        measurement = self.get(url)
+        if not measurement: return None
+        gain_db = LOUDNESS_TARGET_LUFS - measurement["i"]
+        gain_db = min(gain_db, LOUDNESS_TRUE_PEAK_LIMIT - measurement["tp"], LOUDNESS_MAX_GAIN_DB) # Don't push the peak into clipping
+        return f"volume={gain_db:.2f}dB"
+
+    def apply_to_filters(self, filters: str, url: str) -> str:
+        """Swaps the dynamic loudnorm step of a filter chain for the track's static gain, if it has been measured."""
+        if LOUDNESS_NORMALIZATION_FILTER not in filters.split(","): return filters
+        gain_filter = self.static_gain_filter(url)
+        if not gain_filter: return filters
+        return ",".join(gain_filter if part == LOUDNESS_NORMALIZATION_FILTER else part for part in filters.split(","))
+
+    def needs_analysis(self, song: Dict[str, Any]) -> bool:
+        duration = song.get('duration')
+        return bool(song.get('webpage_url')) and bool(song.get('stream_url')) and not song.get('is_live_stream') and \
+               isinstance(duration, (int, float)) and 0 < duration <= LOUDNESS_ANALYSIS_MAX_DURATION and \
+               normalize_track_url(song['webpage_url']) not in self._measurements and normalize_track_url(song['webpage_url']) not in self._in_progress
+
+    async def analyze(self, webpage_url: str, stream_url: str):
+        key = normalize_track_url(webpage_url); self._in_progress.add(key)
+        if self._semaphore is None: self._semaphore = asyncio.Semaphore(LOUDNESS_ANALYSIS_CONCURRENCY)
+        try:
+            async with self._semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", *ffmpeg_before_options_for(stream_url).split(), "-i", stream_url, "-vn", "-threads", "1",
+                    "-af", f"{LOUDNESS_NORMALIZATION_FILTER}:print_format=json", "-f", "null", "-",
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            report_match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", stderr.decode("utf-8", errors="replace"))
+            if process.returncode != 0 or not report_match:
+                print(f"DEBUG LOUDNESS: Analysis failed for {webpage_url} (exit {process.returncode})"); return
+            report = json.loads(report_match.group(0))
+            measurement = {"i": float(report["input_i"]), "tp": float(report["input_tp"]), "lra": float(report["input_lra"]), "measured_at": time.time()}
+            if measurement["i"] == float("-inf") or measurement["i"] < -70: return # Silence; keep the live filter
+            self._measurements[key] = measurement
+            print(f"DEBUG LOUDNESS: Measured {webpage_url}: {measurement['i']:.1f} LUFS, {measurement['tp']:.1f} dBTP")
+            await asyncio.to_thread(self._save, dict(self._measurements))
+        except FileNotFoundError: print("DEBUG LOUDNESS: ffmpeg not found; skipping loudness analysis.")
+        except Exception as e: print(f"Error analyzing loudness for {webpage_url}: {e}")
+        finally: self._in_progress.discard(key)
+
+loudness_store = LoudnessStore(LOUDNESS_DB_FILE)
+
+# --- AUDIO FILE CACHE ---
+def is_remote_input(input_url: Optional[str]) -> bool: return bool(input_url) and input_url.startswith(("http://", "https://"))
+
+def ffmpeg_before_options_for(input_url: Optional[str]) -> str:
+    return DEFAULT_FFMPEG_BEFORE_OPTIONS if input_url is None or is_remote_input(input_url) else LOCAL_FFMPEG_BEFORE_OPTIONS
+
+class AudioFileCache:
+    """
+    On-disk copies of frequently played tracks, keyed by normalized URL. Audio is stream-copied (no re-encode) into
+    Matroska by a background ffmpeg once a track has been played AUDIO_CACHE_ADMIT_AFTER_PLAYS times. When the
+    byte budget is exceeded, entries are evicted by recency boosted by their play count.
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir; self.max_bytes = max_bytes
+        self._entries: Dict[str, Dict[str, Any]] = {} # key -> {"file", "bytes", "acodec", "plays", "last_used"}
+        self._play_counts: "OrderedDict[str, int]" = OrderedDict() # Plays of tracks not cached (yet)
+        self._downloading: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._index_dirty = False; self._save_task: Optional[asyncio.Task] = None
+        self._save_lock: Optional[asyncio.Lock] = None # Play-count saves and post-download saves never write the index at the same time
+        self.stats = {"hits": 0, "misses": 0, "downloads": 0, "download_failures": 0, "evictions": 0}
+
+    @property
+    def total_bytes(self) -> int: return sum(entry["bytes"] for entry in self._entries.values())
+
+    def load(self):
+        """Blocking; run it in a thread. Drops index entries whose file is gone and leftover partial downloads."""
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "r") as f: data = json.load(f)
+                self._entries = {k: v for k, v in data.get("entries", {}).items() if os.path.exists(os.path.join(self.cache_dir, v["file"]))}
+                self._play_counts = OrderedDict(data.get("play_counts", {}))
+                print(f"Loaded audio cache index: {len(self._entries)} tracks, {self.total_bytes / 1024 ** 2:.0f} MB.")
+            except Exception as e: print(f"Error loading audio cache index: {e}")
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".part"):
+                try: os.remove(os.path.join(self.cache_dir, filename))
+                except OSError: pass
+
+    def _save(self, snapshot: Dict[str, Any]) -> bool:
+        try: write_json_atomic(os.path.join(self.cache_dir, self.INDEX_FILE), snapshot); return True
+        except Exception as e: print(f"Error saving audio cache index: {e}"); return False
+
+    def _mark_index_dirty(self):
+        # Play counts and recency are written behind, at most once per AUDIO_CACHE_INDEX_SAVE_SECONDS
+        self._index_dirty = True
+        if self._save_task is None or self._save_task.done(): self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(AUDIO_CACHE_INDEX_SAVE_SECONDS)
+        self._save_task = None
+        await self.save_index()
+
+    async def save_index(self):
+        if self._save_lock is None: self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            if not self._index_dirty: return
+            self._index_dirty = False; snapshot = self._snapshot() # Taken on the event loop; marks arriving during the write set the flag again
+            if not await asyncio.to_thread(self._save, snapshot): self._index_dirty = True # Retried with the next mark or at close
+
+    async def close(self):
+        if self._save_task and not self._save_task.done(): self._save_task.cancel()
+        self._save_task = None
+        await self.save_index()
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {"entries": {k: dict(v) for k, v in self._entries.items()}, "play_counts": dict(self._play_counts)}
+
+    def _entry_for(self, song: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        if not AUDIO_CACHE_ENABLED or not song.get('webpage_url') or song.get('is_live_stream'): return None, None
+        key = normalize_track_url(song['webpage_url'])
+        return key, self._entries.get(key)
+
+    def contains(self, song: Dict[str, Any]) -> bool: return self._entry_for(song)[1] is not None
+
+    def lookup(self, song: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """{'path', 'acodec'} of the local copy, or None."""
+        key, entry = self._entry_for(song)
+        if not entry: return None
+        path = os.path.join(self.cache_dir, entry["file"])
+        if not os.path.exists(path): self._entries.pop(key, None); return None
+        return {"path": path, "acodec": entry.get("acodec")}
+
+    def record_play(self, song: Dict[str, Any]) -> bool:
+        """Counts a play (hit or miss). True when the track just qualified for a background download."""
+        key, entry = self._entry_for(song)
+        if not key: return False
+        self._mark_index_dirty()
+        if entry:
+            entry["plays"] += 1; entry["last_used"] = time.time(); self.stats["hits"] += 1
+            return False
+        self.stats["misses"] += 1
+        plays = self._play_counts.pop(key, 0) + 1; self._play_counts[key] = plays
+        while len(self._play_counts) > AUDIO_CACHE_TRACKED_PLAYS: self._play_counts.popitem(last=False)
+        duration = song.get('duration')
+        return plays >= AUDIO_CACHE_ADMIT_AFTER_PLAYS and key not in self._downloading and \
+               isinstance(duration, (int, float)) and 0 < duration <= AUDIO_CACHE_MAX_DURATION
+
+    def _evict_over_budget(self, keep: str) -> List[str]:
+        # Lowest (last_used + plays * weight) goes first: LRU, with frequently played tracks surviving longer
+        evicted_files = []; total = self.total_bytes
+        candidates = sorted((k for k in self._entries if k != keep), key=lambda k: self._entries[k]["last_used"] + self._entries[k]["plays"] * AUDIO_CACHE_PLAY_WEIGHT_SECONDS)
+        for key in candidates:
+            if total <= self.max_bytes: break
+            entry = self._entries.pop(key); total -= entry["bytes"]; evicted_files.append(entry["file"]); self.stats["evictions"] += 1
+        return evicted_files
+
+    def _remove_files(self, filenames: List[str]):
+        for filename in filenames:
+            try: os.remove(os.path.join(self.cache_dir, filename))
+            except OSError: pass
+
+    async def download(self, song: Dict[str, Any], stream_url: str):
+        key, entry = self._entry_for(song)
+        if not key or entry or key in self._downloading: return
+        self._downloading.add(key)
+        filename = f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.mka"
+        path = os.path.join(self.cache_dir, filename); part_path = f"{path}.part"
+        if self._semaphore is None: self._semaphore = asyncio.Semaphore(AUDIO_CACHE_DOWNLOAD_CONCURRENCY)
+        try:
+            async with self._semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", *DEFAULT_FFMPEG_BEFORE_OPTIONS.split(), "-y", "-i", stream_url, "-vn", "-c:a", "copy", "-f", "matroska", part_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+                await process.wait()
+            size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if process.returncode != 0 or not size or size > self.max_bytes:
+                self.stats["download_failures"] += 1
+                print(f"DEBUG AUDIO CACHE: Download failed for {song.get('webpage_url')} (exit {process.returncode}, {size} bytes)"); return
+            await asyncio.to_thread(os.replace, part_path, path)
+            self._entries[key] = {"file": filename, "bytes": size, "acodec": song.get('stream_acodec'), "plays": self._play_counts.pop(key, 0), "last_used": time.time()}
+            self.stats["downloads"] += 1
+            evicted_files = self._evict_over_budget(keep=key)
+            print(f"DEBUG AUDIO CACHE: Cached '{song.get('title')}' ({size / 1024 ** 2:.1f} MB); evicted {len(evicted_files)}. Total {self.total_bytes / 1024 ** 2:.0f} MB.")
+            self._mark_index_dirty()
+            if evicted_files: await asyncio.to_thread(self._remove_files, evicted_files)
+            await self.save_index() # New entries are worth persisting right away
+        except FileNotFoundError: print("DEBUG AUDIO CACHE: ffmpeg not found; not caching audio.")
+        except Exception as e: print(f"Error caching audio for {song.get('webpage_url')}: {e}")
+        finally:
+            self._downloading.discard(key)
+            if os.path.exists(part_path): await asyncio.to_thread(self._remove_files, [os.path.basename(part_path)])
+
+    def summary(self) -> str:
+        plays = self.stats["hits"] + self.stats["misses"]
+        hit_rate = f"{self.stats['hits'] / plays:.0%}" if plays else "n/a"
+        return (f"{len(self._entries)} tracks, {self.total_bytes / 1024 ** 2:.0f}/{self.max_bytes / 1024 ** 2:.0f} MB · hit rate {hit_rate} ({self.stats['hits']}/{plays})\n"
+                f"{self.stats['downloads']} downloads, {self.stats['download_failures']} failed, {self.stats['evictions']} evictions")
+
+audio_cache = AudioFileCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+# --- IN-PROCESS DSP ---
+DSP_SAMPLE_RATE = 48000
+DSP_FRAME_SAMPLES = 960 # 20 ms of 48 kHz stereo s16le, i.e. one discord.py audio frame
+DSP_FFT_SIZE = 2048 # >= DSP_FRAME_SAMPLES + DSP_FIR_TAPS - 1
+DSP_FILTER_PATTERNS = [ # FFmpeg filters the DSP stage implements itself, matched against whole filter-chain entries
+    ("bass", re.compile(r"bass=g=(-?\d+(?:\.\d+)?)")),
+    ("treble", re.compile(r"treble=g=(-?\d+(?:\.\d+)?)")),
+    ("equalizer", re.compile(r"equalizer=f=(\d+(?:\.\d+)?):width_type=h:width=(\d+(?:\.\d+)?):g=(-?\d+(?:\.\d+)?)")),
+    ("karaoke", re.compile(r"stereotools=mlev=(\d+(?:\.\d+)?)")),
+    ("echo", re.compile(r"aecho=(\d+(?:\.\d+)?):(\d+(?:\.\d+)?):(\d+(?:\.\d+)?):(\d+(?:\.\d+)?)")),
+]
+
+def _absorb_dsp_filter(part: str, dsp_spec: Dict[str, Any]) -> bool:
+    # Folds one filter-chain entry into dsp_spec; False means FFmpeg has to keep running it
+    for kind, pattern in DSP_FILTER_PATTERNS:
+        match = pattern.fullmatch(part)
+        if not match: continue
+        values = [float(g) for g in match.groups()]
+        if kind == "bass": dsp_spec["bass_db"] += values[0]
+        elif kind == "treble": dsp_spec["treble_db"] += values[0]
+        elif kind == "equalizer": dsp_spec["peaks"].append(tuple(values))
+        elif kind == "karaoke": dsp_spec["karaoke_mid_level"] = values[0]
+        elif kind == "echo":
+            if dsp_spec["echo"] is not None or values[2] > 2000: return False # One echo line up to 2 s in-process; anything else stays in FFmpeg
+            dsp_spec["echo"] = tuple(values)
+        return True
+    return False
+
+def split_filters_for_dsp(filters: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Splits an FFmpeg -af chain into (filters FFmpeg still has to run, DSP parameters). Without numpy
+    (or with DSP_ENABLED off) everything stays in FFmpeg.
+    """
+    dsp_spec: Dict[str, Any] = {"bass_db": 0.0, "treble_db": 0.0, "peaks": [], "karaoke_mid_level": None, "echo": None, "echo_makeup": False}
+    if np is None or not DSP_ENABLED or not filters: return filters, dsp_spec
+    ffmpeg_parts = []
+    for part in filters.split(","):
+        if _absorb_dsp_filter(part.strip(), dsp_spec): continue
+        ffmpeg_parts.append(part)
+        # The echo now runs after this normalization instead of ahead of it, so it must not take aecho's gains off the normalized level
+        if "loudnorm" in part and dsp_spec["echo"] is not None: dsp_spec["echo_makeup"] = True
+    return ",".join(ffmpeg_parts), dsp_spec
+
+class CompiledDSP:
+    """Immutable, precomputed processing parameters. A new instance is built per effect change and swapped in whole."""
+    def __init__(self, spec: Dict[str, Any]):
+        self.spec = spec
+        self.fir_spectrum = None
+        if spec["bass_db"] or spec["treble_db"] or spec["peaks"]:
+            freqs = np.fft.rfftfreq(DSP_FIR_TAPS + 1, 1.0 / DSP_SAMPLE_RATE)
+            gain_db = np.zeros_like(freqs)
+            if spec["bass_db"]: gain_db += spec["bass_db"] / (1.0 + (freqs / 100.0) ** 2) # Low shelf around 100 Hz (FFmpeg bass default)
+            if spec["treble_db"]: gain_db += spec["treble_db"] * (freqs / 3000.0) ** 2 / (1.0 + (freqs / 3000.0) ** 2) # High shelf around 3 kHz
+            for center, width, peak_db in spec["peaks"]: gain_db += peak_db * np.exp(-0.5 * ((freqs - center) / (width / 2.355)) ** 2)
+            impulse = np.roll(np.fft.irfft(10.0 ** (gain_db / 20.0), n=DSP_FIR_TAPS + 1), DSP_FIR_TAPS // 2)[:DSP_FIR_TAPS]
+            impulse *= np.hanning(DSP_FIR_TAPS) # Linear-phase FIR, ~10 ms latency
+            self.fir_spectrum = np.fft.rfft(impulse, n=DSP_FFT_SIZE).astype(np.complex64)[:, None]
+        self.karaoke_mid_level = spec["karaoke_mid_level"]
+        self.echo = None
+        if spec["echo"]:
+            in_gain, out_gain, delay_ms, decay = spec["echo"]
+            if spec["echo_makeup"]: out_gain = 1.0 / in_gain # Scales the whole echo by 1/(in_gain*out_gain): the dry signal stays at the loudnorm target
+            self.echo = (in_gain, out_gain, max(1, int(DSP_SAMPLE_RATE * delay_ms / 1000.0)), decay)
+        self.is_identity = self.fir_spectrum is None and self.karaoke_mid_level is None and self.echo is None
+
+class EffectsDSPSource(discord.AudioSource):
+    """
+    Runs between the PCM decoder and the volume/Opus stages, processing each 20 ms frame with NumPy.
+    set_effects() swaps the compiled parameters in one attribute assignment, so a change lands on the
+    next frame without touching FFmpeg.
+    """
+    def __init__(self, original: discord.AudioSource, ffmpeg_filters: str, dsp_spec: Dict[str, Any]):
+        self.original = original
+        self.ffmpeg_filters = ffmpeg_filters # The -af chain the wrapped FFmpeg process was started with
+        self._compiled = CompiledDSP(dsp_spec)
+        self._ola_buffer = np.zeros((DSP_FFT_SIZE, 2), dtype=np.float32) # Overlap-add accumulator for the FIR
+        self._echo_history = np.zeros((2 * DSP_SAMPLE_RATE + DSP_FRAME_SAMPLES, 2), dtype=np.float32) # Ring buffer of dry input
+        self._echo_pos = 0
+
+    def set_effects(self, dsp_spec: Dict[str, Any]):
+        self._compiled = CompiledDSP(dsp_spec)
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        compiled = self._compiled # One read per frame: a concurrent swap applies from the next frame
+        if not data or compiled.is_identity: return data
+        frame_count = len(data) // 4
+        samples = np.frombuffer(data, dtype=np.int16, count=frame_count * 2).reshape(-1, 2).astype(np.float32)
+        if compiled.echo:
+            in_gain, out_gain, delay, decay = compiled.echo; history = self._echo_history; size = len(history)
+            write_idx = (self._echo_pos + np.arange(frame_count)) % size
+            history[write_idx] = samples
+            delayed = history[(write_idx - delay) % size]
+            self._echo_pos = (self._echo_pos + frame_count) % size
+            samples = (samples * in_gain + delayed * decay) * out_gain # Same weighting as FFmpeg aecho: the delayed input is scaled by decay alone
+        if compiled.fir_spectrum is not None:
+            filtered = np.fft.irfft(np.fft.rfft(samples, n=DSP_FFT_SIZE, axis=0) * compiled.fir_spectrum, n=DSP_FFT_SIZE, axis=0)
+            self._ola_buffer += filtered
+            samples = self._ola_buffer[:frame_count].copy()
+            self._ola_buffer[:-frame_count] = self._ola_buffer[frame_count:]; self._ola_buffer[-frame_count:] = 0.0
+        if compiled.karaoke_mid_level is not None:
+            mid = (samples[:, 0] + samples[:, 1]) * (0.5 * compiled.karaoke_mid_level); side = (samples[:, 0] - samples[:, 1]) * 0.5
+            samples = np.stack((mid + side, mid - side), axis=1)
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+    def is_opus(self) -> bool: return False
+    def cleanup(self): self.original.cleanup()
+
+class VolumeLimiterSource(discord.AudioSource):
+    """
+    NumPy replacement for discord.PCMVolumeTransformer (which needs audioop, gone in Python 3.13).
+    At a steady volume each frame is one lookup through a 64K-entry int16 table with the gain and the
+    soft limiter baked in; after a change the next frame ramps linearly between the two gains. All
+    per-frame work happens in preallocated buffers.
+    """
+    def __init__(self, original: discord.AudioSource, volume: float = 1.0):
+        if original.is_opus(): raise discord.ClientException('AudioSource must not be Opus encoded.')
+        self.original = original
+        self._threshold = VOLUME_LIMITER_THRESHOLD * 32767.0
+        self._knee = 32767.0 - self._threshold
+        samples = DSP_FRAME_SAMPLES * 2
+        self._work = np.empty(samples, dtype=np.float32)
+        self._scratch = np.empty(samples, dtype=np.float32)
+        self._sign = np.empty(samples, dtype=np.float32)
+        self._ramp = np.empty(samples, dtype=np.float32)
+        self._ramp_shape = np.repeat(np.arange(1, DSP_FRAME_SAMPLES + 1, dtype=np.float32) / DSP_FRAME_SAMPLES, 2) # 0 -> 1 over one frame, per interleaved sample
+        self._out = np.empty(samples, dtype=np.int16)
+        self._gain_table = self._build_gain_table(volume) # (gain, lookup table), replaced as one object
+        self._current_gain = self._gain_table[0]
+
+    @property
+    def volume(self) -> float: return self._gain_table[0]
+
+    @volume.setter
+    def volume(self, value: float): self._gain_table = self._build_gain_table(value)
+
+    def _build_gain_table(self, volume: float) -> Tuple[float, Any]:
+        gain = max(float(volume), 0.0)
+        # Indexed by the raw uint16 bit pattern of each int16 sample
+        table = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32) * gain
+        self._soft_limit(table, np.empty_like(table), np.empty_like(table))
+        return gain, np.clip(table, -32768.0, 32767.0).astype(np.int16)
+
+    def _soft_limit(self, work, excess, sign):
+        # Past the knee |x| becomes threshold + knee * tanh(excess / knee), which never reaches full scale
+        if not VOLUME_SOFT_LIMITER: return
+        np.abs(work, out=excess); excess -= self._threshold; np.maximum(excess, 0.0, out=excess)
+        np.divide(excess, self._knee, out=sign); np.tanh(sign, out=sign); sign *= self._knee
+        excess -= sign; np.sign(work, out=sign); excess *= sign
+        work -= excess
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        target, table = self._gain_table; start = self._current_gain
+        if not data or (target == 1.0 and start == 1.0): return data # Unity gain can't exceed int16 range
+        n = min(len(data) // 2, len(self._out))
+        out = self._out[:n]
+        if target == start:
+            np.take(table, np.frombuffer(data, dtype=np.uint16, count=n), out=out)
+            return out.tobytes()
+        work = self._work[:n]; ramp = self._ramp[:n]
+        np.multiply(self._ramp_shape[:n], target - start, out=ramp); ramp += start
+        np.multiply(np.frombuffer(data, dtype=np.int16, count=n), ramp, out=work)
+        self._soft_limit(work, self._scratch[:n], self._sign[:n])
+        np.clip(work, -32768.0, 32767.0, out=work); np.copyto(out, work, casting='unsafe')
+        self._current_gain = target
+        return out.tobytes()
+
+    def is_opus(self) -> bool: return False
+    def cleanup(self): self.original.cleanup()
+
+VOLUME_SOURCE_TYPES = (discord.PCMVolumeTransformer, VolumeLimiterSource)
+
+def make_volume_source(source: discord.AudioSource, volume: float) -> discord.AudioSource:
+    # NumPy stage when available; PCMVolumeTransformer (audioop) otherwise
+    return VolumeLimiterSource(source, volume) if np is not None else discord.PCMVolumeTransformer(source, volume=volume)
+
+# --- PLAYBACK BUFFERING ---
+class _FrameCountingMixin:
+    """Counts the 20 ms frames an FFmpeg source produced and whether it ended on its own, to tell an early exit from a track's real end."""
+    frames_read = 0
+    reached_eof = False
+    _stopping = False
+
+    def read(self) -> bytes:
+        data = super().read()
+        if data: self.frames_read += 1
+        elif not self._stopping: self.reached_eof = True # EOF caused by our own cleanup (vc.stop) doesn't count
+        return data
+
+    def cleanup(self):
+        self._stopping = True
+        super().cleanup()
+
+class TrackedFFmpegPCMAudio(_FrameCountingMixin, discord.FFmpegPCMAudio): pass
+class TrackedFFmpegOpusAudio(_FrameCountingMixin, discord.FFmpegOpusAudio): pass
+
+def find_tracked_decoder(source: Optional[discord.AudioSource]) -> Optional[discord.AudioSource]:
+    # Unwraps buffering/prebuffer stages down to the FFmpeg process
+    while source is not None and not isinstance(source, _FrameCountingMixin): source = getattr(source, 'original', None)
+    return source
+
+class JitterBufferSource(discord.AudioSource):
+    """
+    Read-ahead between the FFmpeg pipe and the voice sender. A reader thread keeps up to JITTER_BUFFER_SECONDS
+    of 20 ms frames in a preallocated ring, so upstream stalls (e.g. -reconnect) drain the ring instead of
+    stalling the audio thread. On an empty ring mid-track, read() returns silence and counts an underrun;
+    when drop_when_full is set (live streams), the oldest frame is dropped on a full ring and counted as an overrun.
+    """
+    FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE
+    SILENCE = bytes(FRAME_BYTES)
+
+    def __init__(self, original: discord.AudioSource, stats: Dict[str, float], drop_when_full: bool = False):
+        self.original = original
+        self.stats = stats
+        self._drop_when_full = drop_when_full
+        self._capacity = max(2, int(JITTER_BUFFER_SECONDS / 0.02))
+        self._ring = bytearray(self._capacity * self.FRAME_BYTES)
+        self._lengths = [0] * self._capacity # Bytes stored per slot; the last frame of a track may be short
+        self._head = 0; self._count = 0 # Next slot to read / frames stored
+        self._cond = threading.Condition()
+        self._eof = False; self._closed = False; self._started = False
+        self._reader = threading.Thread(target=self._fill, name="jitter-buffer-reader", daemon=True)
+        self._reader.start()
+
+    def _fill(self):
+        ring_view = memoryview(self._ring)
+        try:
+            while not self._closed:
+                data = self.original.read()
+                if not data: break
+                with self._cond:
+                    while self._count == self._capacity and not self._closed:
+                        if self._drop_when_full:
+                            self._head = (self._head + 1) % self._capacity; self._count -= 1; self.stats["overruns"] += 1
+                        else: self._cond.wait(0.1)
+                    if self._closed: break
+                    slot = (self._head + self._count) % self._capacity; length = min(len(data), self.FRAME_BYTES)
+                    ring_view[slot * self.FRAME_BYTES:slot * self.FRAME_BYTES + length] = data[:length]
+                    self._lengths[slot] = length; self._count += 1; self._started = True
+                    self._cond.notify_all()
+        except Exception as e: print(f"ERROR JITTER: Reader stopped: {type(e).__name__} - {e}")
+        finally:
+            with self._cond: self._eof = True; self._cond.notify_all()
+
+    @property
+    def ready(self) -> bool: return self._started
+
+    def wait_ready(self, frames: int, timeout: float) -> bool:
+        # Blocks until `frames` are buffered, the decoder ended, or timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._count < min(frames, self._capacity) and not self._eof and time.monotonic() < deadline: self._cond.wait(0.05)
+            return self._started
+
+    def read(self) -> bytes:
+        with self._cond:
+            if not self._started and not self._eof: # FFmpeg still connecting/probing: block like a direct pipe read would
+                deadline = time.monotonic() + JITTER_STARTUP_TIMEOUT
+                while not self._started and not self._eof and time.monotonic() < deadline: self._cond.wait(0.05)
+            if self._count:
+                offset = self._head * self.FRAME_BYTES; data = bytes(self._ring[offset:offset + self._lengths[self._head]])
+                self._head = (self._head + 1) % self._capacity; self._count -= 1
+                self.stats["buffered_ms"] = self._count * 20.0
+                self._cond.notify_all()
+                return data
+            if self._eof or self._closed: return b''
+        self.stats["underruns"] += 1; self.stats["buffered_ms"] = 0.0
+        return self.SILENCE # Upstream hiccup: keep the voice clock running instead of ending the track
+
+    def is_opus(self) -> bool: return False
+    def cleanup(self):
+        with self._cond: self._closed = True; self._cond.notify_all()
+        self.original.cleanup() # Kills FFmpeg, which unblocks a reader waiting on the pipe
+
+# --- SHARED LIVE STREAMS ---
+class SharedLiveDecoder:
+    """One FFmpeg decode of a live stream. A pump thread hands every frame (the same immutable bytes) to each subscriber's ring."""
+    def __init__(self, key: Tuple[str, str], decoder: discord.AudioSource, hub: 'LiveStreamHub'):
+        self.key = key; self.decoder = decoder; self.hub = hub
+        self.subscribers: List['LiveSubscriberSource'] = []
+        self.lock = threading.Lock()
+        self.ended = False; self._closed = False
+        threading.Thread(target=self._pump, name="live-stream-pump", daemon=True).start()
+
+    def _pump(self):
+        try:
+            while not self._closed:
+                data = self.decoder.read()
+                if not data: break
+                with self.lock: subscribers = list(self.subscribers)
+                for subscriber in subscribers: subscriber._push(data)
+        except Exception as e: print(f"ERROR LIVE HUB: Pump for {self.key[0]} stopped: {type(e).__name__} - {e}")
+        finally:
+            with self.lock: self.ended = True; subscribers = list(self.subscribers) # Atomic with subscribe's check: every subscriber either sees ended or gets _end()
+            for subscriber in subscribers: subscriber._end()
+            self.hub._forget(self)
+
+    def close(self):
+        self._closed = True
+        self.decoder.cleanup()
+
+class LiveSubscriberSource(discord.AudioSource):
+    """A guild's view of a SharedLiveDecoder: its own bounded frame ring, with the same underrun/overrun accounting as JitterBufferSource."""
+    def __init__(self, shared: SharedLiveDecoder, stats: Dict[str, float]):
+        self.shared = shared; self.stats = stats
+        self._frames: deque = deque(maxlen=max(2, int(LIVE_SUBSCRIBER_BUFFER_SECONDS / 0.02)))
+        self._cond = threading.Condition()
+        self._ended = False; self._started = False
+
+    def _push(self, data: bytes):
+        with self._cond:
+            if len(self._frames) == self._frames.maxlen: self.stats["overruns"] += 1 # deque drops the oldest
+            self._frames.append(data); self._started = True
+            self._cond.notify_all()
+
+    def _end(self):
+        with self._cond: self._ended = True; self._cond.notify_all()
+
+    def read(self) -> bytes:
+        with self._cond:
+            if not self._started and not self._ended: # First subscriber waits for FFmpeg to connect; later ones join at the live edge
+                deadline = time.monotonic() + JITTER_STARTUP_TIMEOUT
+                while not self._started and not self._ended and time.monotonic() < deadline: self._cond.wait(0.05)
+            if self._frames:
+                data = self._frames.popleft(); self.stats["buffered_ms"] = len(self._frames) * 20.0
+                return data
+            if self._ended: return b''
+        self.stats["underruns"] += 1; self.stats["buffered_ms"] = 0.0
+        return JitterBufferSource.SILENCE
+
+    def is_opus(self) -> bool: return False
+    def cleanup(self): self.shared.hub.unsubscribe(self)
+
+class LiveStreamHub:
+    """Shares live-stream decodes across guilds, keyed by (normalized stream URL, FFmpeg output options). The decode stops when its last subscriber leaves."""
+    def __init__(self):
+        self._decoders: Dict[Tuple[str, str], SharedLiveDecoder] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key: Tuple[str, str], open_decoder: Callable[[], discord.AudioSource], stats: Dict[str, float]) -> LiveSubscriberSource:
+        with self._lock:
+            while True:
+                shared = self._decoders.get(key)
+                if shared is None or shared.ended:
+                    shared = self._decoders[key] = SharedLiveDecoder(key, open_decoder(), self)
+                    print(f"DEBUG LIVE HUB: Started shared decode for {truncate_text(key[0], 80)}")
+                subscriber = LiveSubscriberSource(shared, stats)
+                with shared.lock:
+                    if shared.ended: continue # Pump finished since the check above; it would never _end() this subscriber
+                    shared.subscribers.append(subscriber); listeners = len(shared.subscribers)
+                break
+        print(f"DEBUG LIVE HUB: Subscriber joined {truncate_text(key[0], 80)} ({listeners} listening)")
+        return subscriber
+
+    def unsubscribe(self, subscriber: LiveSubscriberSource):
+        shared = subscriber.shared
+        with self._lock:
+            with shared.lock:
+                if subscriber in shared.subscribers: shared.subscribers.remove(subscriber)
+                last_one = not shared.subscribers
+            if last_one and self._decoders.get(shared.key) is shared: self._decoders.pop(shared.key)
+        if last_one:
+            print(f"DEBUG LIVE HUB: Last subscriber left {truncate_text(shared.key[0], 80)}; stopping decode.")
+            shared.close()
+
+    def _forget(self, shared: SharedLiveDecoder):
+        with self._lock:
+            if self._decoders.get(shared.key) is shared: self._decoders.pop(shared.key)
+
+    def summary(self) -> str:
+        with self._lock: decoders = list(self._decoders.values())
+        return f"{len(decoders)} live decodes / {sum(len(d.subscribers) for d in decoders)} listeners"
+
+live_stream_hub = LiveStreamHub()
+
+# --- PLAYBACK CLOCK ---
+def playback_speed_for_filters(ffmpeg_filters: str) -> float:
+    # Track seconds per second of output: asetrate=48000*X (resampled back to 48 kHz) and atempo=Y both scale it
+    speed = 1.0
+    for part in (ffmpeg_filters or "").split(","):
+        match = re.fullmatch(r"\s*asetrate=48000\*(\d+(?:\.\d+)?)\s*", part) or re.fullmatch(r"\s*atempo=(\d+(?:\.\d+)?)\s*", part)
+        if match: speed *= float(match.group(1))
+    return speed if speed > 0 else 1.0
+
+class PlaybackClock:
+    """
+    Per-guild position of the current track: segment offset + frames delivered to the voice client x 20 ms x speed.
+    Pauses, jitter-buffer underruns and restarts don't move it. Each track segment (a ClockedTrackSource)
+    claims the clock; frames from a segment that no longer owns it are ignored.
+    """
+    def __init__(self):
+        self.owner: Optional['ClockedTrackSource'] = None
+        self.offset = 0.0; self.speed = 1.0; self.frames = 0
+
+    def claim(self, owner: 'ClockedTrackSource', offset: float, speed: float):
+        self.frames = 0; self.offset = offset; self.speed = speed
+        self.owner = owner # Last, so the new owner's ticks only count after the reset
+
+    def position(self) -> float: return self.offset + self.frames * 0.02 * self.speed
+
+    def wall_seconds_until(self, track_position: float) -> float: return max(0.0, (track_position - self.position()) / self.speed)
+
+class ClockedTrackSource(discord.AudioSource):
+    """Advances the guild's PlaybackClock for every real (non-underrun) frame of one track segment."""
+    def __init__(self, original: discord.AudioSource, clock: PlaybackClock, offset: float, speed: float):
+        self.original = original
+        self.clock = clock; self.offset = offset; self.speed = speed
+        self._claimed = False
+
+    @property
+    def ready(self) -> bool: return getattr(self.original, 'ready', True)
+
+    def claim(self):
+        self.clock.claim(self, self.offset, self.speed); self._claimed = True
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if data and data is not JitterBufferSource.SILENCE:
+            if not self._claimed: self.claim()
+            if self.clock.owner is self: self.clock.frames += 1
+        return data
+
+    def is_opus(self) -> bool: return self.original.is_opus()
+    def cleanup(self): self.original.cleanup()
+
+# --- GAPLESS TRANSITIONS ---
+class PrebufferedSource(discord.AudioSource):
+    """Reads the first frames of a freshly spawned decoder up front, so switching to it later doesn't wait on connect/probe."""
+    def __init__(self, original: discord.AudioSource, frames: int):
+        self.original = original
+        self._buffered = deque()
+        for _ in range(frames):
+            data = original.read()
+            if not data: break
+            self._buffered.append(data)
+
+    @property
+    def ready(self) -> bool: return bool(self._buffered)
+
+    def read(self) -> bytes: return self._buffered.popleft() if self._buffered else self.original.read()
+    def is_opus(self) -> bool: return False
+    def cleanup(self): self.original.cleanup()
+
+_source_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="source-cleanup")
+
+def cleanup_source_in_background(source: discord.AudioSource):
+    # Killing and reaping FFmpeg can block; never do it on the voice sender thread mid-transition
+    def _cleanup():
+        try: source.cleanup()
+        except Exception as e: print(f"DEBUG GAPLESS: Cleanup of finished decoder failed: {e}")
+    _source_cleanup_executor.submit(_cleanup)
+
+class GaplessTrackSource(discord.AudioSource):
+    """
+    Sits directly above the PCM decoder. When the current decoder hits EOF and a prepared one is attached, reading
+    continues from it within the same frame, so the voice player never stops between tracks. With a crossfade
+    configured, both are mixed over the last GAPLESS_CROSSFADE_SECONDS of the known duration instead. The attached
+    next decoder stays owned by the client (detach with clear_next); only the current/outgoing ones are cleaned up here.
+    """
+    def __init__(self, original: discord.AudioSource, ffmpeg_filters: str, on_switch: Callable[[Any], None], remaining_seconds: Optional[float]):
+        self.original = original
+        self.ffmpeg_filters = ffmpeg_filters # Pre-loudness -af chain every decoder in this chain runs with
+        self._on_switch = on_switch # Called with the token from set_next, on the audio thread
+        self._lock = threading.Lock()
+        self._next: Optional[Tuple[discord.AudioSource, Any, Optional[float]]] = None
+        self._outgoing: Optional[discord.AudioSource] = None # Previous decoder while it is being faded out
+        self._fade_frame = 0
+        self._crossfade_frames = int(GAPLESS_CROSSFADE_SECONDS / 0.02) if np is not None else 0
+        self._frames_left = int(remaining_seconds / 0.02) if remaining_seconds else None
+
+    def set_next(self, source: discord.AudioSource, token: Any, remaining_seconds: Optional[float]):
+        with self._lock: self._next = (source, token, remaining_seconds)
+
+    def clear_next(self, token: Any) -> Optional[discord.AudioSource]:
+        # Returns the detached decoder, or None if it was already switched to
+        with self._lock:
+            if self._next and self._next[1] is token:
+                source = self._next[0]; self._next = None
+                return source
+        return None
+
+    def _switch(self, fade: bool):
+        # Lock held by the caller
+        source, token, remaining_seconds = self._next; self._next = None
+        if fade: self._outgoing = self.original; self._fade_frame = 0
+        else: cleanup_source_in_background(self.original) # Only the pointer swap happens on the audio thread
+        self.original = source
+        self._frames_left = int(remaining_seconds / 0.02) if remaining_seconds else None
+        self._on_switch(token)
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self._next and self._crossfade_frames and self._outgoing is None and self._frames_left is not None and self._frames_left <= self._crossfade_frames:
+                self._switch(fade=True)
+            if self._frames_left is not None: self._frames_left -= 1
+        data = self.original.read()
+        if not data:
+            with self._lock:
+                if not self._next or (self._frames_left is not None and self._frames_left > STREAM_RECOVERY_END_TOLERANCE / 0.02):
+                    return data # Real end of the chain, or a stream cut off early; the player's after-callback takes over (and recovers)
+                self._switch(fade=False)
+            data = self.original.read()
+        if self._outgoing is not None: data = self._mix_outgoing(data)
+        return data
+
+    def _mix_outgoing(self, data: bytes) -> bytes:
+        old = self._outgoing.read()
+        self._fade_frame += 1
+        if not old or self._fade_frame >= self._crossfade_frames:
+            cleanup_source_in_background(self._outgoing); self._outgoing = None
+            if not old: return data
+        n = min(len(data), len(old)) // 2
+        t = self._fade_frame / self._crossfade_frames
+        mixed = np.frombuffer(data, dtype=np.int16, count=n).astype(np.float32) * t
+        mixed += np.frombuffer(old, dtype=np.int16, count=n).astype(np.float32) * (1.0 - t)
+        return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes() + data[n * 2:]
+
+    def is_opus(self) -> bool: return False
+    def cleanup(self):
+        with self._lock:
+            if self._outgoing is not None: self._outgoing.cleanup(); self._outgoing = None
+            self.original.cleanup()
+
+async def build_lazy_queue_entry(webpage_url: str, requester: str, known_metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Queue entry that is enqueued without resolving. Its stream URL (and any missing metadata) is filled in
+    by the pre-resolver as it nears the head of the queue, or by _play_guild_queue at the latest.
+    """
+    metadata = dict(known_metadata or {})
+    if not metadata.get('title'): metadata = {**(await track_cache.peek_metadata(webpage_url) or {}), **{k: v for k, v in metadata.items() if v}}
+    entry = {
+        'webpage_url': metadata.get('webpage_url') or webpage_url, 'title': metadata.get('title') or webpage_url,
+        'duration': metadata.get('duration'), 'thumbnail': metadata.get('thumbnail'),
+        'uploader': metadata.get('uploader'), 'requester': requester,
+        'stream_url': None, 'stream_expires_at': None, 'stream_acodec': None
+    }
+    if not metadata.get('title'): entry['needs_metadata'] = True # Title is just the URL until resolved
+    return entry
+
+QUEUE_EXPORT_FIELDS = ('webpage_url', 'title', 'duration', 'uploader', 'thumbnail', 'requester_id')
+
+def queue_entry_content_hash(record: Dict[str, Any]) -> str:
+    """Short hash over an export record's fields; lets import trust metadata that was not edited by hand."""
+    canonical = json.dumps([record.get(k) for k in QUEUE_EXPORT_FIELDS], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+
+def queue_entry_to_export_record(song: Dict[str, Any]) -> Dict[str, Any]:
+    requester_match = re.match(r"<@!?(\d+)>", song.get('requester') or "")
+    record = {'webpage_url': song.get('webpage_url'), 'title': song.get('title'), 'duration': song.get('duration'),
+              'uploader': song.get('uploader'), 'thumbnail': song.get('thumbnail'),
+              'requester_id': int(requester_match.group(1)) if requester_match else None}
+    if song.get('needs_metadata'): record['title'] = None # Placeholder title is just the URL
+    record['hash'] = queue_entry_content_hash(record)
+    return record
+
+def write_queue_export_file(songs: List[Dict[str, Any]], guild_name: str) -> str:
+    """
+    Writes a JSON Lines export (header line, then one record per song) to a temp file line by line and
+    returns its path. Blocking; run it in a thread. The caller deletes the file once it is sent.
+    """
+    header = {"format": QUEUE_EXPORT_FORMAT, "version": QUEUE_EXPORT_VERSION, "guild": guild_name,
+              "exported_at": datetime.datetime.now(timezone.utc).isoformat(), "count": sum(1 for s in songs if s.get('webpage_url'))}
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl", delete=False) as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for song in songs:
+            if song.get('webpage_url'): f.write(json.dumps(queue_entry_to_export_record(song), ensure_ascii=False) + "\n")
+        return f.name
+
 async def fetch_lyrics(song_title: str, artist_name: Optional[str] = None) -> Optional[str]:
     search_artist = artist_name if artist_name else ""
     query_artist = re.sub(r'[^\w\s-]', '', search_artist).strip().replace(' ', '%20')
@@ -990,18 +3050,14 @@ async def fetch_lyrics(song_title: str, artist_name: Optional[str] = None) -> Op
         except Exception as e: print(f"Error fetching lyrics (fallback): {e}"); return f"Could not fetch lyrics: Error. ({type(e).__name__})"
     return "Lyrics not found."
 
-def load_user_playlists(user_id: int) -> Dict[str, List[Dict[str, Any]]]:
-    playlist_path = client.get_user_playlist_path(user_id)
-    if os.path.exists(playlist_path):
-        try:
-            with open(playlist_path, "r") as f: return json.load(f)
-        except Exception as e: print(f"Error loading playlists for user {user_id}: {e}")
+async def load_user_playlists(user_id: int) -> Dict[str, List[Dict[str, Any]]]:
+    # Off the event loop: the backend may be busy (its lock held) with a large snapshot write
+    try: return await asyncio.to_thread(storage.load_user_playlists, user_id) # Single indexed lookup (SQLite) or one small file (JSON)
+    except Exception as e: print(f"Error loading playlists for user {user_id}: {e}")
     return {}
 
-def save_user_playlists(user_id: int, playlists_data: Dict[str, List[Dict[str, Any]]]):
-    playlist_path = client.get_user_playlist_path(user_id)
-    try:
-        with open(playlist_path, "w") as f: json.dump(playlists_data, f, indent=4)
+async def save_user_playlists(user_id: int, playlists_data: Dict[str, List[Dict[str, Any]]]):
+    try: await asyncio.to_thread(storage.save_user_playlists, user_id, playlists_data)
     except Exception as e: print(f"Error saving playlists for user {user_id}: {e}")
 
 # --- Response Helper ---
@@ -1065,7 +3121,13 @@ async def send_custom_response(
         else: print(f"Warning: Attempted to send response for text command but channel was None or not Messageable. Guild: {context.guild.id if context.guild else 'N/A'}")
 
 # --- UI VIEWS ---
-class SearchResultsView(discord.ui.View):
+class GuildStateView(discord.ui.View):
+    # Component callbacks bypass the command tree's hook; load the guild's state first like MusicCommandTree does
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.guild_id: await interaction.client.ensure_guild_loaded(interaction.guild_id)
+        return True
+
+class SearchResultsView(GuildStateView):
     def __init__(self, 
                  interaction: discord.Interaction, 
                  results: List[Dict[str, Any]], 
@@ -1201,7 +3263,7 @@ class SearchResultButton(discord.ui.Button):
         
         view.stop()
 
-class QueueView(discord.ui.View):
+class QueueView(GuildStateView):
     def __init__(self, interaction_or_ctx: Union[discord.Interaction, commands.Context], guild_id: int, current_page: int = 0, songs_per_page: int = 10):
         super().__init__(timeout=180.0)
         self.interaction_or_ctx = interaction_or_ctx
@@ -1279,7 +3341,7 @@ class QueueView(discord.ui.View):
         
         queue = client._queues.get(self.guild_id, [])
         if len(queue) > 1:
-            random.shuffle(queue)
+            client.queue_shuffle(self.guild_id); client.notify_queue_changed(self.guild_id)
             await client.save_guild_settings_to_file(self.guild_id)
             self.current_page = 0 # Reset to first page after shuffle
             self._update_button_states()
@@ -1294,7 +3356,7 @@ class QueueView(discord.ui.View):
         if not client.is_controller(interaction): # Check current interactor
             await interaction.response.send_message(embed=create_error_embed("Only controllers can clear the queue."), ephemeral=True); return
 
-        client._queues[self.guild_id] = []
+        client.queue_clear(self.guild_id); client.notify_queue_changed(self.guild_id)
         await client.save_guild_settings_to_file(self.guild_id)
         self.current_page = 0 # Reset to first page
         self._update_button_states()
@@ -1370,7 +3432,7 @@ async def _display_queue_view_logic(interaction_or_ctx: Union[discord.Interactio
         ephemeral_preference=False # Queue view is usually public
     )
 
-class NowPlayingView(discord.ui.View):
+class NowPlayingView(GuildStateView):
     def __init__(self, guild_id: int, song_requester_mention: str):
         super().__init__(timeout=None) # Persistent while song plays
         self.guild_id = guild_id
@@ -1537,6 +3599,19 @@ class NowPlayingView(discord.ui.View):
         
         await _display_queue_view_logic(interaction) # Make sure this function is accessible
 
+class BulkImportView(GuildStateView):
+    def __init__(self, guild_id: int, requester_id: int):
+        super().__init__(timeout=None)
+        self.guild_id = guild_id; self.requester_id = requester_id
+        self.cancelled = False
+
+    @discord.ui.button(label="Cancel Import", style=discord.ButtonStyle.red, emoji="✖️")
+    async def cancel_import_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.requester_id and not client.is_controller(interaction):
+            await interaction.response.send_message(embed=create_error_embed("Only the person who started the import or a controller can cancel it."), ephemeral=True); return
+        self.cancelled = True; button.disabled = True; button.label = "Cancelling..."
+        await interaction.response.edit_message(view=self)
+
 # --- SLASH COMMAND GROUPS ---
 music_group = app_commands.Group(name="music", description="Music related commands.")
 music_controls_group = app_commands.Group(name="controls", description="Playback controls.", parent=music_group)
@@ -1608,7 +3683,7 @@ async def music_voteskip_slash(interaction: discord.Interaction):
     public_vote_message = await interaction.channel.send(embed=embed)
     client._vote_skips.setdefault(guild_id, {})[public_vote_message.id] = [interaction.user.id]
     
-    vote_view = View(timeout=60.0)
+    vote_view = GuildStateView(timeout=60.0)
     yes_button = Button(label="✅ Vote Yes", style=discord.ButtonStyle.green, custom_id=f"internal_voteskip_yes_{public_vote_message.id}")
     vote_view.add_item(yes_button)
     
@@ -1680,26 +3755,31 @@ async def music_queue_move_slash(interaction: discord.Interaction, from_index: i
 @app_commands.describe(identifier="1-based Index or part of title.")
 async def music_queue_jump_slash(interaction: discord.Interaction, identifier: str): await _handle_queue_jump_logic(interaction, identifier)
 
-@music_queue_group.command(name="export", description="Exports current queue to a text file of URLs.")
+@music_queue_group.command(name="export", description="Exports the current queue (with song metadata) to a JSON Lines file.")
 async def music_queue_export_slash(interaction: discord.Interaction):
     guild_id = interaction.guild.id; full_queue = []
-    if client._current_song.get(guild_id): full_queue.append(client._current_song[guild_id].copy())
-    full_queue.extend(s.copy() for s in client._queues.get(guild_id, []))
+    if client._current_song.get(guild_id): full_queue.append(dict(client._current_song[guild_id]))
+    full_queue.extend(dict(s) for s in client._queues.get(guild_id, [])) # Copied on the loop: the pre-resolver edits queued songs in place while the writer thread serializes
+    song_count = sum(1 for s in full_queue if s.get('webpage_url'))
     if not full_queue:
         await send_custom_response(interaction, embed=create_error_embed("Queue is empty. Nothing to export."), ephemeral_preference=True); return
-    urls = [s.get('webpage_url') for s in full_queue if s.get('webpage_url')]
-    if not urls:
+    if not song_count:
         await send_custom_response(interaction, embed=create_error_embed("No exportable URLs found in the queue."), ephemeral_preference=True); return
     
-    file_obj = StringIO("\n".join(urls))
-    fname = "".join(c if c.isalnum() else "_" for c in interaction.guild.name)
-    df = discord.File(fp=file_obj, filename=f"{fname}_queue_export.txt")
-    await send_custom_response(interaction, content=f"Exported queue with {len(urls)} songs:", embed=None, ephemeral_preference=True) # Send info first
-    await interaction.followup.send(file=df, ephemeral=True) # Send file in followup
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    export_path = await asyncio.to_thread(write_queue_export_file, full_queue, interaction.guild.name)
+    try:
+        fname = "".join(c if c.isalnum() else "_" for c in interaction.guild.name)
+        df = discord.File(export_path, filename=f"{fname}_queue_export.jsonl")
+        await send_custom_response(interaction, content=f"Exported queue with {song_count} songs (re-import it with `/music queue import`):", embed=None, ephemeral_preference=True) # Send info first
+        await interaction.followup.send(file=df, ephemeral=True) # Send file in followup
+    finally:
+        try: os.remove(export_path)
+        except OSError: pass
 
 
-@music_queue_group.command(name="import", description="Imports songs from a raw text file URL.")
-@app_commands.describe(url="URL of raw text file (each line a song URL).", mode="Append or Replace.")
+@music_queue_group.command(name="import", description="Imports songs from a URL list, M3U/PLS playlist or queue export file.")
+@app_commands.describe(url="URL of a raw text file (one song URL per line), M3U/M3U8, PLS or JSON queue export.", mode="Append or Replace.")
 @app_commands.choices(mode=[app_commands.Choice(name="Append", value="append"), app_commands.Choice(name="Replace", value="replace")])
 async def music_queue_import_slash(interaction: discord.Interaction, url: str, mode: app_commands.Choice[str]): await _handle_queue_import_logic(interaction, url, mode.value)
 
@@ -1787,6 +3867,12 @@ async def stats_command(interaction: discord.Interaction):
     embed.add_field(name="🏓 Latency", value=f"`{round(client.latency*1000)}ms`").add_field(name="⏳ Uptime", value=uptime).add_field(name="💻 Servers", value=str(len(client.guilds)))
     embed.add_field(name="🎤 Active VCs", value=str(len(client._voice_clients))).add_field(name="🎵 Playing/Queued", value=f"{playing_now}/{queued}")
     embed.add_field(name="⚙️ discord.py", value=discord.__version__)
+    embed.add_field(name="🧵 Resolver", value=f"```{resolution_scheduler.summary()}\ncoalesced: {coalesce_stats['joined']} joined / {coalesce_stats['started']} extractions```", inline=False)
+    embed.add_field(name="💽 Guild State Saves", value=f"```{guild_state_persister.summary()}\n{queue_journal.summary()}\n{len(client._loaded_guilds)}/{GUILD_STATE_MAX_RESIDENT} guilds resident ({storage.name} storage) · {client._guild_state_stats['evictions']} evicted · {client._guild_state_stats['reloads']} reloaded```", inline=False)
+    if AUDIO_CACHE_ENABLED: embed.add_field(name="💾 Audio Cache", value=f"```{audio_cache.summary()}```", inline=False)
+    embed.add_field(name="📻 Shared Live Streams", value=f"`{live_stream_hub.summary()}`", inline=False)
+    buffer_stats = client._playback_buffer_stats.get(interaction.guild_id) if interaction.guild_id else None
+    if buffer_stats: embed.add_field(name="🎧 Playback Buffer (this server)", value=f"`{buffer_stats['buffered_ms'] / 1000:.1f}s buffered · {buffer_stats['underruns']} underruns · {buffer_stats['overruns']} overruns`", inline=False)
     await send_custom_response(interaction, embed=embed, ephemeral_preference=False)
 
 
@@ -1812,7 +3898,7 @@ async def customprefix_slash_command(interaction: discord.Interaction, action: a
     if action.value == "view":
         await send_custom_response(interaction, content=f"Current prefixes for this server: `{'`, `'.join(current_guild_prefixes)}`\nDefault bot prefix: `{client.default_prefix_val}`", ephemeral_preference=True); return
     if action.value == "reset":
-        if guild_id in client.custom_prefixes: del client.custom_prefixes[guild_id]; await client.save_custom_prefixes_to_file()
+        if guild_id in client.custom_prefixes: del client.custom_prefixes[guild_id]; await client.save_custom_prefixes_to_file(guild_id)
         await send_custom_response(interaction, content=f"Custom prefixes reset. Current prefix is now the default: `{client.default_prefix_val}`", ephemeral_preference=True); return
     if not prefixes_str:
         await send_custom_response(interaction, embed=create_error_embed("You must provide prefix(es) for 'add' or 'remove' actions."), ephemeral_preference=True); return
@@ -1841,7 +3927,7 @@ async def customprefix_slash_command(interaction: discord.Interaction, action: a
         if modified and not client.custom_prefixes[guild_id]: client.custom_prefixes.pop(guild_id) # Should not happen due to check above, but safeguard
         msg_action = f"Removed prefixes: `{', '.join(feedback_prefixes)}`." if modified and feedback_prefixes else "No matching prefixes found to remove."
     
-    if modified: await client.save_custom_prefixes_to_file()
+    if modified: await client.save_custom_prefixes_to_file(guild_id)
     final_prefixes_display = client.custom_prefixes.get(guild_id, [client.default_prefix_val])
     await send_custom_response(interaction, content=f"{msg_action}\nCurrent prefixes: `{'`, `'.join(final_prefixes_display)}`", ephemeral_preference=True)
 
@@ -1908,6 +3994,7 @@ async def _handle_play_logic(
     original_text_query: Optional[str] = None
 ):
     print(f"\nDEBUG CMD_PLAY: _handle_play_logic CALLED. Query: '{truncate_text(query, 100)}', Platform Override: {platform_override}")
+    if ctx_or_interaction.guild: await client_instance.ensure_guild_loaded(ctx_or_interaction.guild.id) # Also reached from view callbacks and message handlers
     
     # --- NEW: Spotify Check ---
     # If a Spotify link somehow reaches this function, it means the on_message embed handler failed.
@@ -1965,7 +4052,7 @@ async def _handle_play_logic(
              song_audio_info = {"error": f"Search query for {platform_display_name} cannot be empty.", "title": query}
         elif is_interaction: 
             # (Slash command search logic with SearchResultsView and platform switch)
-            search_results_data = await get_audio_stream_info(query_to_use_for_this_search_internally, search=True, search_results_count=MAX_SEARCH_RESULTS, search_provider=search_platform)
+            search_results_data = await get_audio_stream_info(query_to_use_for_this_search_internally, search=True, search_results_count=MAX_SEARCH_RESULTS, search_provider=search_platform, guild_id=guild_id)
             # ... (the rest of the slash command search path from previous answer)
             if not search_results_data or "error" in search_results_data or not search_results_data.get('entries'):
                 err_msg = search_results_data.get('error', "No results found.") if search_results_data else "No results found."
@@ -1987,13 +4074,13 @@ async def _handle_play_logic(
                 return 
             if search_view_instance.selected_song_info:
                 selected_url = search_view_instance.selected_song_info.get('webpage_url') or search_view_instance.selected_song_info.get('url')
-                if selected_url: song_audio_info = await get_audio_stream_info(selected_url, search=False)
+                if selected_url: song_audio_info = await get_audio_stream_info(selected_url, search=False, guild_id=guild_id)
                 else: song_audio_info = {"error": "Selected search result missing a valid URL."}
             else: return
 
         else: # (Text command search logic with SoundCloud switch)
             # ... (The full text search logic from previous answer goes here)
-            search_results_data = await get_audio_stream_info(query_to_use_for_this_search_internally, search=True, search_results_count=MAX_SEARCH_RESULTS, search_provider=search_platform)
+            search_results_data = await get_audio_stream_info(query_to_use_for_this_search_internally, search=True, search_results_count=MAX_SEARCH_RESULTS, search_provider=search_platform, guild_id=guild_id)
             # (Your full text search logic here to select an item and set song_audio_info, including the recursive call for SoundCloud switch)
             if not search_results_data or "error" in search_results_data or not search_results_data.get('entries'):
                 err_msg = search_results_data.get('error', "No results found.") if search_results_data else "No results found."
@@ -2067,7 +4154,7 @@ async def _handle_play_logic(
             if chosen_idx != -1 and pending_data: # Copied
                 selected_ref = pending_data['results'][chosen_idx]
                 sel_url = selected_ref.get('webpage_url') or selected_ref.get('url')
-                if sel_url: song_audio_info = await get_audio_stream_info(sel_url, search=False) 
+                if sel_url: song_audio_info = await get_audio_stream_info(sel_url, search=False, guild_id=guild_id) 
                 else: song_audio_info = {"error": "Selected text search result missing URL."}
                 try: 
                     title_display = song_audio_info.get('title','N/A') if song_audio_info and "error" not in song_audio_info else "Error"
@@ -2080,7 +4167,7 @@ async def _handle_play_logic(
 
 
     elif is_url: # Direct URL (but guaranteed not Spotify at this point)
-        song_audio_info = await get_audio_stream_info(query, search=False)
+        song_audio_info = await get_audio_stream_info(query, search=False, guild_id=guild_id)
 
     # ... (Common queuing logic at the end - this part is unchanged and required)
     if not song_audio_info or "error" in song_audio_info or not song_audio_info.get('webpage_url'):
@@ -2098,9 +4185,9 @@ async def _handle_play_logic(
         'webpage_url': song_audio_info.get('webpage_url'), 'title': song_audio_info.get('title', 'Unknown Title'),
         'duration': song_audio_info.get('duration'), 'thumbnail': song_audio_info.get('thumbnail'),
         'uploader': song_audio_info.get('uploader', 'Unknown Uploader'), 'requester': user_obj.mention,
-        'stream_url': song_audio_info.get('url')
+        'stream_url': song_audio_info.get('url'), 'stream_expires_at': song_audio_info.get('stream_expires_at'), 'stream_acodec': song_audio_info.get('acodec')
     }
-    client_instance._queues[guild_id].append(song_to_add)
+    client_instance.queue_add(guild_id, song_to_add); client_instance.notify_queue_changed(guild_id)
     await client_instance.save_guild_settings_to_file(guild_id) 
     
     add_embed = discord.Embed(title="🎵 Added to Queue", description=f"[{truncate_text(song_to_add['title'],70)}]({song_to_add['webpage_url']})", color=discord.Color.green())
@@ -2206,7 +4293,7 @@ async def _handle_stop_logic(ctx_or_interaction: Union[commands.Context, discord
     if isinstance(ctx_or_interaction, discord.Interaction) and not ctx_or_interaction.response.is_done():
         await ctx_or_interaction.response.defer(ephemeral=False) # Stop message is public
 
-    client._queues[guild_id] = []
+    client.queue_clear(guild_id)
     client._current_song[guild_id] = None # Clear current song before saving
     client.set_guild_loop_mode(guild_id, "off") # Reset loop on stop
     if guild_id in client._up_next_tasks: client._up_next_tasks[guild_id].cancel(); client._up_next_tasks.pop(guild_id, None)
@@ -2236,9 +4323,7 @@ async def _handle_nowplaying_logic(ctx_or_interaction: Union[commands.Context, d
     
     progress_str = format_duration(current.get('duration', 0))
     if current.get('duration') is not None and current.get('duration') > 0 and not current.get('is_live_stream'):
-        elapsed_time_sec = current.get('accumulated_play_time_seconds', 0.0)
-        if current.get('play_start_utc'): elapsed_time_sec += (datetime.datetime.now(timezone.utc) - current['play_start_utc']).total_seconds()
-        elapsed_time_sec = min(elapsed_time_sec, current['duration'])
+        elapsed_time_sec = min(client.get_playback_position(guild_id), current['duration'])
         
         bar_len = 20; prog_pct = elapsed_time_sec / current['duration'] if current['duration'] > 0 else 0
         fill_len = int(bar_len * prog_pct)
@@ -2387,7 +4472,7 @@ async def _handle_queue_clear_logic(ctx_or_interaction: Union[commands.Context,
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("Only controllers can clear the queue."), ephemeral_preference=True); return
     guild_id = ctx_or_interaction.guild.id
     if client._queues.get(guild_id):
-        client._queues[guild_id] = []; await client.save_guild_settings_to_file(guild_id)
+        client.queue_clear(guild_id); client.notify_queue_changed(guild_id); await client.save_guild_settings_to_file(guild_id)
         await send_custom_response(ctx_or_interaction, embed=create_success_embed("Queue Cleared", "All songs have been removed from the queue."), ephemeral_preference=False)
     else:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("The queue is already empty."), ephemeral_preference=True)
@@ -2403,14 +4488,15 @@ async def _handle_queue_remove_logic(ctx_or_interaction: Union[commands.Context,
     removed_song = None
     try:
         idx = int(identifier) - 1
-        if 0 <= idx < len(queue): removed_song = queue.pop(idx)
+        if 0 <= idx < len(queue): removed_song = client.queue_pop(guild_id, idx)
     except ValueError:
         ident_lower = identifier.lower()
         # Search from bottom up so removing multiple by title starts with earlier occurrences
         for i in range(len(queue) -1, -1, -1):
-            if ident_lower in queue[i]['title'].lower(): removed_song = queue.pop(i); break 
+            if ident_lower in queue[i]['title'].lower(): removed_song = client.queue_pop(guild_id, i); break
                 
     if removed_song:
+        client.notify_queue_changed(guild_id)
         await client.save_guild_settings_to_file(guild_id)
         await send_custom_response(ctx_or_interaction, embed=create_success_embed("Song Removed", f"Removed **{truncate_text(removed_song['title'],60)}** from the queue."), ephemeral_preference=False)
     else:
@@ -2428,15 +4514,11 @@ async def _handle_queue_removerange_logic(ctx_or_interaction: Union[commands.Con
     if not (0 <= start_0 < len(queue) and start_0 <= end_0 < len(queue)):
         await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Invalid range. Please provide indices between 1 and {len(queue)}."), ephemeral_preference=True); return
     
-    num_to_remove = (end_0 - start_0) + 1; removed_count = 0
-    # Iteratively pop from the start_0 index. This handles shifting indices.
-    for _ in range(num_to_remove):
-        if start_0 < len(client._queues[guild_id]): # Check bounds each time
-            client._queues[guild_id].pop(start_0)
-            removed_count += 1
-        else: break # Should not be strictly necessary with initial range check, but safe
+    num_to_remove = (end_0 - start_0) + 1
+    removed_count = len(client.queue_remove_range(guild_id, start_0, num_to_remove))
     
     if removed_count > 0:
+        client.notify_queue_changed(guild_id)
         await client.save_guild_settings_to_file(guild_id)
         await send_custom_response(ctx_or_interaction, embed=create_success_embed("Songs Removed", f"Successfully removed {removed_count} songs from the queue."), ephemeral_preference=False)
     else: # Should not happen if range was valid and queue not empty.
@@ -2448,7 +4530,7 @@ async def _handle_queue_shuffle_logic(ctx_or_interaction: Union[commands.Context
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("Only controllers can shuffle the queue."), ephemeral_preference=True); return
     guild_id = ctx_or_interaction.guild.id
     if client._queues.get(guild_id) and len(client._queues[guild_id]) > 1:
-        random.shuffle(client._queues[guild_id]); await client.save_guild_settings_to_file(guild_id)
+        client.queue_shuffle(guild_id); client.notify_queue_changed(guild_id); await client.save_guild_settings_to_file(guild_id)
         await send_custom_response(ctx_or_interaction, embed=discord.Embed(title="🔀 Queue Shuffled", description="The song queue has been shuffled!", color=discord.Color.random()), ephemeral_preference=False)
     else:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("Not enough songs in the queue to shuffle (need at least 2)."), ephemeral_preference=True)
@@ -2469,13 +4551,9 @@ async def _handle_queue_move_logic(ctx_or_interaction: Union[commands.Context, d
     if from_0 == to_0 or (from_0 == max_idx and to_0 == len(queue)): # Trying to move to same spot or last to end
          await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Song is already at or effectively at position {to_index}."), ephemeral_preference=True); return
     
-    song_to_move = queue.pop(from_0)
-    # If to_0 was intended for the end (len(queue) before pop), it's now one less or simply append
-    if to_0 >= len(queue): # After pop, if to_0 was original len(queue) or more
-        queue.append(song_to_move)
-    else:
-        queue.insert(to_0, song_to_move)
+    song_to_move = client.queue_move(guild_id, from_0, to_0) # A 'to' past the end (after the pop) appends
 
+    client.notify_queue_changed(guild_id)
     await client.save_guild_settings_to_file(guild_id)
     final_pos = queue.index(song_to_move) + 1 # Get actual new 1-based index
     await send_custom_response(ctx_or_interaction, embed=create_success_embed("Song Moved", f"Moved '{truncate_text(song_to_move['title'], 50)}' from position {from_index} to {final_pos}."), ephemeral_preference=False)
@@ -2507,8 +4585,7 @@ async def _handle_queue_jump_logic(ctx_or_interaction: Union[commands.Context, d
     if isinstance(ctx_or_interaction, discord.Interaction) and not ctx_or_interaction.response.is_done():
         await ctx_or_interaction.response.defer(ephemeral=False) # Jump confirmation is public
 
-    song_to_jump_to = client._queues[guild_id].pop(target_song_idx_0)
-    client._queues[guild_id].insert(0, song_to_jump_to)
+    client.queue_move(guild_id, target_song_idx_0, 0); client.notify_queue_changed(guild_id)
     
     if guild_id in client._up_next_tasks: client._up_next_tasks[guild_id].cancel(); client._up_next_tasks.pop(guild_id, None)
     client._is_processing_next_song[guild_id] = False
@@ -2519,6 +4596,215 @@ async def _handle_queue_jump_logic(ctx_or_interaction: Union[commands.Context, d
     else: await client._play_guild_queue(guild_id) # If bot was idle
     await client.save_guild_settings_to_file(guild_id)
 
+class PlaylistImportParser:
+    """
+    Incremental parser for queue import files: plain URL lists, M3U/M3U8 (#EXTINF), PLS, JSON arrays
+    and JSON Lines (the /music queue export format). Text is fed in chunks as it arrives; only the
+    unfinished tail of the current line / JSON object is buffered. Yields dicts with 'webpage_url'
+    and whatever of title/duration/uploader/thumbnail the file carries.
+    """
+    def __init__(self):
+        self.format: Optional[str] = None
+        self._buffer = ""
+        self._pending_extinf: Optional[Dict[str, Any]] = None
+        self._pls_index: Optional[str] = None; self._pls_entry: Dict[str, Any] = {}
+        self._json_decoder = json.JSONDecoder(); self._json_array_started = False
+
+    @staticmethod
+    def _entry_from_object(obj: Any) -> Optional[Dict[str, Any]]:
+        if not isinstance(obj, dict): return None
+        url = obj.get('webpage_url') or obj.get('url')
+        if not isinstance(url, str) or not url.startswith("http"): return None
+        entry = {'webpage_url': url}
+        for key in ('title', 'uploader', 'thumbnail'):
+            if obj.get(key) is not None: entry[key] = obj[key]
+        if isinstance(obj.get('duration'), (int, float)): entry['duration'] = obj['duration']
+        if obj.get('hash') and obj['hash'] == queue_entry_content_hash(obj): # Untouched /music queue export record
+            entry['verified_export'] = True
+            if isinstance(obj.get('requester_id'), int): entry['requester_id'] = obj['requester_id']
+        return entry
+
+    def _detect_format(self) -> bool:
+        head = self._buffer.lstrip("\ufeff \t\r\n")
+        if len(head) < 10 and "\n" not in head: return False # Need a bit more text to decide
+        lowered = head[:16].lower()
+        if lowered.startswith("[playlist]"): self.format = "pls"
+        elif head.startswith("["): self.format = "json_array"
+        elif head.startswith("{"): self.format = "json_lines"
+        elif lowered.startswith("#extm3u") or lowered.startswith("#extinf"): self.format = "m3u"
+        else: self.format = "lines"
+        self._buffer = head
+        return True
+
+    def _parse_line(self, line: str) -> List[Dict[str, Any]]:
+        line = line.strip()
+        if not line: return []
+        if self.format == "json_lines":
+            try: entry = self._entry_from_object(json.loads(line))
+            except json.JSONDecodeError: return []
+            return [entry] if entry else []
+        if self.format == "pls":
+            match = re.match(r"(?i)(file|title|length)(\d+)\s*=\s*(.*)", line)
+            if not match: return []
+            key, index, value = match.group(1).lower(), match.group(2), match.group(3).strip()
+            finished = self._flush_pls() if index != self._pls_index else []
+            self._pls_index = index
+            if key == "file": self._pls_entry['webpage_url'] = value
+            elif key == "title" and value: self._pls_entry['title'] = value
+            elif key == "length" and value.lstrip("-").isdigit() and int(value) >= 0: self._pls_entry['duration'] = int(value)
+            return finished
+        # M3U / plain URL lists
+        if line.lower().startswith("#extinf:"):
+            duration_part, _, title_part = line[8:].partition(",")
+            duration_match = re.match(r"\s*(-?\d+(?:\.\d+)?)", duration_part)
+            self._pending_extinf = {}
+            if duration_match and float(duration_match.group(1)) >= 0: self._pending_extinf['duration'] = float(duration_match.group(1))
+            if title_part.strip(): self._pending_extinf['title'] = title_part.strip()
+            return []
+        if line.startswith("#") or not line.startswith("http"): return []
+        entry = {'webpage_url': line, **(self._pending_extinf or {})}; self._pending_extinf = None
+        return [entry]
+
+    def _flush_pls(self) -> List[Dict[str, Any]]:
+        entry, self._pls_entry = self._pls_entry, {}
+        return [entry] if entry.get('webpage_url', '').startswith("http") else []
+
+    def _parse_json_array(self, final: bool) -> List[Dict[str, Any]]:
+        entries = []
+        if not self._json_array_started:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer.startswith("["): return entries
+            self._buffer = self._buffer[1:]; self._json_array_started = True
+        while True:
+            self._buffer = self._buffer.lstrip(" \t\r\n,")
+            if not self._buffer or self._buffer.startswith("]"): break
+            try: obj, end = self._json_decoder.raw_decode(self._buffer)
+            except json.JSONDecodeError:
+                if final or len(self._buffer) > IMPORT_MAX_ENTRY_CHARS: self._buffer = "" # Malformed or oversized element
+                break # Otherwise the element is incomplete; wait for more data
+            self._buffer = self._buffer[end:]
+            if entry := self._entry_from_object(obj): entries.append(entry)
+        return entries
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buffer += text
+        if self.format is None and not self._detect_format(): return []
+        if self.format == "json_array": return self._parse_json_array(final=False)
+        entries = []
+        *complete_lines, self._buffer = self._buffer.split("\n")
+        if len(self._buffer) > IMPORT_MAX_ENTRY_CHARS: self._buffer = "" # Drop a runaway line rather than buffer it
+        for line in complete_lines: entries.extend(self._parse_line(line))
+        return entries
+
+    def finish(self) -> List[Dict[str, Any]]:
+        if self.format is None: self._detect_format(); self.format = self.format or "lines"
+        if self.format == "json_array": return self._parse_json_array(final=True)
+        entries = self._parse_line(self._buffer); self._buffer = ""
+        if self.format == "pls": entries.extend(self._flush_pls())
+        return entries
+
+async def read_import_entries(resp: aiohttp.ClientResponse, max_entries: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """Streams an import file's body through PlaylistImportParser. Returns (entries, truncated)."""
+    parser = PlaylistImportParser(); decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    entries: List[Dict[str, Any]] = []; bytes_read = 0; truncated = False
+    async for chunk in resp.content.iter_chunked(16 * 1024):
+        bytes_read += len(chunk)
+        entries.extend(parser.feed(decoder.decode(chunk)))
+        if len(entries) >= max_entries or bytes_read >= IMPORT_MAX_BYTES: truncated = True; break
+    else:
+        entries.extend(parser.feed(decoder.decode(b"", final=True))); entries.extend(parser.finish())
+    if len(entries) > max_entries: entries, truncated = entries[:max_entries], True
+    print(f"DEBUG IMPORT: Parsed {len(entries)} entries ({parser.format}) from {bytes_read} bytes. Truncated: {truncated}")
+    return entries, truncated
+
+async def _run_bulk_import(guild_id: int, items: List[Dict[str, Any]], requester: str, status_message: Optional[discord.Message], cancel_view: BulkImportView) -> Dict[str, int]:
+    """
+    Resolves import `items` (dicts with 'webpage_url' plus any known metadata) with bounded parallelism and
+    appends them to the guild queue in their original order. Items that already carry a title and duration,
+    or whose metadata is in the track cache, are enqueued lazily without any yt-dlp call.
+    Each finished prefix is committed immediately, so playback can start early and a cancel or a full
+    queue keeps everything committed so far. Progress is streamed by editing `status_message`.
+    """
+    await client.ensure_guild_loaded(guild_id)
+    client._running_imports[guild_id] = client._running_imports.get(guild_id, 0) + 1 # Resident until the import finishes (released below)
+    counts = {"added": 0, "failed": 0, "skipped": 0, "total": len(items)}
+    results: Dict[int, Any] = {}; next_to_commit = 0; queue_full = False
+    semaphore = asyncio.Semaphore(BULK_IMPORT_CONCURRENCY)
+    SKIPPED = object() # Sentinel for URLs never resolved because of cancel / full queue
+
+    def commit_ready_prefix():
+        # Runs on the event loop without awaiting, so commits are atomic with respect to other queue edits
+        nonlocal next_to_commit, queue_full
+        committed_any = False
+        while next_to_commit in results:
+            entry = results.pop(next_to_commit); next_to_commit += 1
+            if entry is SKIPPED: counts["skipped"] += 1
+            elif entry is None: counts["failed"] += 1
+            elif len(client._queues.setdefault(guild_id, [])) >= MAX_QUEUE_SIZE: queue_full = True; counts["skipped"] += 1
+            else: client.queue_add(guild_id, entry); counts["added"] += 1; committed_any = True
+        if committed_any:
+            client.notify_queue_changed(guild_id)
+            vc = client._voice_clients.get(guild_id)
+            if vc and not vc.is_playing() and not vc.is_paused() and not client._current_song.get(guild_id) and not client._is_processing_next_song.get(guild_id):
+                client.loop.create_task(client._play_guild_queue(guild_id)) # Start playing as soon as the first track is in
+
+    guild = client.get_guild(guild_id)
+
+    async def resolve_one(index: int, item: Dict[str, Any]):
+        song_url = item['webpage_url']
+        try:
+            if cancel_view.cancelled or queue_full: results[index] = SKIPPED; return
+            if item.get('verified_export') and item.get('title'): # Trusted export record, even without a duration (live streams)
+                original_requester = guild.get_member(item['requester_id']) if guild and item.get('requester_id') else None
+                entry_requester = f"{original_requester.mention} (Import)" if original_requester else requester
+                results[index] = await build_lazy_queue_entry(song_url, entry_requester, known_metadata=item); return
+            if item.get('title') and item.get('duration') is not None: # Enough to queue it; the stream resolves just-in-time
+                results[index] = await build_lazy_queue_entry(song_url, requester, known_metadata=item); return
+            async with semaphore:
+                if cancel_view.cancelled or queue_full: results[index] = SKIPPED; return
+                known_metadata = await track_cache.peek_metadata(song_url)
+                if known_metadata: results[index] = await build_lazy_queue_entry(song_url, requester, known_metadata=known_metadata); return
+                info = await get_audio_stream_info(song_url, priority=RESOLVE_PRIORITY_BULK, guild_id=guild_id)
+                if not info or "error" in info or not info.get('webpage_url') or info.get('_type') == 'playlist': results[index] = None; return
+                results[index] = {
+                    'webpage_url': info.get('webpage_url'), 'title': info.get('title', 'Unknown Title'),
+                    'duration': info.get('duration'), 'thumbnail': info.get('thumbnail'),
+                    'uploader': info.get('uploader', 'Unknown Uploader'), 'requester': requester,
+                    'stream_url': info.get('url'), 'stream_expires_at': info.get('stream_expires_at'), 'stream_acodec': info.get('acodec')}
+        except Exception as e:
+            print(f"Error resolving import entry {index} ('{truncate_text(song_url, 80)}'): {e}"); results[index] = None
+        finally: commit_ready_prefix()
+
+    def progress_embed(final: bool = False) -> discord.Embed:
+        done = counts["added"] + counts["failed"] + counts["skipped"]
+        title = "📥 Import Cancelled" if final and cancel_view.cancelled else ("📥 Import Finished" if final else "📥 Importing...")
+        embed = discord.Embed(title=title, description=f"Processed **{done}/{counts['total']}** URLs.", color=discord.Color.green() if final else discord.Color.blue())
+        embed.add_field(name="Added", value=str(counts["added"])).add_field(name="Failed", value=str(counts["failed"])).add_field(name="Skipped", value=str(counts["skipped"]))
+        if queue_full: embed.set_footer(text=f"Queue reached the maximum of {MAX_QUEUE_SIZE} songs.")
+        return embed
+
+    async def stream_progress():
+        last_snapshot = None
+        while True:
+            await asyncio.sleep(BULK_IMPORT_PROGRESS_INTERVAL)
+            snapshot = (counts["added"], counts["failed"], counts["skipped"])
+            if status_message and snapshot != last_snapshot:
+                try: await status_message.edit(embed=progress_embed())
+                except discord.HTTPException: pass
+                last_snapshot = snapshot
+
+    progress_task = asyncio.create_task(stream_progress())
+    try: await asyncio.gather(*(resolve_one(i, item) for i, item in enumerate(items)))
+    finally:
+        progress_task.cancel()
+        client._running_imports[guild_id] -= 1
+        if not client._running_imports[guild_id]: client._running_imports.pop(guild_id)
+    await client.save_guild_settings_to_file(guild_id)
+    if status_message:
+        try: await status_message.edit(embed=progress_embed(final=True), view=None)
+        except discord.HTTPException: pass
+    return counts
+
 async def _handle_queue_import_logic(ctx_or_interaction: Union[commands.Context, discord.Interaction], url: str, mode: str):
     is_interaction = isinstance(ctx_or_interaction, discord.Interaction)
     if is_interaction:
@@ -2533,53 +4819,37 @@ async def _handle_queue_import_logic(ctx_or_interaction: Union[commands.Context,
     
     try:
         async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as resp:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=60, sock_read=10)) as resp:
                 if resp.status != 200:
                     await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Failed to fetch the URL (Status: {resp.status})."), ephemeral_preference=True); return
-                content = await resp.text()
+                items_to_add, truncated = await read_import_entries(resp, BULK_IMPORT_MAX_URLS)
     except Exception as e:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Error fetching URL: {e}"), ephemeral_preference=True); return
 
-    urls_to_add = [line.strip() for line in content.splitlines() if line.strip().startswith("http")]
-    if not urls_to_add:
+    if not items_to_add:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("No valid URLs found in the provided file content."), ephemeral_preference=True); return
 
     client._queues.setdefault(guild_id, [])
     if mode == "replace":
-        client._queues[guild_id] = []
+        client.queue_clear(guild_id)
         if client._current_song.get(guild_id): 
             if vc.is_playing() or vc.is_paused(): vc.stop()
             client._current_song[guild_id] = None
 
-    added_count = 0; failed_count = 0
-    max_to_add_this_session = 50 # Limit imports per command to avoid abuse/long waits
-    initial_queue_size = len(client._queues[guild_id])
+    if truncated:
+        await send_custom_response(ctx_or_interaction, embed=create_info_embed("Import Limit Reached", f"Only the first {len(items_to_add)} entries will be imported (max {BULK_IMPORT_MAX_URLS} songs / {IMPORT_MAX_BYTES // (1024 * 1024)} MB per import)."), ephemeral_preference=True)
 
-    for i, song_url in enumerate(urls_to_add):
-        if i >= max_to_add_this_session:
-            await send_custom_response(ctx_or_interaction, embed=create_info_embed("Import Limit Reached", f"Imported {added_count} songs. Maximum {max_to_add_this_session} songs can be imported at once."), ephemeral_preference=True); break
-        if initial_queue_size + added_count >= MAX_QUEUE_SIZE:
-            await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Queue is full. Successfully added {added_count} songs. {failed_count} URLs failed or were skipped."), ephemeral_preference=True); break
-        
-        temp_requester = f"{user_mention} (Import)" 
-        song_audio_info = await get_audio_stream_info(song_url)
-        if not song_audio_info or "error" in song_audio_info or not song_audio_info.get('webpage_url'):
-            failed_count += 1; continue
-        
-        client._queues[guild_id].append({
-            'webpage_url': song_audio_info.get('webpage_url'), 'title': song_audio_info.get('title', 'Unknown Title'),
-            'duration': song_audio_info.get('duration'), 'thumbnail': song_audio_info.get('thumbnail'),
-            'uploader': song_audio_info.get('uploader', 'Unknown Uploader'), 'requester': temp_requester,
-            'stream_url': song_audio_info.get('url')})
-        added_count += 1
-    
-    await client.save_guild_settings_to_file(guild_id)
-    desc = f"Successfully added {added_count} songs to the queue." if mode == "append" else f"Successfully replaced the queue with {added_count} songs."
-    if failed_count > 0: desc += f" ({failed_count} URLs failed to process or were skipped)."
-    await send_custom_response(ctx_or_interaction, embed=create_success_embed("Queue Imported", desc), ephemeral_preference=False)
+    temp_requester = f"{user_mention} (Import)"
+    requester_id = ctx_or_interaction.user.id if is_interaction else ctx_or_interaction.author.id
+    cancel_view = BulkImportView(guild_id, requester_id)
+    start_embed = discord.Embed(title="📥 Importing...", description=f"Processed **0/{len(items_to_add)}** URLs.", color=discord.Color.blue())
+    status_message = None
+    try:
+        if is_interaction: status_message = await ctx_or_interaction.followup.send(embed=start_embed, view=cancel_view, wait=True)
+        else: status_message = await ctx_or_interaction.channel.send(embed=start_embed, view=cancel_view)
+    except discord.HTTPException as e: print(f"Failed to send import progress message: {e}")
 
-    if added_count > 0 and not vc.is_playing() and not client._current_song.get(guild_id) and client._queues[guild_id]:
-        await client._play_guild_queue(guild_id)
+    await _run_bulk_import(guild_id, items_to_add, temp_requester, status_message, cancel_view)
 
 async def _handle_settings_volume_logic(ctx_or_interaction: Union[commands.Context, discord.Interaction], level: int):
     user_obj = ctx_or_interaction.user if isinstance(ctx_or_interaction, discord.Interaction) else ctx_or_interaction.author
@@ -2742,7 +5012,7 @@ async def _handle_settings_djrole_logic(
 async def _handle_settings_view_logic(ctx_or_interaction: Union[commands.Context, discord.Interaction]):
     guild_id = ctx_or_interaction.guild.id
     # Ensure settings are loaded (should be by on_guild_join or startup, but as a safeguard)
-    if guild_id not in client._guild_settings: await client.load_guild_settings_from_file(guild_id)
+    await client.ensure_guild_loaded(guild_id)
     
     embed = discord.Embed(title=f"Saved Music Settings for {ctx_or_interaction.guild.name}", color=discord.Color.orange())
     embed.add_field(name="Volume", value=f"{int(client.get_guild_volume(guild_id)*100)}%").add_field(name="Loop Mode", value=client.get_guild_loop_mode(guild_id).capitalize())
@@ -2765,6 +5035,7 @@ async def _handle_settings_view_logic(ctx_or_interaction: Union[commands.Context
 
 async def _apply_effect_and_restart(guild_id: int, interaction_or_ctx: Union[discord.Interaction, commands.Context]):
     vc = client._voice_clients.get(guild_id); current_song = client._current_song.get(guild_id)
+    if client.apply_live_effects(guild_id): return # Handled in-process on the next audio frame; no FFmpeg restart or re-fetch
     if vc and (vc.is_playing() or vc.is_paused()) and current_song and not current_song.get('is_live_stream'):
         # For interactions, the initial response is already sent by the handler.
         # This is an additional notification.
@@ -2778,17 +5049,7 @@ async def _apply_effect_and_restart(guild_id: int, interaction_or_ctx: Union[dis
         else: # Text command
             await interaction_or_ctx.channel.send("Attempting to restart song with new effect(s)...")
 
-        accumulated_time = current_song.get('accumulated_play_time_seconds', 0.0)
-        if current_song.get('play_start_utc'): accumulated_time += (datetime.datetime.now(timezone.utc) - current_song['play_start_utc']).total_seconds()
-        
-        song_duration = current_song.get('duration')
-        # Ensure seek time is valid
-        if isinstance(song_duration, (int,float)) and accumulated_time >= song_duration :
-             accumulated_time = song_duration - 0.1 if song_duration > 0.1 else 0.0
-        
-        song_to_replay = current_song.copy()
-        # vc.stop() is handled by _play_guild_queue now
-        await client._play_guild_queue(guild_id, song_to_replay=song_to_replay, seek_seconds=max(0, accumulated_time))
+        await client.restart_current_song(guild_id)
     elif current_song and current_song.get('is_live_stream'):
         msg = "Effect saved. Live streams cannot be restarted; effect will apply to the next non-live song or if the stream reconnects."
         if isinstance(interaction_or_ctx, discord.Interaction):
@@ -2982,7 +5243,7 @@ async def _handle_playlist_save_logic(ctx_or_interaction: Union[commands.Context
     if not (1 <= len(name.strip()) <= 50): # Use original name for length check display
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("Playlist name must be between 1 and 50 characters."), ephemeral_preference=True); return
     
-    user_pls = load_user_playlists(user_obj.id)
+    user_pls = await load_user_playlists(user_obj.id)
     if len(user_pls) >= 20 and name_norm not in user_pls: # Max 20 playlists, unless overwriting
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("You have reached the maximum of 20 saved playlists. Delete an old one to save a new one."), ephemeral_preference=True); return
     
@@ -2993,7 +5254,7 @@ async def _handle_playlist_save_logic(ctx_or_interaction: Union[commands.Context
     if not pl_to_save:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("No songs with valid URLs in the queue to save."), ephemeral_preference=True); return
 
-    user_pls[name_norm] = pl_to_save; save_user_playlists(user_obj.id, user_pls)
+    user_pls[name_norm] = pl_to_save; await save_user_playlists(user_obj.id, user_pls)
     await send_custom_response(ctx_or_interaction, embed=create_success_embed("Playlist Saved", f"Playlist '**{name.strip()}**' with {len(pl_to_save)} songs has been saved!"), ephemeral_preference=True)
 
 
@@ -3009,14 +5270,14 @@ async def _handle_playlist_load_logic(ctx_or_interaction: Union[commands.Context
     vc = await client.ensure_voice_client(ctx_or_interaction, join_if_not_connected=True)
     if not vc: return # Error handled by ensure_voice_client
 
-    user_pls = load_user_playlists(user_obj.id); name_norm = name.strip().lower()
+    user_pls = await load_user_playlists(user_obj.id); name_norm = name.strip().lower()
     pl_to_load_refs = user_pls.get(name_norm)
     if not pl_to_load_refs:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Playlist '**{name.strip()}**' not found in your saved playlists."), ephemeral_preference=True); return
 
     client._queues.setdefault(guild_id, [])
     if mode_value == "replace":
-        client._queues[guild_id] = [] # Clear current server queue
+        client.queue_clear(guild_id) # Clear current server queue
         if client._current_song.get(guild_id): # If a song is playing, stop it
             if vc.is_playing() or vc.is_paused(): vc.stop()
             client._current_song[guild_id] = None # Clear current song
@@ -3030,24 +5291,15 @@ async def _handle_playlist_load_logic(ctx_or_interaction: Union[commands.Context
         if not isinstance(song_ref, dict) or not song_ref.get('webpage_url'):
             failed_count +=1; continue
         
-        # Fetch fresh audio info for stream URL and up-to-date metadata
-        audio_info = await get_audio_stream_info(song_ref['webpage_url'])
-        if not audio_info or "error" in audio_info or not audio_info.get('url'):
-            failed_count += 1; continue
-
-        client._queues[guild_id].append({
-            'webpage_url': audio_info.get('webpage_url'), 
-            'title': audio_info.get('title', song_ref.get('title', 'Unknown Title')), # Prefer fresh title
-            'duration': audio_info.get('duration', song_ref.get('duration')),
-            'thumbnail': audio_info.get('thumbnail', song_ref.get('thumbnail')),
-            'uploader': audio_info.get('uploader', song_ref.get('uploader')),
-            'requester': user_obj.mention, # Playlist loader is the requester
-            'stream_url': audio_info.get('url') # Crucial: fresh stream URL
-        }); added_count += 1
+        # Lazy entry from the saved fields; the stream URL is resolved just-in-time near the head of the queue
+        client.queue_add(guild_id, await build_lazy_queue_entry(song_ref['webpage_url'], user_obj.mention, known_metadata=song_ref)) # Playlist loader is the requester
+        added_count += 1
     
+    client.notify_queue_changed(guild_id)
     await client.save_guild_settings_to_file(guild_id)
     desc = f"Successfully added {added_count} songs from playlist '**{name.strip()}**' to the queue." if mode_value == "append" else f"Successfully replaced the queue with {added_count} songs from playlist '**{name.strip()}**'."
     if failed_count > 0: desc += f" ({failed_count} songs from the playlist failed to load)."
+    desc += " Songs are resolved as they approach the front of the queue."
     await send_custom_response(ctx_or_interaction, embed=create_success_embed("Playlist Loaded", desc), ephemeral_preference=False)
 
     if added_count > 0 and not vc.is_playing() and not client._current_song.get(guild_id) and client._queues.get(guild_id):
@@ -3056,7 +5308,7 @@ async def _handle_playlist_load_logic(ctx_or_interaction: Union[commands.Context
 
 async def _handle_playlist_list_logic(ctx_or_interaction: Union[commands.Context, discord.Interaction]):
     user_obj = ctx_or_interaction.user if isinstance(ctx_or_interaction, discord.Interaction) else ctx_or_interaction.author
-    user_pls = load_user_playlists(user_obj.id)
+    user_pls = await load_user_playlists(user_obj.id)
     if not user_pls:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed("You have no saved playlists."), ephemeral_preference=True); return
     
@@ -3071,9 +5323,9 @@ async def _handle_playlist_list_logic(ctx_or_interaction: Union[commands.Context
 
 async def _handle_playlist_delete_logic(ctx_or_interaction: Union[commands.Context, discord.Interaction], name: str):
     user_obj = ctx_or_interaction.user if isinstance(ctx_or_interaction, discord.Interaction) else ctx_or_interaction.author
-    user_pls = load_user_playlists(user_obj.id); name_norm = name.strip().lower()
+    user_pls = await load_user_playlists(user_obj.id); name_norm = name.strip().lower()
     if name_norm in user_pls:
-        del user_pls[name_norm]; save_user_playlists(user_obj.id, user_pls)
+        del user_pls[name_norm]; await save_user_playlists(user_obj.id, user_pls)
         await send_custom_response(ctx_or_interaction, embed=create_success_embed("Playlist Deleted", f"Playlist '**{name.strip()}**' has been deleted from your saved playlists."), ephemeral_preference=True)
     else:
         await send_custom_response(ctx_or_interaction, embed=create_error_embed(f"Playlist '**{name.strip()}**' not found in your saved playlists."), ephemeral_preference=True)
@@ -3317,6 +5569,7 @@ async def _initiate_play_from_embed(
 
     if not isinstance(user_obj, discord.Member) or not user_obj.voice or not user_obj.voice.channel:
         print(f"DEBUG EMBED_INIT: User {user_obj.name} not in VC."); return
+    await client_instance.ensure_guild_loaded(guild_id) # Not a command, so no command hook loaded the guild
 
     # ... (PseudoContext setup as before, using client_instance for ensure_voice_client)
     author_member = guild.get_member(user_obj.id)
@@ -3342,7 +5595,8 @@ async def _initiate_play_from_embed(
         actual_query_for_ytdl, # The clean search term or direct URL
         search=is_search_from_embed,
         search_results_count=1, # For embed auto-play, we take the top result
-        search_provider=search_provider_for_ytdl
+        search_provider=search_provider_for_ytdl,
+        guild_id=guild_id
     )
 
     if not song_audio_info or "error" in song_audio_info or \
@@ -3375,9 +5629,10 @@ async def _initiate_play_from_embed(
         'thumbnail': song_audio_info.get('thumbnail'),
         'uploader': song_audio_info.get('uploader'), 
         'requester': message.author.mention, # User who posted the link
-        'stream_url': song_audio_info['url'] # This is the direct playable stream
+        'stream_url': song_audio_info['url'], # This is the direct playable stream
+        'stream_expires_at': song_audio_info.get('stream_expires_at'), 'stream_acodec': song_audio_info.get('acodec')
     }
-    client_instance._queues[guild_id].append(song_to_add)
+    client_instance.queue_add(guild_id, song_to_add); client_instance.notify_queue_changed(guild_id)
     await client_instance.save_guild_settings_to_file(guild_id)
 
     # Corrected line below:
@@ -3530,6 +5785,7 @@ async def on_message(message: discord.Message):
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
     if not member.guild: return # Should not happen with voice state updates
     guild_id = member.guild.id
+    if member.id == client.user.id: await client.ensure_guild_loaded(guild_id) # Other members' moves only matter where the bot is connected, i.e. already loaded
     vc = client._voice_clients.get(guild_id)
 
     if member.id == client.user.id and before.channel and not after.channel: # Bot was disconnected